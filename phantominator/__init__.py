@@ -1,10 +1,11 @@
 """Bring functions up to the correct level."""
 
 from .ct_shepp_logan import (
-    ct_shepp_logan, ct_shepp_logan_params_2d,
+    ct_shepp_logan, ct_shepp_logan_slabs, ct_shepp_logan_params_2d,
     ct_modified_shepp_logan_params_2d, ct_shepp_logan_params_3d,
     ct_modified_shepp_logan_params_3d)
-from .mr_shepp_logan import mr_shepp_logan, mr_ellipsoid_parameters
+from .mr_shepp_logan import (
+    mr_shepp_logan, mr_shepp_logan_slabs, mr_ellipsoid_parameters)
 from .shepp_logan import shepp_logan
 from .dynamic import dynamic
 from .kspace import kspace_shepp_logan
@@ -1,18 +1,25 @@
 # -*- coding: utf-8 -*-
 """The canonical Shepp-Logan phantom used for CT simulations."""
 
-from typing import Tuple, Optional, Union
+from typing import Iterator, Tuple, Optional, Union
 
 import numpy as np
 import numpy.typing as npt
 
+from phantominator.ellipsoids import (
+    bounding_slice, check_out_shape, check_zlims, ellipse_extent,
+    ellipsoid_slabs, rasterize_slabs)
+
 
 def ct_shepp_logan(
         N: Union[int, npt.ArrayLike],
         modified: bool = True,
         E: Optional[npt.ArrayLike] = None,
         ret_E: bool = False,
-        zlims: Tuple[float, float] = (-1, 1)) -> Union[npt.ArrayLike, Tuple[npt.ArrayLike, npt.ArrayLike]]:
+        zlims: Tuple[float, float] = (-1, 1),
+        out: Optional[npt.ArrayLike] = None,
+        slab_size: int = 16,
+        num_threads: int = 1) -> Union[npt.ArrayLike, Tuple[npt.ArrayLike, npt.ArrayLike]]:
     """Generate a Shepp-Logan phantom of size (N, N).
 
     Parameters
@@ -52,11 +59,24 @@ def ct_shepp_logan(
     zlims : tuple, optional
         Only for 3D.  Specify bounds along z.  Often we only want the
         middle portion of a 3D phantom, e.g., zlim=(-.5, .5).
+    out : array_like, optional
+        Only for 3D.  Array of shape (L, M, N) to write the phantom
+        to, e.g., an np.memmap or a zarr array.  The phantom is then
+        generated in slabs along the first axis, so memory use is
+        bounded by the slab size rather than the volume.  Slabs of
+        chunked outputs such as zarr arrays are aligned to their
+        chunks, so they can be written by several threads.
+    slab_size : int, optional
+        Only for 3D.  Number of rows along the first axis generated at
+        a time with out or num_threads.
+    num_threads : int, optional
+        Only for 3D.  Rasterize slabs on a pool of num_threads
+        threads.  The output is identical to the serial one.
 
     Returns
     -------
     ph : array_like
-        The Shepp-Logan phantom.
+        The Shepp-Logan phantom (out, if given).
     E : array_like, optional
         The ellipse parameters used to generate ph.
 
@@ -100,7 +120,8 @@ def ct_shepp_logan(
         return ct_shepp_logan_2d(M, N, modified, E, ret_E)
     elif len(N) == 3:
         L, M, N = N[:]
-        return ct_shepp_logan_3d(L, M, N, modified, E, ret_E, zlims)
+        return ct_shepp_logan_3d(
+            L, M, N, modified, E, ret_E, zlims, out, slab_size, num_threads)
     else:
         raise ValueError('Dimension N must be scalar, 2D, or 3D!')
 
@@ -127,9 +148,8 @@ def ct_shepp_logan_2d(M: int, N: int,
     theta = E[:, 5]
 
     # 2x2 square => FOV = (-1, 1)
-    X, Y = np.meshgrid(  # meshgrid needs linspace in opposite order
-        np.linspace(-1, 1, N),
-        np.linspace(-1, 1, M))
+    x = np.linspace(-1, 1, N)
+    y = np.linspace(-1, 1, M)
     ph = np.zeros((M, N))
     ct = np.cos(theta)
     st = np.sin(theta)
@@ -139,13 +159,21 @@ def ct_shepp_logan_2d(M: int, N: int,
         a, b = major[ii], minor[ii]
         ct0, st0 = ct[ii], st[ii]
 
+        # Only evaluate the bounding box of the ellipse
+        xext, yext = ellipse_extent(a, b, ct0, st0)
+        sx = bounding_slice(x, xc, xext)
+        sy = bounding_slice(y, yc, yext)
+        if sx.start >= sx.stop or sy.start >= sy.stop:
+            continue
+        X, Y = np.meshgrid(x[sx], y[sy], sparse=True)
+
         # Find indices falling inside the ellipse
         idx = (
                 ((X - xc) * ct0 + (Y - yc) * st0) ** 2 / a ** 2 +
                 ((X - xc) * st0 - (Y - yc) * ct0) ** 2 / b ** 2 <= 1)
 
         # Sum of ellipses
-        ph[idx] += grey[ii]
+        ph[sy, sx][idx] += grey[ii]
 
     if ret_E:
         return ph, E
@@ -156,61 +184,84 @@ def ct_shepp_logan_3d(L: int, M: int, N: int,
                       modified: bool,
                       E: Optional[npt.ArrayLike],
                       ret_E: bool,
-                      zlims: Tuple[float, float]) -> Union[npt.ArrayLike, Tuple[npt.ArrayLike, npt.ArrayLike]]:
+                      zlims: Tuple[float, float],
+                      out: Optional[npt.ArrayLike] = None,
+                      slab_size: int = 16,
+                      num_threads: int = 1) -> Union[npt.ArrayLike, Tuple[npt.ArrayLike, npt.ArrayLike]]:
     """Make a 3D phantom."""
 
-    # Make sure zlims are appropriate
-    assert len(zlims) == 2, (
-        'zlims must be a tuple with 2 entries: upper and lower '
-        'bounds!')
-    assert zlims[0] <= zlims[1], (
-        'zlims: lower bound must be first entry!')
+    check_zlims(zlims)
+    E = _ct_params_3d(modified, E)
+    geometry = _ct_geometry_3d(E)
+
+    if out is not None:
+        # Stream slabs to the caller's array
+        check_out_shape((out,), (L, M, N))
+        rasterize_slabs((out,), (L, M, N), zlims, *geometry, slab_size, num_threads)
+        ph = out
+    else:
+        # Serially, the whole volume is one slab
+        ph = np.zeros((L, M, N))
+        rasterize_slabs((ph,), (L, M, N), zlims, *geometry,
+                        slab_size if num_threads > 1 else max(L, 1),
+                        num_threads, in_place=True)
+
+    if ret_E:
+        return ph, E
+    return ph
+
 
-    # Get parameters from paper if None provided
+def ct_shepp_logan_slabs(
+        N: Union[int, npt.ArrayLike],
+        modified: bool = True,
+        E: Optional[npt.ArrayLike] = None,
+        zlims: Tuple[float, float] = (-1, 1),
+        slab_size: int = 16) -> Iterator[Tuple[int, npt.ArrayLike]]:
+    """Generate a 3D Shepp-Logan phantom slab by slab.
+
+    Parameters
+    ----------
+    N : int or array_like
+        Matrix size, (N, N, N) or (L, M, N).
+    modified, E, zlims : optional
+        See ct_shepp_logan().
+    slab_size : int, optional
+        Number of rows along the first axis in each slab.
+
+    Yields
+    ------
+    start : int
+        Index along the first axis of the first row of the slab.
+    slab : array_like
+        The phantom rows start to start + slab_size (fewer for the
+        last slab).
+
+    Notes
+    -----
+    Concatenating the slabs gives ct_shepp_logan((L, M, N)) exactly,
+    while only one slab is held in memory at a time.
+    """
+    L, M, N = (N, N, N) if np.isscalar(N) else N[:]
+    check_zlims(zlims)
+    E = _ct_params_3d(modified, E)
+    for start, (slab,) in ellipsoid_slabs(
+            (L, M, N), zlims, *_ct_geometry_3d(E), slab_size):
+        yield start, slab
+
+
+def _ct_params_3d(modified: bool, E: Optional[npt.ArrayLike]) -> npt.ArrayLike:
+    """Get parameters from paper if None provided."""
     if E is None:
         if modified:
             E = ct_modified_shepp_logan_params_3d()
         else:
             E = ct_shepp_logan_params_3d()
+    return E
 
-    # Extract some parameters so we can use them
-    gray = E[:, 0]
-    xaxis = E[:, 1]
-    yaxis = E[:, 2]
-    zaxis = E[:, 3]
-    xs = E[:, 4]
-    ys = E[:, 5]
-    zs = E[:, 6]
-    theta = E[:, 7]
-
-    # Initialize array
-    X, Y, Z = np.meshgrid(  # meshgrid does X, Y backwards
-        np.linspace(-1, 1, M),
-        np.linspace(-1, 1, L),
-        np.linspace(zlims[0], zlims[1], N))
-    ct = np.cos(theta)
-    st = np.sin(theta)
-    ph = np.zeros((L, M, N))
-
-    # Put ellipses where they need to be
-    for ii in range(E.shape[0]):
-        xc, yc, zc = xs[ii], ys[ii], zs[ii]
-        a, b, c = xaxis[ii], yaxis[ii], zaxis[ii]
-        ct0, st0 = ct[ii], st[ii]
-
-        # Find indices falling inside the ellipsoid, ellipses only
-        # rotated in xy plane
-        idx = (
-                ((X - xc) * ct0 + (Y - yc) * st0) ** 2 / a ** 2 +
-                ((X - xc) * st0 - (Y - yc) * ct0) ** 2 / b ** 2 +
-                (Z - zc) ** 2 / c ** 2 <= 1)
-
-        # Add ellipses together
-        ph[idx] += gray[ii]
 
-    if ret_E:
-        return ph, E
-    return ph
+def _ct_geometry_3d(E: npt.ArrayLike) -> Tuple[npt.ArrayLike, ...]:
+    """Centers, axes, angles and gray values of the ellipsoids in E."""
+    return E[:, 4:7], E[:, 1:4], E[:, 7], E[:, :1]
 
 
 def ct_shepp_logan_params_2d() -> npt.ArrayLike:
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""Rasterization of ellipsoids shared by the CT and MR phantoms."""
+
+import math
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Sequence, Tuple
+
+import numpy as np
+import numpy.typing as npt
+
+
+def ellipse_extent(a: float, b: float, ct0: float, st0: float) -> Tuple[float, float]:
+    """Half-widths along x and y of an ellipse rotated by theta."""
+    return (np.sqrt((a * ct0) ** 2 + (b * st0) ** 2),
+            np.sqrt((a * st0) ** 2 + (b * ct0) ** 2))
+
+
+def bounding_slice(coords: npt.ArrayLike, center: float, extent: float) -> slice:
+    """Slice of the sorted grid coords covering [center - extent, center + extent].
+
+    The slice is padded by one sample on each side so rounding in the
+    membership test can never miss a point at the boundary.
+    """
+    start = np.searchsorted(coords, center - extent, side='left') - 1
+    stop = np.searchsorted(coords, center + extent, side='right') + 1
+    return slice(max(int(start), 0), min(int(stop), len(coords)))
+
+
+def check_zlims(zlims: Tuple[float, float]) -> None:
+    """Make sure zlims are appropriate."""
+    assert len(zlims) == 2, (
+        'zlims must be a tuple with 2 entries: upper and lower '
+        'bounds!')
+    assert zlims[0] <= zlims[1], (
+        'zlims: lower bound must be first entry!')
+
+
+def check_out_shape(outs: Sequence[npt.ArrayLike], shape: Tuple[int, int, int]) -> None:
+    """Make sure caller-provided outputs have the phantom shape."""
+    for out in outs:
+        if tuple(out.shape) != tuple(shape):
+            raise ValueError(
+                'out has shape %s, expected %s!' % (tuple(out.shape), tuple(shape)))
+
+
+def grid_coordinates(L: int, M: int, N: int,
+                     zlims: Tuple[float, float]) -> Tuple[npt.ArrayLike, npt.ArrayLike, npt.ArrayLike]:
+    """Sample positions of a (L, M, N) phantom along x (axis 1), y (axis 0) and z (axis 2)."""
+    return (np.linspace(-1, 1, M),
+            np.linspace(-1, 1, L),
+            np.linspace(zlims[0], zlims[1], N))
+
+
+def rasterize_ellipsoids(outs: Sequence[npt.ArrayLike],
+                         x: npt.ArrayLike, y: npt.ArrayLike, z: npt.ArrayLike,
+                         centers: npt.ArrayLike, axes: npt.ArrayLike,
+                         theta: npt.ArrayLike, values: npt.ArrayLike) -> None:
+    """Add ellipsoids into a block of a phantom.
+
+    Parameters
+    ----------
+    outs : sequence of array_like
+        Output arrays of shape (len(y), len(x), len(z)), added to in
+        place.  Any block of rows of a phantom can be rasterized by
+        passing the matching slice of y.
+    x, y, z : array_like
+        Sorted sample positions of the block along each axis.
+    centers : array_like
+        (e, 3) ellipsoid centers (x, y, z).
+    axes : array_like
+        (e, 3) principal axes (x, y, z) of the ellipsoids.
+    theta : array_like
+        (e,) rotation angles in the xy plane (in rad).
+    values : array_like
+        (e, len(outs)) value added to each output inside each
+        ellipsoid.
+
+    Notes
+    -----
+    Each ellipsoid is only evaluated over its bounding box, on sparse
+    grids.  Ellipsoids are added in order, so the result does not
+    depend on how the phantom is split into blocks.
+    """
+    ct = np.cos(theta)
+    st = np.sin(theta)
+
+    for ii in range(len(centers)):
+        xc, yc, zc = centers[ii]
+        a, b, c = axes[ii]
+        ct0, st0 = ct[ii], st[ii]
+
+        # Only evaluate the bounding box of the ellipsoid
+        xext, yext = ellipse_extent(a, b, ct0, st0)
+        sx = bounding_slice(x, xc, xext)
+        sy = bounding_slice(y, yc, yext)
+        sz = bounding_slice(z, zc, np.abs(c))
+        if sx.start >= sx.stop or sy.start >= sy.stop or sz.start >= sz.stop:
+            continue
+        X, Y, Z = np.meshgrid(  # meshgrid does X, Y backwards
+            x[sx], y[sy], z[sz], sparse=True)
+
+        # Find indices falling inside the ellipsoid, ellipses only
+        # rotated in xy plane
+        idx = (
+                ((X - xc) * ct0 + (Y - yc) * st0) ** 2 / a ** 2 +
+                ((X - xc) * st0 - (Y - yc) * ct0) ** 2 / b ** 2 +
+                (Z - zc) ** 2 / c ** 2 <= 1)
+
+        # Add ellipses together
+        for out, value in zip(outs, values[ii]):
+            out[sy, sx, sz][idx] += value
+
+
+def ellipsoid_slabs(shape: Tuple[int, int, int], zlims: Tuple[float, float],
+                    centers: npt.ArrayLike, axes: npt.ArrayLike,
+                    theta: npt.ArrayLike, values: npt.ArrayLike,
+                    slab_size: int) -> Iterator[Tuple[int, Tuple[npt.ArrayLike, ...]]]:
+    """Generate a phantom in slabs of slab_size rows along axis 0.
+
+    Yields
+    ------
+    start : int
+        Index of the first row of the slab.
+    slabs : tuple of array_like
+        One (rows, M, N) float64 slab per column of values.
+    """
+    L, M, N = shape
+    x, y, z = grid_coordinates(L, M, N, zlims)
+    for start in range(0, L, slab_size):
+        stop = min(start + slab_size, L)
+        slabs = tuple(np.zeros((stop - start, M, N)) for _ in range(values.shape[1]))
+        rasterize_ellipsoids(slabs, x, y[start:stop], z, centers, axes, theta, values)
+        yield start, slabs
+
+
+def aligned_slab_size(outs: Sequence[npt.ArrayLike], slab_size: int) -> int:
+    """Round slab_size up to a multiple of the axis 0 chunks of outs.
+
+    Chunked stores such as zarr write a partial chunk by reading,
+    modifying and writing back the whole chunk, so two threads writing
+    different rows of one chunk can lose each other's data.  Slabs
+    starting on chunk boundaries never share a chunk.
+    """
+    chunks = [getattr(out, 'chunks', None) for out in outs]
+    steps = [int(chunk[0]) for chunk in chunks
+             if chunk and isinstance(chunk[0], (int, np.integer))]
+    if not steps:
+        return slab_size
+    step = int(np.lcm.reduce(steps))
+    return step * math.ceil(slab_size / step)
+
+
+def rasterize_slabs(outs: Sequence[npt.ArrayLike], shape: Tuple[int, int, int],
+                    zlims: Tuple[float, float],
+                    centers: npt.ArrayLike, axes: npt.ArrayLike,
+                    theta: npt.ArrayLike, values: npt.ArrayLike,
+                    slab_size: int, num_threads: int = 1,
+                    in_place: bool = False) -> None:
+    """Rasterize a phantom into outputs slab by slab, optionally on a thread pool.
+
+    Parameters
+    ----------
+    outs : sequence of array_like
+        One (L, M, N) output per column of values, e.g. np.ndarray,
+        np.memmap or zarr arrays.
+    shape : tuple
+        The phantom shape (L, M, N).
+    zlims, centers, axes, theta, values :
+        See grid_coordinates() and rasterize_ellipsoids().
+    slab_size : int
+        Number of rows along axis 0 in each slab.  For chunked outputs
+        (e.g. zarr arrays) it is rounded up to a multiple of the chunk
+        size along axis 0 (see aligned_slab_size()).
+    num_threads : int, optional
+        Number of worker threads.  Each worker owns whole slabs, i.e.
+        disjoint rows of ndarray/memmap outputs and disjoint chunks of
+        chunked outputs, so no locking is needed.
+    in_place : bool, optional
+        Add directly into views of outs, which must be zero-filled
+        NumPy arrays.  Otherwise every slab is rasterized into a
+        temporary array and copied to outs, so at most num_threads
+        slabs are held in memory.
+
+    Notes
+    -----
+    The result is identical for any slab_size and num_threads.
+    """
+    L, M, N = shape
+    x, y, z = grid_coordinates(L, M, N, zlims)
+    slab_size = aligned_slab_size(outs, slab_size)
+
+    def rasterize_slab(start: int) -> None:
+        stop = min(start + slab_size, L)
+        if in_place:
+            slabs = tuple(out[start:stop] for out in outs)
+        else:
+            slabs = tuple(np.zeros((stop - start, M, N)) for _ in outs)
+        rasterize_ellipsoids(slabs, x, y[start:stop], z, centers, axes, theta, values)
+        if not in_place:
+            for out, slab in zip(outs, slabs):
+                out[start:stop] = slab
+
+    starts = range(0, L, slab_size)
+    if num_threads > 1:
+        with ThreadPoolExecutor(num_threads) as executor:
+            list(executor.map(rasterize_slab, starts))
+    else:
+        for start in starts:
+            rasterize_slab(start)
@@ -0,0 +1,42 @@
+"""Benchmark the thread-parallel Shepp-Logan rasterizer."""
+
+import os
+from time import perf_counter
+
+import numpy as np
+
+from phantominator import shepp_logan
+
+
+if __name__ == '__main__':
+
+    # Phantom sizes and thread counts to compare
+    sizes = [(128, 128, 128), (256, 256, 256), (512, 512, 512)]
+    threads = [1, 2, 4, 8]
+    repeats = 3
+    print('CPUs available: %d' % os.cpu_count())
+
+    for N in sizes:
+        serial = shepp_logan(N)
+        times = {}
+        for num_threads in threads:
+            best = np.inf
+            for _ in range(repeats):
+                t0 = perf_counter()
+                ph = shepp_logan(N, num_threads=num_threads)
+                best = min(best, perf_counter() - t0)
+
+            # Parallel output must match the serial output exactly
+            assert np.array_equal(ph, serial)
+            times[num_threads] = best
+
+        for num_threads in threads:
+            print('%s, %d thread(s): %.3f s (speedup %.2fx)' % (
+                N, num_threads, times[num_threads],
+                times[1]/times[num_threads]))
+
+        # MR maps are filled by the same rasterizer
+        t0 = perf_counter()
+        shepp_logan(N, MR=True, num_threads=threads[-1])
+        print('%s, MR with %d threads: %.3f s' % (
+            N, threads[-1], perf_counter() - t0))
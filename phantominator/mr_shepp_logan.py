@@ -1,17 +1,23 @@
 # -*- coding: utf-8 -*-
 """Shepp-Logan phantom for use with MR simulations."""
 
-from typing import Union, Optional, Tuple, Dict
+from typing import Union, Optional, Tuple, Dict, Iterator, Sequence
 
 import numpy as np
 import numpy.typing as npt
 
+from phantominator.ellipsoids import (
+    check_out_shape, check_zlims, ellipsoid_slabs, rasterize_slabs)
+
 
 def mr_shepp_logan(N: Union[int, npt.ArrayLike],
                    E: Optional[npt.ArrayLike] = None,
                    B0: float = 3.0,
                    T2star: bool = False,
-                   zlims: Tuple[float, float] = (-1, 1)) -> Tuple[npt.ArrayLike, npt.ArrayLike, npt.ArrayLike]:
+                   zlims: Tuple[float, float] = (-1, 1),
+                   out: Optional[Sequence[npt.ArrayLike]] = None,
+                   slab_size: int = 16,
+                   num_threads: int = 1) -> Tuple[npt.ArrayLike, npt.ArrayLike, npt.ArrayLike]:
     """Shepp-Logan phantom with MR tissue parameters.
 
     Parameters
@@ -47,6 +53,19 @@ def mr_shepp_logan(N: Union[int, npt.ArrayLike],
     zlims : tuple, optional
         Only for 3D.  Specify bounds along z.  Often we only want the
         middle portion of a 3D phantom, e.g., zlim=(-.5, .5).
+    out : tuple of array_like, optional
+        Three arrays of shape (L, M, N) to write M0, T1 and T2 to,
+        e.g., np.memmap or zarr arrays.  The phantom is then generated
+        in slabs along the first axis, so memory use is bounded by the
+        slab size rather than the volume.  Slabs of chunked outputs
+        such as zarr arrays are aligned to their chunks, so they can be
+        written by several threads.
+    slab_size : int, optional
+        Number of rows along the first axis generated at a time with
+        out or num_threads.
+    num_threads : int, optional
+        Rasterize slabs on a pool of num_threads threads.  The output
+        is identical to the serial one.
 
     Returns
     -------
@@ -82,23 +101,73 @@ def mr_shepp_logan(N: Union[int, npt.ArrayLike],
         L, M, N = N[:]
 
     # Make sure zlims are appropriate
-    assert len(zlims) == 2, (
-        'zlims must be a tuple with 2 entries: upper and lower '
-        'bounds!')
-    assert zlims[0] <= zlims[1], (
-        'zlims: lower bound must be first entry!')
+    check_zlims(zlims)
 
     # Get parameters from paper if None provided
     if E is None:
         E = mr_ellipsoid_parameters()
+    geometry = _mr_geometry(E, B0, T2star)
+
+    if out is not None:
+        # Stream slabs to the caller's arrays
+        check_out_shape(out, (L, M, N))
+        rasterize_slabs(out, (L, M, N), zlims, *geometry, slab_size, num_threads)
+        return tuple(out)
+
+    # Serially, the whole volume is one slab
+    M0s = np.zeros((L, M, N))
+    T1s = np.zeros((L, M, N))
+    T2s = np.zeros((L, M, N))
+    rasterize_slabs((M0s, T1s, T2s), (L, M, N), zlims, *geometry,
+                    slab_size if num_threads > 1 else max(L, 1),
+                    num_threads, in_place=True)
+
+    return M0s, T1s, T2s
+
+
+def mr_shepp_logan_slabs(N: Union[int, npt.ArrayLike],
+                         E: Optional[npt.ArrayLike] = None,
+                         B0: float = 3.0,
+                         T2star: bool = False,
+                         zlims: Tuple[float, float] = (-1, 1),
+                         slab_size: int = 16) -> Iterator[Tuple[int, Tuple[npt.ArrayLike, npt.ArrayLike, npt.ArrayLike]]]:
+    """Generate the MR Shepp-Logan phantom slab by slab.
+
+    Parameters
+    ----------
+    N : int or array_like
+        Matrix size, (N, N, N), or (L, M, N).
+    E, B0, T2star, zlims : optional
+        See mr_shepp_logan().
+    slab_size : int, optional
+        Number of rows along the first axis in each slab.
+
+    Yields
+    ------
+    start : int
+        Index along the first axis of the first row of the slab.
+    slabs : tuple of array_like
+        The M0, T1 and T2 rows start to start + slab_size (fewer for
+        the last slab).
+
+    Notes
+    -----
+    Concatenating the slabs gives mr_shepp_logan((L, M, N)) exactly,
+    while only one slab of each map is held in memory at a time.
+    """
+    L, M, N = (N, N, N) if np.isscalar(N) else N[:]
+    check_zlims(zlims)
+    if E is None:
+        E = mr_ellipsoid_parameters()
+    yield from ellipsoid_slabs(
+        (L, M, N), zlims, *_mr_geometry(E, B0, T2star), slab_size)
+
+
+def _mr_geometry(E: npt.ArrayLike, B0: float,
+                 T2star: bool) -> Tuple[npt.ArrayLike, ...]:
+    """Centers, axes, angles and (M0, T1, T2) values of the ellipsoids."""
 
     # Extract some parameters so we can use them
-    xs = E[:, 0]
-    ys = E[:, 1]
-    zs = E[:, 2]
-    xaxis = E[:, 3]
-    yaxis = E[:, 4]
-    zaxis = E[:, 5]
     theta = E[:, 6]
     M0 = E[:, 7]
     As = E[:, 8]
@@ -106,52 +175,30 @@ def mr_shepp_logan(N: Union[int, npt.ArrayLike],
     T1 = E[:, 10]
     T2 = E[:, 11]
     chis = E[:, 12]
-
-    # Initialize array
-    X, Y, Z = np.meshgrid(  # meshgrid does X, Y backwards
-        np.linspace(-1, 1, M),
-        np.linspace(-1, 1, L),
-        np.linspace(zlims[0], zlims[1], N))
-    ct = np.cos(theta)
-    st = np.sin(theta)
     sgn = np.sign(M0)
-    T1s = np.zeros((L, M, N))
-    T2s = np.zeros((L, M, N))
-    M0s = np.zeros((L, M, N))
 
-    # Put ellipses where they need to be
+    # Values added inside each ellipsoid -- subtract if M0 is negative
+    values = np.zeros((E.shape[0], 3))
     for ii in range(E.shape[0]):
-        xc, yc, zc = xs[ii], ys[ii], zs[ii]
-        a, b, c = xaxis[ii], yaxis[ii], zaxis[ii]
-        ct0, st0 = ct[ii], st[ii]
+        values[ii, 0] = M0[ii]
 
-        # Find indices falling inside the ellipsoid, ellipses only
-        # rotated in xy plane
-        idx = (
-            ((X - xc)*ct0 + (Y - yc)*st0)**2/a**2 +
-            ((X - xc)*st0 - (Y - yc)*ct0)**2/b**2 +
-            (Z - zc)**2/c**2 <= 1)
-
-        # Add ellipses together -- subtract of M0 is negative
-        M0s[idx] += M0[ii]
+        # Use T1 model if not given explicit T1 value
+        if np.isnan(T1[ii]):
+            values[ii, 1] = sgn[ii]*As[ii]*(B0**Cs[ii])
+        else:
+            values[ii, 1] = sgn[ii]*T1[ii]
 
         # Use T2star values if user asked for them
         if T2star:
             # We'll need the gyromagnetic ratio if returning T2star values
             # see https://en.wikipedia.org/wiki/Gyromagnetic_ratio:
             gamma0 = 267.52219  # 10^6 rad⋅s−1⋅T⋅−1
-            T2s[idx] += sgn[ii]/(1/T2[ii] + gamma0*np.abs(
+            values[ii, 2] = sgn[ii]/(1/T2[ii] + gamma0*np.abs(
                 B0*chis[ii]))
         else:
-            T2s[idx] += sgn[ii]*T2[ii]
+            values[ii, 2] = sgn[ii]*T2[ii]
 
-        # Use T1 model if not given explicit T1 value
-        if np.isnan(T1[ii]):
-            T1s[idx] += sgn[ii]*As[ii]*(B0**Cs[ii])
-        else:
-            T1s[idx] += sgn[ii]*T1[ii]
-
-    return M0s, T1s, T2s
+    return E[:, 0:3], E[:, 3:6], theta, values
 
 
 def mr_ellipsoid_parameters() -> npt.ArrayLike:
@@ -17,6 +17,10 @@ def shepp_logan(*args, **kwargs):
     -----
     See phantominator.mr_shepp_logan() and
     phantominator.ct_shepp_logan() for docstrings explaining usage.
+
+    3D phantoms can be rasterized on a thread pool with num_threads,
+    and streamed in slabs to memory-mapped arrays with out (see
+    examples/parallel_benchmark.py).
     """
 
     MR = kwargs.get('MR', False)
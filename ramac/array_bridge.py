@@ -0,0 +1,193 @@
+
+
+import ctypes
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import SimpleITK as sitk
+
+# SimpleITK scalar pixel types of NumPy dtypes
+_PIXEL_TYPES = {
+    np.dtype(np.uint8): sitk.sitkUInt8,
+    np.dtype(np.int8): sitk.sitkInt8,
+    np.dtype(np.uint16): sitk.sitkUInt16,
+    np.dtype(np.int16): sitk.sitkInt16,
+    np.dtype(np.uint32): sitk.sitkUInt32,
+    np.dtype(np.int32): sitk.sitkInt32,
+    np.dtype(np.uint64): sitk.sitkUInt64,
+    np.dtype(np.int64): sitk.sitkInt64,
+    np.dtype(np.float32): sitk.sitkFloat32,
+    np.dtype(np.float64): sitk.sitkFloat64,
+}
+
+# Number and size of the pixel buffer copies made through this module
+_copy_statistics = {'copies': 0, 'bytes': 0}
+_copy_lock = threading.Lock()
+
+
+def _count_copy(nbytes):
+    """
+    Record one pixel buffer copy of nbytes bytes.
+    """
+    with _copy_lock:
+        _copy_statistics['copies'] += 1
+        _copy_statistics['bytes'] += int(nbytes)
+
+
+def copy_statistics():
+    """
+    Return the number and total size of the pixel buffer copies made by array_copy and image_from_array.
+
+    Returns:
+        dict: 'copies' and 'bytes' since the last reset_copy_statistics.
+    """
+    with _copy_lock:
+        return dict(_copy_statistics)
+
+
+def reset_copy_statistics():
+    """
+    Reset the copy counters of copy_statistics.
+
+    Returns:
+        None
+    """
+    with _copy_lock:
+        _copy_statistics.update(copies=0, bytes=0)
+
+
+def pixel_type(dtype):
+    """
+    Return the SimpleITK scalar pixel type of a NumPy dtype.
+
+    Args:
+        dtype (numpy.dtype): The NumPy dtype.
+
+    Returns:
+        int: The SimpleITK pixel type, e.g. sitk.sitkFloat32.
+
+    Raises:
+        TypeError: If SimpleITK has no scalar pixel type for dtype.
+    """
+    try:
+        return _PIXEL_TYPES[np.dtype(dtype)]
+    except KeyError:
+        raise TypeError(f"No SimpleITK pixel type for dtype {np.dtype(dtype)}.") from None
+
+
+def array_view(image):
+    """
+    Read-only NumPy view (z, y, x) of the pixel buffer of an image, without copying.
+
+    The view is only valid while the image exists: keep a reference to the image while using it.
+
+    Args:
+        image (SimpleITK.Image): The image.
+
+    Returns:
+        numpy.ndarray: The read-only view.
+    """
+    return sitk.GetArrayViewFromImage(image)
+
+
+def array_copy(image):
+    """
+    NumPy copy (z, y, x) of the pixel buffer of an image, counted in copy_statistics.
+
+    Use it only when the array must outlive the image or be modified independently of it.
+
+    Args:
+        image (SimpleITK.Image): The image.
+
+    Returns:
+        numpy.ndarray: The copy.
+    """
+    array = sitk.GetArrayFromImage(image)
+    _count_copy(array.nbytes)
+    return array
+
+
+def new_image(shape, dtype, reference=None):
+    """
+    Allocate a zero-filled scalar image for a (z, y, x) array shape, to be filled through edit_image_array.
+
+    Filling a new image in place avoids building a NumPy array first and copying it into SimpleITK.
+
+    Args:
+        shape (tuple): The (z, y, x) (or (y, x)) shape of the pixel array.
+        dtype (numpy.dtype): The pixel dtype.
+        reference (SimpleITK.Image, optional): Image whose origin, spacing and direction are copied.
+            Defaults to None.
+
+    Returns:
+        SimpleITK.Image: The image.
+    """
+    image = sitk.Image([int(s) for s in shape[::-1]], pixel_type(dtype))
+    if reference is not None:
+        image.SetOrigin(reference.GetOrigin())
+        image.SetSpacing(reference.GetSpacing())
+        image.SetDirection(reference.GetDirection())
+    return image
+
+
+def image_from_array(array, spacing=None, origin=None, direction=None, reference=None):
+    """
+    Copy a (z, y, x) NumPy array into a new image, counted in copy_statistics.
+
+    SimpleITK cannot wrap a NumPy buffer, so this is always exactly one copy (non-contiguous arrays are
+    not made contiguous first). Prefer new_image and edit_image_array when the pixels can be computed in place.
+
+    Args:
+        array (numpy.ndarray): The pixel array.
+        spacing (tuple, optional): The spacing. Defaults to None (from reference, or 1).
+        origin (tuple, optional): The origin. Defaults to None (from reference, or 0).
+        direction (tuple, optional): The direction. Defaults to None (from reference, or identity).
+        reference (SimpleITK.Image, optional): Image whose geometry is copied. Defaults to None.
+
+    Returns:
+        SimpleITK.Image: The image.
+    """
+    image = sitk.GetImageFromArray(array)
+    _count_copy(np.asarray(array).nbytes)
+    if reference is not None:
+        image.SetOrigin(reference.GetOrigin())
+        image.SetSpacing(reference.GetSpacing())
+        image.SetDirection(reference.GetDirection())
+    if spacing is not None:
+        image.SetSpacing(spacing)
+    if origin is not None:
+        image.SetOrigin(origin)
+    if direction is not None:
+        image.SetDirection(direction)
+    return image
+
+
+@contextmanager
+def edit_image_array(image):
+    """
+    Context manager giving a writable NumPy view (z, y, x) of the pixel buffer of an image.
+
+    The image buffer is first made unique (SimpleITK shares buffers between copies of an image until one is
+    modified), so edits do not leak into other images. Do not copy the image, or keep the array, beyond the
+    with block.
+
+    Example:
+        with edit_image_array(image) as array:
+            array[array < -1000] = -1000
+
+    Args:
+        image (SimpleITK.Image): The image to edit in place.
+
+    Yields:
+        numpy.ndarray: The writable view.
+    """
+    image.MakeUnique()
+    view = sitk.GetArrayViewFromImage(image)
+    address = view.__array_interface__['data'][0]
+    buffer = (ctypes.c_char * view.nbytes).from_address(address)
+    array = np.frombuffer(buffer, dtype=view.dtype).reshape(view.shape)
+    try:
+        yield array
+    finally:
+        del array, buffer, view
@@ -42,6 +42,26 @@ def find_corresponding_lesions_timepoints(df1_file, df2_file, threshold):
     df1 = read_lesion_csv(df1_file)
     df2 = read_lesion_csv(df2_file)
 
+    return find_corresponding_lesions(df1, df2, threshold)
+
+
+def find_corresponding_lesions(df1, df2, threshold):
+    """
+    Find corresponding lesions between two lesion DataFrames.
+
+    This is the in-memory counterpart of find_corresponding_lesions_timepoints, for callers
+    that already hold the lesion tables (e.g. iterative refinement or streamed exports).
+
+    Parameters:
+        df1 (pandas.DataFrame): The first set of lesions or ROIs with 'x', 'y', 'z' and 'Index' columns.
+        df2 (pandas.DataFrame): The second set of lesions or ROIs with 'x', 'y', 'z' and 'Index' columns.
+        threshold (float): The threshold distance for considering lesions or ROIs as corresponding.
+
+    Returns:
+        Tuple[pandas.DataFrame, pandas.DataFrame, pandas.DataFrame]: 
+        A tuple containing correspondences DataFrame, unmatched indices DataFrame from the first set,
+        and unmatched indices DataFrame from the second set.
+    """
     # Initialize the correspondence data frame with 'F_I' and 'R_I' columns
     correspondences = pd.DataFrame(columns=['F_I', 'Fixed_Index', 'R_I', 'Reg_Index', 'Distance', 'Match_Status'])
 
@@ -143,7 +163,24 @@ def plot_lesion_correspondences_timepoints(df1_file, df2_file):
     # Plot the lesions and their correspondences
     fig = plt.figure(figsize=(10, 8))
     ax = fig.add_subplot(111, projection='3d')
+    draw_lesion_correspondences(ax, df1, df2, correspondences)
+    plt.title('Lesion Correspondences Between Radiologists')
+    plt.show()
+
+
+def draw_lesion_correspondences(ax, df1, df2, correspondences):
+    """
+    Draw two sets of lesions and their correspondences on an existing 3D axes.
+
+    Parameters:
+        ax (mpl_toolkits.mplot3d.Axes3D): The 3D axes to draw on.
+        df1 (pandas.DataFrame): The first set of lesions or ROIs with 'x', 'y', 'z' and 'Index' columns.
+        df2 (pandas.DataFrame): The second set of lesions or ROIs with 'x', 'y', 'z' and 'Index' columns.
+        correspondences (pandas.DataFrame): Correspondences from find_corresponding_lesions.
 
+    Returns:
+        None
+    """
     # Helper function to plot a check or cross
     def plot_check_or_cross(ax, mid_point, status):
         if status == 'matched':
@@ -182,8 +219,6 @@ def plot_lesion_correspondences_timepoints(df1_file, df2_file):
     ax.set_xlabel('X')
     ax.set_ylabel('Y')
     ax.set_zlabel('Z')
-    plt.title('Lesion Correspondences Between Radiologists')
-    plt.show()
 
 def create_final_dataframe_timepoints(correspondences, unmatched_names_df1, unmatched_names_df2, df1_file, df2_file):
     """
@@ -0,0 +1,171 @@
+
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from dicom_io import read_dicom_header, get_dicom_tag
+
+# DICOM tags stored in the catalog, by column name
+CATALOG_TAGS = {
+    'PatientID': '0010|0020',
+    'StudyDate': '0008|0020',
+    'StudyInstanceUID': '0020|000d',
+    'SeriesInstanceUID': '0020|000e',
+    'SeriesDescription': '0008|103e',
+    'Modality': '0008|0060',
+}
+
+
+def _index_dicom_file(file_name):
+    """
+    Read the catalog columns of one file from its header. Files that are not readable images get empty tags.
+    """
+    stat = os.stat(file_name)
+    row = {'File': file_name, 'MTime': stat.st_mtime_ns, 'FileSize': stat.st_size}
+    row.update({column: '' for column in CATALOG_TAGS})
+    try:
+        header = read_dicom_header(file_name)
+    except RuntimeError:
+        return row
+
+    row.update({column: get_dicom_tag(header, tag) for column, tag in CATALOG_TAGS.items()})
+    row['Columns'], row['Rows'] = header.GetSize()[:2]
+    row['Spacing_x'], row['Spacing_y'] = header.GetSpacing()[:2]
+    row['Position_x'], row['Position_y'], row['Position_z'] = header.GetOrigin()[:3]
+    direction = np.array(header.GetDirection()).reshape(3, 3)
+    row['SlicePosition'] = float(np.dot(header.GetOrigin(), direction[:, 2]))
+    return row
+
+
+def index_dicom_files(root, catalog_file=None, num_threads=8):
+    """
+    Index the headers of all files below a cohort directory.
+
+    Only DICOM headers are read, in parallel, never the pixel data. When catalog_file exists, files whose
+    modification time and size are unchanged are taken from it, so re-indexing a growing cohort only reads
+    the new or modified files. The updated file index is written back to catalog_file.
+
+    Args:
+        root (str): The cohort directory to walk.
+        catalog_file (str, optional): CSV file holding the file index between runs. Defaults to None.
+        num_threads (int, optional): Number of header-reading threads. Defaults to 8.
+
+    Returns:
+        pandas.DataFrame: One row per file, with the catalog tags, geometry and file modification time and size.
+    """
+    file_names = sorted(os.path.join(directory, name) for directory, _, names in os.walk(root) for name in names)
+    if catalog_file is not None:
+        file_names = [name for name in file_names if os.path.abspath(name) != os.path.abspath(catalog_file)]
+
+    previous = None
+    if catalog_file is not None and os.path.exists(catalog_file):
+        previous = pd.read_csv(catalog_file, dtype={column: str for column in CATALOG_TAGS})
+        previous[list(CATALOG_TAGS)] = previous[list(CATALOG_TAGS)].fillna('')
+
+    # Reuse the rows of files that did not change since the previous run
+    reused, to_read = [], file_names
+    if previous is not None:
+        stats = {name: os.stat(name) for name in file_names}
+        current = pd.DataFrame({'File': file_names,
+                                'MTime': [stats[name].st_mtime_ns for name in file_names],
+                                'FileSize': [stats[name].st_size for name in file_names]})
+        reused = previous.merge(current, on=['File', 'MTime', 'FileSize'])
+        to_read = sorted(set(file_names) - set(reused['File']))
+        reused = reused.to_dict('records')
+
+    with ThreadPoolExecutor(num_threads) as executor:
+        rows = reused + list(executor.map(_index_dicom_file, to_read))
+
+    file_index = pd.DataFrame(rows, columns=['File', 'MTime', 'FileSize'] + list(CATALOG_TAGS) +
+                              ['Columns', 'Rows', 'Spacing_x', 'Spacing_y',
+                               'Position_x', 'Position_y', 'Position_z', 'SlicePosition'])
+    file_index = file_index.sort_values('File', ignore_index=True)
+
+    if catalog_file is not None:
+        file_index.to_csv(catalog_file, index=False)
+
+    return file_index
+
+
+def summarize_dicom_series(file_index):
+    """
+    Group a file index into one row per DICOM series.
+
+    Args:
+        file_index (pandas.DataFrame): The file index returned by index_dicom_files.
+
+    Returns:
+        pandas.DataFrame: One row per series, indexed by SeriesInstanceUID, with patient, study date,
+        timepoint (0 for the first study date of a patient, 1 for the next, ...), series description,
+        modality, geometry, directory and the list of files sorted by slice position.
+    """
+    images = file_index[file_index['SeriesInstanceUID'].astype(str) != '']
+    images = images.sort_values(['SeriesInstanceUID', 'SlicePosition'])
+
+    catalog = images.groupby('SeriesInstanceUID', sort=False).agg(
+        PatientID=('PatientID', 'first'),
+        StudyDate=('StudyDate', 'first'),
+        StudyInstanceUID=('StudyInstanceUID', 'first'),
+        SeriesDescription=('SeriesDescription', 'first'),
+        Modality=('Modality', 'first'),
+        Columns=('Columns', 'first'),
+        Rows=('Rows', 'first'),
+        NumberOfSlices=('File', 'size'),
+        Spacing_x=('Spacing_x', 'first'),
+        Spacing_y=('Spacing_y', 'first'),
+        FirstSlicePosition=('SlicePosition', 'min'),
+        LastSlicePosition=('SlicePosition', 'max'),
+        Files=('File', list),
+    )
+    catalog['SliceSpacing'] = ((catalog['LastSlicePosition'] - catalog['FirstSlicePosition']) /
+                               (catalog['NumberOfSlices'] - 1).clip(lower=1))
+    catalog['Directory'] = [os.path.commonpath(files) if len(files) > 1 else os.path.dirname(files[0])
+                            for files in catalog['Files']]
+    catalog['Timepoint'] = catalog.groupby('PatientID')['StudyDate'].rank(method='dense').astype(int) - 1
+
+    return catalog.sort_values(['PatientID', 'Timepoint', 'SeriesDescription'])
+
+
+def build_dicom_catalog(root, catalog_file=None, num_threads=8):
+    """
+    Build the series catalog of a cohort directory from DICOM headers only.
+
+    Args:
+        root (str): The cohort directory to walk.
+        catalog_file (str, optional): CSV file holding the file index for incremental re-indexing. Defaults to None.
+        num_threads (int, optional): Number of header-reading threads. Defaults to 8.
+
+    Returns:
+        pandas.DataFrame: The series catalog returned by summarize_dicom_series.
+    """
+    return summarize_dicom_series(index_dicom_files(root, catalog_file, num_threads))
+
+
+def query_dicom_catalog(catalog, patient_id=None, timepoint=None, description=None, modality=None):
+    """
+    Select series from a catalog.
+
+    Args:
+        catalog (pandas.DataFrame): The series catalog returned by build_dicom_catalog.
+        patient_id (str, optional): Keep only this patient. Defaults to None.
+        timepoint (int, optional): Keep only this timepoint. Defaults to None.
+        description (str, optional): Regular expression searched (case-insensitive) in the series
+            description, e.g. 'venous'. Defaults to None.
+        modality (str, optional): Keep only this modality, e.g. 'CT'. Defaults to None.
+
+    Returns:
+        pandas.DataFrame: The matching rows of the catalog.
+    """
+    selected = np.ones(len(catalog), dtype=bool)
+    if patient_id is not None:
+        selected &= catalog['PatientID'] == str(patient_id)
+    if timepoint is not None:
+        selected &= catalog['Timepoint'] == timepoint
+    if description is not None:
+        selected &= catalog['SeriesDescription'].str.contains(description, case=False, regex=True)
+    if modality is not None:
+        selected &= catalog['Modality'] == modality
+    return catalog[selected]
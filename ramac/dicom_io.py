@@ -0,0 +1,485 @@
+
+
+import glob
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import SimpleITK as sitk
+
+from utils import index_to_physical, physical_to_index
+from array_bridge import new_image, edit_image_array, array_copy
+from synthetic_dicom import write_dicom_series
+
+
+def read_dicom_header(file_name):
+    """
+    Read the header of a DICOM file without decoding its pixel data.
+
+    Args:
+        file_name (str): The path to the DICOM file.
+
+    Returns:
+        SimpleITK.ImageFileReader: The reader, with image information and meta-data loaded.
+    """
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(file_name)
+    reader.ReadImageInformation()
+    return reader
+
+
+def get_dicom_tag(reader, tag, default=''):
+    """
+    Return the stripped value of a DICOM tag read by read_dicom_header.
+
+    Args:
+        reader (SimpleITK.ImageFileReader): The reader returned by read_dicom_header.
+        tag (str): The DICOM tag in 'gggg|eeee' format, e.g. '0020|000e' for SeriesInstanceUID.
+        default (str, optional): Value returned when the tag is absent. Defaults to ''.
+
+    Returns:
+        str: The tag value.
+    """
+    if reader.HasMetaDataKey(tag):
+        return reader.GetMetaData(tag).strip()
+    return default
+
+
+def dicom_files_fingerprint(file_names):
+    """
+    Fingerprint a list of files from their names, modification times and sizes.
+
+    Args:
+        file_names (list): The paths to the files.
+
+    Returns:
+        str: A hexadecimal digest that changes whenever a file is added, removed or modified.
+    """
+    digest = hashlib.sha1()
+    for file_name in file_names:
+        stat = os.stat(file_name)
+        digest.update(f"{os.path.abspath(file_name)}|{stat.st_mtime_ns}|{stat.st_size}\n".encode())
+    return digest.hexdigest()
+
+
+def read_dicom_files(file_names):
+    """
+    Read a sorted list of DICOM slice files into one volume with the GDCM series reader.
+
+    Args:
+        file_names (list): The paths to the DICOM files, sorted along the slice direction.
+
+    Returns:
+        SimpleITK.Image: The volume in its stored pixel type.
+    """
+    reader = sitk.ImageSeriesReader()
+    reader.SetFileNames(file_names)
+    return reader.Execute()
+
+
+def sort_dicom_files(file_names, headers):
+    """
+    Sort DICOM slice files by their position along the slice normal.
+
+    Args:
+        file_names (list): The paths to the DICOM files.
+        headers (list): The readers returned by read_dicom_header for each file.
+
+    Returns:
+        tuple: The sorted file names and the headers in the same order.
+    """
+    direction = np.array(headers[0].GetDirection()).reshape(3, 3)
+    positions = np.array([header.GetOrigin() for header in headers]) @ direction[:, 2]
+    order = np.argsort(positions, kind='stable')
+    return [file_names[i] for i in order], [headers[i] for i in order]
+
+
+def read_dicom_files_parallel(file_names, num_threads=None):
+    """
+    Read DICOM slice files into one volume, decoding the slices concurrently.
+
+    Headers are read first to sort the slices by position. The slices are then decoded in a thread pool
+    directly into the pixel buffer of the output image (no intermediate NumPy volume), and the geometry is set as the GDCM series reader does:
+    origin and direction of the first slice, and slice spacing from the distance between the first and
+    last slices. The result is identical to read_dicom_files. This helps most on compressed (JPEG2000,
+    JPEG-LS) series, where decoding rather than reading dominates.
+
+    Args:
+        file_names (list): The paths to the DICOM files.
+        num_threads (int, optional): Number of decoding threads. Defaults to the number of CPUs.
+
+    Returns:
+        SimpleITK.Image: The volume in its stored pixel type.
+    """
+    with ThreadPoolExecutor(num_threads) as executor:
+        headers = list(executor.map(read_dicom_header, file_names))
+        file_names, headers = sort_dicom_files(file_names, headers)
+
+        # Decode the first slice to learn the pixel type, then allocate the whole volume as the output image
+        first_slice = sitk.ReadImage(file_names[0])
+        first_array = sitk.GetArrayViewFromImage(first_slice)
+        image = new_image((len(file_names),) + first_array.shape[-2:], first_array.dtype)
+
+        with edit_image_array(image) as volume:
+            volume[0] = first_array.reshape(volume.shape[1:])
+
+            def decode(k):
+                # Keep a reference to the slice image while its buffer is viewed
+                slice_image = sitk.ReadImage(file_names[k])
+                volume[k] = sitk.GetArrayViewFromImage(slice_image).reshape(volume.shape[1:])
+
+            list(executor.map(decode, range(1, len(file_names))))
+
+    first, last = np.array(headers[0].GetOrigin()), np.array(headers[-1].GetOrigin())
+    spacing = list(headers[0].GetSpacing())
+    if len(file_names) > 1:
+        spacing[2] = np.linalg.norm(last - first) / (len(file_names) - 1)
+
+    image.SetOrigin(headers[0].GetOrigin())
+    image.SetSpacing(spacing)
+    image.SetDirection(headers[0].GetDirection())
+
+    return image
+
+
+def benchmark_dicom_loading(directory=None, num_slices=200, slice_shape=(512, 512), num_threads=(1, 2, 4, 8),
+                            repeats=3):
+    """
+    Compare the sequential GDCM series reader with the parallel slice decoder.
+
+    Args:
+        directory (str, optional): A DICOM series to benchmark. Defaults to None, in which case a synthetic
+            series of num_slices random slices is written to a temporary directory.
+        num_slices (int, optional): Number of slices of the synthetic series. Defaults to 200.
+        slice_shape (tuple, optional): (rows, columns) of the synthetic slices. Defaults to (512, 512).
+        num_threads (tuple, optional): Thread counts to benchmark. Defaults to (1, 2, 4, 8).
+        repeats (int, optional): Number of timed loads per configuration; the best is kept. Defaults to 3.
+
+    Returns:
+        dict: Best load time in seconds per configuration ('sequential' and the thread counts).
+
+    Raises:
+        AssertionError: If the parallel loader output differs from the sequential loader.
+    """
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        if directory is None:
+            directory = temporary_directory
+            volume = np.random.default_rng(0).integers(-1024, 3000, (num_slices,) + tuple(slice_shape), dtype=np.int16)
+            image = sitk.GetImageFromArray(volume)
+            image.SetSpacing((0.7, 0.7, 2.5))
+            write_dicom_series(image, directory)
+
+        file_names = sitk.ImageSeriesReader.GetGDCMSeriesFileNames(directory)
+
+        def best_time(load):
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                image = load()
+                times.append(time.perf_counter() - start)
+            return min(times), image
+
+        timings = {}
+        timings['sequential'], reference = best_time(lambda: read_dicom_files(file_names))
+        for threads in num_threads:
+            timings[threads], image = best_time(lambda: read_dicom_files_parallel(file_names, threads))
+            assert np.array_equal(sitk.GetArrayViewFromImage(image), sitk.GetArrayViewFromImage(reference))
+            assert image.GetOrigin() == reference.GetOrigin() and image.GetDirection() == reference.GetDirection()
+            assert np.allclose(image.GetSpacing(), reference.GetSpacing())
+
+    for configuration, seconds in timings.items():
+        print(f"{configuration!s:>10} : {seconds:.3f} s")
+
+    return timings
+
+
+def dicom_cache_file(directory_or_files, cache_dir):
+    """
+    Path of the cache entry of a DICOM series in a volume cache.
+
+    Derived data of the series (e.g. body masks) can be cached next to it under the same name with a suffix;
+    such files are dropped together with the volume when the series changes.
+
+    Args:
+        directory_or_files (str or list): The DICOM series directory, or its sorted file names.
+        cache_dir (str): The path to the cache directory.
+
+    Returns:
+        str: The path to the cache file, '<SeriesInstanceUID>_<fingerprint>.nrrd'.
+    """
+    if isinstance(directory_or_files, str):
+        directory_or_files = sitk.ImageSeriesReader.GetGDCMSeriesFileNames(directory_or_files)
+    series_uid = get_dicom_tag(read_dicom_header(directory_or_files[0]), '0020|000e', default='unknown')
+    fingerprint = dicom_files_fingerprint(directory_or_files)
+    return os.path.join(cache_dir, f"{series_uid}_{fingerprint[:16]}.nrrd")
+
+
+def temporary_cache_file(cache_file, suffix='.tmp.nrrd'):
+    """
+    Create a uniquely named empty file next to a cache entry, to be written and then moved into place with
+    os.replace, so that an interrupted write never leaves a corrupt entry and concurrent writers (threads
+    or processes) never share a temporary file.
+
+    Args:
+        cache_file (str): The path to the cache entry.
+        suffix (str, optional): The suffix of the temporary file. Stale-entry cleanup skips files ending in
+            '.tmp.nrrd' or '.tmp.json'. Defaults to '.tmp.nrrd'.
+
+    Returns:
+        str: The path to the temporary file.
+    """
+    directory, name = os.path.split(os.path.abspath(cache_file))
+    handle, temporary_file = tempfile.mkstemp(suffix=suffix, prefix=os.path.splitext(name)[0] + '.',
+                                              dir=directory)
+    os.close(handle)
+    return temporary_file
+
+
+def write_cache_image(image, cache_file, **kwargs):
+    """
+    Write an image to a cache entry atomically, through a temporary file (see temporary_cache_file).
+
+    Args:
+        image (SimpleITK.Image): The image.
+        cache_file (str): The path to the cache entry.
+        **kwargs: Options of SimpleITK.WriteImage (e.g. compressionLevel); the image is always compressed.
+
+    Returns:
+        None
+    """
+    temporary_file = temporary_cache_file(cache_file)
+    try:
+        sitk.WriteImage(image, temporary_file, useCompression=True, **kwargs)
+        os.replace(temporary_file, cache_file)
+    except BaseException:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+        raise
+
+
+def load_cached_dicom_series(directory, cache_dir, num_threads=None):
+    """
+    Load a DICOM series through a persistent volume cache.
+
+    The decoded volume is stored once as a compressed NRRD file (which keeps origin, spacing and direction)
+    in cache_dir, keyed by the SeriesInstanceUID and a fingerprint of the file list (names, modification
+    times and sizes). Later loads read the single cache file instead of parsing and decoding every slice.
+    A stale cache entry of the same series is replaced when its files change.
+
+    Args:
+        directory (str): The path to the directory containing the DICOM series.
+        cache_dir (str): The path to the cache directory. It is created if it does not exist.
+        num_threads (int, optional): Decode the series with read_dicom_files_parallel using this many threads
+            on a cache miss. Defaults to None (sequential GDCM series reader).
+
+    Returns:
+        SimpleITK.Image: The loaded DICOM series in its stored pixel type.
+    """
+    dicom_names = sitk.ImageSeriesReader.GetGDCMSeriesFileNames(directory)
+    cache_file = dicom_cache_file(dicom_names, cache_dir)
+    series_uid = os.path.basename(cache_file).rsplit('_', 1)[0]
+    if os.path.exists(cache_file):
+        return sitk.ReadImage(cache_file)
+
+    if num_threads is None:
+        image = read_dicom_files(dicom_names)
+    else:
+        image = read_dicom_files_parallel(dicom_names, num_threads)
+
+    # Drop entries (and derived files) of the same series that were built from an older file list, but not
+    # the temporary files of writes in progress
+    os.makedirs(cache_dir, exist_ok=True)
+    for pattern in ('_*.nrrd', '_*.json'):
+        for stale_file in glob.glob(os.path.join(cache_dir, glob.escape(series_uid) + pattern)):
+            if not stale_file.endswith(('.tmp.nrrd', '.tmp.json')):
+                try:
+                    os.remove(stale_file)
+                except FileNotFoundError:
+                    pass
+
+    write_cache_image(image, cache_file, compressionLevel=1)
+
+    return image
+
+
+class LazyDicomSeries:
+    """
+    Lazy handle on a DICOM series that decodes only the slices a request needs.
+
+    The geometry is read from the headers when the handle is created, so the handle answers GetSize,
+    GetOrigin, GetSpacing and GetDirection like a SimpleITK image, and can be passed to the coordinate
+    conversions of ramac.utils. Pixel data are decoded on request (as float32, like load_dicom_series)
+    and kept in a bounded LRU cache of slices.
+
+    Args:
+        directory_or_files (str or list): The directory of the series, or its DICOM files.
+        cache_size (int, optional): Maximum number of decoded slices kept in memory. Defaults to 64.
+        num_threads (int, optional): Number of threads decoding the slices of a request. Defaults to None
+            (number of CPUs).
+    """
+
+    def __init__(self, directory_or_files, cache_size=64, num_threads=None):
+        if isinstance(directory_or_files, str):
+            file_names = list(sitk.ImageSeriesReader.GetGDCMSeriesFileNames(directory_or_files))
+        else:
+            file_names = list(directory_or_files)
+
+        self.num_threads = num_threads
+        with ThreadPoolExecutor(num_threads) as executor:
+            headers = list(executor.map(read_dicom_header, file_names))
+        self.file_names, headers = sort_dicom_files(file_names, headers)
+
+        # Same geometry as the GDCM series reader
+        self._origin = headers[0].GetOrigin()
+        self._direction = headers[0].GetDirection()
+        spacing = list(headers[0].GetSpacing())
+        if len(headers) > 1:
+            spacing[2] = np.linalg.norm(np.array(headers[-1].GetOrigin()) - np.array(headers[0].GetOrigin())) / \
+                (len(headers) - 1)
+        self._spacing = tuple(spacing)
+        self._size = tuple(headers[0].GetSize()[:2]) + (len(headers),)
+
+        self.cache_size = cache_size
+        self._slices = OrderedDict()
+        self._lock = threading.Lock()
+
+    def GetDimension(self):
+        return 3
+
+    def GetSize(self):
+        return self._size
+
+    def GetOrigin(self):
+        return self._origin
+
+    def GetSpacing(self):
+        return self._spacing
+
+    def GetDirection(self):
+        return self._direction
+
+    def _decode(self, k):
+        slice_image = sitk.ReadImage(self.file_names[k], sitk.sitkFloat32)
+        return array_copy(slice_image).reshape(self._size[1], self._size[0])
+
+    def get_slices(self, slice_indices):
+        """
+        Return decoded slices, decoding (in parallel) only those not in the cache.
+
+        Requests of more distinct slices than cache_size (e.g. whole volumes) bypass the cache, which they
+        would otherwise flush.
+
+        Args:
+            slice_indices (list): Slice (z) indices.
+
+        Returns:
+            np.ndarray: Array of shape (len(slice_indices), rows, columns).
+        """
+        slice_indices = [int(k) for k in slice_indices]
+        # Keep references to the cached slices, which other threads may evict meanwhile
+        with self._lock:
+            found = {k: self._slices[k] for k in set(slice_indices) if k in self._slices}
+        missing = sorted(set(slice_indices) - set(found))
+
+        with ThreadPoolExecutor(self.num_threads) as executor:
+            found.update(zip(missing, executor.map(self._decode, missing)))
+
+        slices = [found[k] for k in slice_indices]
+        if len(found) <= self.cache_size:
+            with self._lock:
+                for k in slice_indices:
+                    self._slices[k] = found[k]
+                    self._slices.move_to_end(k)
+                while len(self._slices) > self.cache_size:
+                    self._slices.popitem(last=False)
+
+        return np.stack(slices) if slices else np.empty((0, self._size[1], self._size[0]), dtype=np.float32)
+
+    def read_region(self, index, size):
+        """
+        Read a box of voxels as a SimpleITK image with the geometry of the series.
+
+        Args:
+            index (tuple): First voxel (x, y, z) of the box. The box is clipped to the series.
+            size (tuple): Size (x, y, z) of the box in voxels.
+
+        Returns:
+            SimpleITK.Image: The region, with pixel type sitkFloat32.
+        """
+        start = np.clip(np.asarray(index, dtype=int), 0, self._size)
+        stop = np.clip(np.asarray(index, dtype=int) + np.asarray(size, dtype=int), 0, self._size)
+
+        array = self.get_slices(range(start[2], stop[2]))[:, start[1]:stop[1], start[0]:stop[0]]
+
+        # Copy the (non-contiguous) box once, directly into the region image
+        region = new_image(array.shape, np.float32)
+        with edit_image_array(region) as region_array:
+            region_array[...] = array
+        region.SetOrigin(index_to_physical(self, start)[0].tolist())
+        region.SetSpacing(self._spacing)
+        region.SetDirection(self._direction)
+        return region
+
+    def read_slab(self, z_start, z_stop):
+        """
+        Read the full slices z_start to z_stop (exclusive).
+
+        Returns:
+            SimpleITK.Image: The slab, with pixel type sitkFloat32.
+        """
+        return self.read_region((0, 0, z_start), (self._size[0], self._size[1], z_stop - z_start))
+
+    def read_box(self, center, half_size):
+        """
+        Read a box centred on a physical point, e.g. a lesion centroid.
+
+        Args:
+            center (tuple): Physical coordinates (x, y, z) of the centre of the box.
+            half_size (float or tuple): Half size of the box in physical units (mm), per axis or for all axes.
+
+        Returns:
+            SimpleITK.Image: The box, with pixel type sitkFloat32.
+        """
+        center_index = physical_to_index(self, center)[0]
+        half_voxels = np.ceil(np.broadcast_to(half_size, 3) / np.array(self._spacing)).astype(int)
+        return self.read_region(center_index - half_voxels, 2 * half_voxels + 1)
+
+    def read_triplanar(self, index, half_extent=16):
+        """
+        Read the axial, coronal and sagittal slices through a voxel.
+
+        Coronal and sagittal slices cross every slice of the series, so half_extent restricts them to the
+        slices within half_extent of the voxel, which is what lesion views need.
+
+        Args:
+            index (tuple): Voxel index (x, y, z).
+            half_extent (int, optional): Number of slices kept on each side of the voxel for the coronal and
+                sagittal views. Defaults to 16. None reads all slices, which are then not cached if the
+                series has more than cache_size slices.
+
+        Returns:
+            tuple: The axial (rows, columns), coronal (slices, columns) and sagittal (slices, rows) arrays, and
+            the first slice index of the coronal and sagittal views.
+        """
+        x, y, z = (int(i) for i in index)
+        if half_extent is None:
+            z_start, z_stop = 0, self._size[2]
+        else:
+            z_start, z_stop = max(z - half_extent, 0), min(z + half_extent + 1, self._size[2])
+
+        slab = self.get_slices(range(z_start, z_stop))
+        return slab[z - z_start], slab[:, y, :], slab[:, :, x], z_start
+
+    def read_volume(self):
+        """
+        Read the whole series.
+
+        Returns:
+            SimpleITK.Image: The volume, with pixel type sitkFloat32.
+        """
+        return self.read_slab(0, self._size[2])
@@ -2,27 +2,38 @@
 
 from phantominator import shepp_logan
 from utils import *
+from transform_coordinates import transform_points
+from transform_chain import collapse_transform_chain, apply_transform_chain
+from dicom_io import read_dicom_files, read_dicom_files_parallel, load_cached_dicom_series
 
 
 import SimpleITK as sitk
 import numpy as np
 
 
-def load_dicom_series(directory):
+def load_dicom_series(directory, cache_dir=None, num_threads=None):
     """
     Loads a DICOM series from the specified directory and converts it to a 32-bit floating-point type.
 
     Args:
         directory (str): The path to the directory containing the DICOM series.
+        cache_dir (str, optional): Directory of a persistent volume cache. When given, the decoded series is
+            stored there on the first load and read back from it on later loads. Defaults to None (no cache).
+        num_threads (int, optional): Decode the slices concurrently with this many threads. Defaults to None
+            (sequential GDCM series reader).
 
     Returns:
         SimpleITK.Image: The loaded DICOM series as a SimpleITK image with pixel type sitkFloat32.
     """
-    reader = sitk.ImageSeriesReader()
-    dicom_names = reader.GetGDCMSeriesFileNames(directory)
-    reader.SetFileNames(dicom_names)
-    # Execute the reader to load the DICOM series
-    image = reader.Execute()
+    if cache_dir is not None:
+        image = load_cached_dicom_series(directory, cache_dir, num_threads)
+    else:
+        dicom_names = sitk.ImageSeriesReader.GetGDCMSeriesFileNames(directory)
+        # Execute the reader to load the DICOM series
+        if num_threads is None:
+            image = read_dicom_files(dicom_names)
+        else:
+            image = read_dicom_files_parallel(dicom_names, num_threads)
     # Convert the loaded image to a 32-bit floating-point type
     image = sitk.Cast(image, sitk.sitkFloat32)
     return image
@@ -148,14 +159,14 @@ def transform_phantom(phantom, lesions, rotation_params, translation_params):
     
     
     # Apply transformation to lesions to obtain the moving coordinates
-    transformed_lesions = [composite_transform.TransformPoint(p) for p in lesions]
+    transformed_lesions = [tuple(p) for p in transform_points(composite_transform, lesions).tolist()]
     
     
-    # Apply transformation to lesions for visualization
+    # Apply transformation to lesions for visualization, rotation first and then translation
     rotation_1, translation_1 = generate_visualization_composite_transform(rotation_params, translation_params)
+    visualization_chain = collapse_transform_chain([rotation_1, translation_1])
     
-    transformed_lesions_1 = [rotation_1.TransformPoint(p) for p in lesions]
-    transformed_lesions_1 = [translation_1.TransformPoint(p) for p in transformed_lesions_1]
+    transformed_lesions_1 = [tuple(p) for p in apply_transform_chain(visualization_chain, lesions).tolist()]
     
     return transformed_phantom, transformed_lesions, transformed_lesions_1, transformed_phantom_1
 
@@ -0,0 +1,117 @@
+
+
+import pandas as pd
+
+# Columns identifying a case in an annotation export, and the lesion columns handed to the correspondence stage
+EXPORT_CASE_COLUMNS = ('PatientID', 'Timepoint', 'Reader')
+LESION_COLUMNS = ['x', 'y', 'z', 'Index']
+
+
+def _lesion_table(rows, coordinate_columns, index_column):
+    """
+    Convert the export rows of one case to the lesion layout of read_lesion_csv ('x', 'y', 'z', 'Index').
+    """
+    df = rows[list(coordinate_columns) + [index_column]]
+    df.columns = LESION_COLUMNS
+    return df.reset_index(drop=True)
+
+
+def iter_lesion_export(export_file, case_columns=EXPORT_CASE_COLUMNS, coordinate_columns=('x', 'y', 'z'),
+                       index_column='Index', chunksize=100000, assume_sorted=True):
+    """
+    Stream a multi-patient annotation export case by case.
+
+    The export is read in chunks of rows and only the case and lesion columns are parsed. When the export is
+    sorted (or at least grouped) by case, a case is yielded as soon as the next case starts, so memory holds a
+    single chunk plus the rows of the case that straddles it, whatever the size of the export. Otherwise the
+    lesion rows are collected per case and the cases are yielded once the whole export is read.
+
+    Parameters:
+        export_file (str or file-like): The path to the export CSV file.
+        case_columns (tuple, optional): Columns identifying a case. Defaults to ('PatientID', 'Timepoint', 'Reader').
+        coordinate_columns (tuple, optional): Columns of the x, y and z lesion coordinates. Defaults to ('x', 'y', 'z').
+        index_column (str, optional): Column of the lesion index. Defaults to 'Index'.
+        chunksize (int, optional): Number of rows read at a time. Defaults to 100000.
+        assume_sorted (bool, optional): Whether the rows of each case are contiguous. Defaults to True.
+
+    Yields:
+        tuple: The case key (values of case_columns, as strings; empty cells, e.g. a blank 'Reader', are read
+        as '') and a DataFrame of its lesions with
+        'x', 'y', 'z' and 'Index' columns, as returned by read_lesion_csv.
+
+    Raises:
+        ValueError: If assume_sorted is True and the rows of a case are not contiguous.
+    """
+    case_columns = list(case_columns)
+    usecols = case_columns + list(coordinate_columns) + [index_column]
+    dtype = {column: str for column in case_columns + [index_column]}
+
+    # Empty case cells are read as '' rather than NaN, which groupby would drop and which never equals itself
+    chunks = (chunk.fillna({column: '' for column in case_columns})
+              for chunk in pd.read_csv(export_file, usecols=usecols, dtype=dtype, chunksize=chunksize))
+
+    if not assume_sorted:
+        cases = {}
+        for chunk in chunks:
+            for key, rows in chunk.groupby(case_columns, sort=False):
+                cases.setdefault(key, []).append(_lesion_table(rows, coordinate_columns, index_column))
+        for key, parts in cases.items():
+            yield key, pd.concat(parts, ignore_index=True)
+        return
+
+    seen = set()
+    carry = None
+    for chunk in chunks:
+        if carry is not None:
+            chunk = pd.concat([carry, chunk])
+
+        # The last case of the chunk may continue in the next one
+        last_key = tuple(chunk.iloc[-1][case_columns])
+        is_last = (chunk[case_columns] == pd.Series(last_key, index=case_columns)).all(axis=1)
+        carry = chunk[is_last]
+
+        for key, rows in chunk[~is_last].groupby(case_columns, sort=False):
+            if key in seen:
+                raise ValueError(f"Rows of case {key} are not contiguous; use assume_sorted=False.")
+            seen.add(key)
+            yield key, _lesion_table(rows, coordinate_columns, index_column)
+
+    if carry is not None and not carry.empty:
+        key = tuple(carry.iloc[0][case_columns])
+        if key in seen:
+            raise ValueError(f"Rows of case {key} are not contiguous; use assume_sorted=False.")
+        yield key, _lesion_table(carry, coordinate_columns, index_column)
+
+
+def iter_timepoint_pairs(cases, baseline_timepoint):
+    """
+    Pair each follow-up case of a streamed export with the baseline case of the same patient and reader.
+
+    The cases of one patient must be contiguous, as in an export sorted by patient, so only the cases of the
+    current patient are held in memory.
+
+    Parameters:
+        cases (iterable): (key, lesions) tuples returned by iter_lesion_export with the default case columns
+            (patient, timepoint, reader).
+        baseline_timepoint (str): The timepoint the follow-up timepoints are matched to, e.g. 'Screening'.
+
+    Yields:
+        tuple: The patient, the reader, the follow-up timepoint, and the baseline and follow-up lesion
+        DataFrames, ready for find_corresponding_lesions.
+    """
+    def pairs(patient_cases):
+        for (patient, timepoint, reader), lesions in patient_cases.items():
+            baseline = patient_cases.get((patient, baseline_timepoint, reader))
+            if timepoint != baseline_timepoint and baseline is not None:
+                yield patient, reader, timepoint, baseline, lesions
+
+    patient_cases = {}
+    current_patient = None
+    for key, lesions in cases:
+        if key[0] != current_patient:
+            yield from pairs(patient_cases)
+            patient_cases = {}
+            current_patient = key[0]
+        patient_cases[key] = lesions
+
+    yield from pairs(patient_cases)
@@ -0,0 +1,201 @@
+
+
+import ast
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+
+from input_transform import load_dicom_series
+from transform_coordinates import read_lesion_csv
+
+
+def _parse_centroid(centroid):
+    """
+    Convert a centroid cell ((x, y, z), list, or its string form) to a float array, or None if missing.
+    """
+    if isinstance(centroid, str):
+        try:
+            centroid = ast.literal_eval(centroid)
+        except (ValueError, SyntaxError):
+            # e.g. 'Not matched'
+            return None
+    if centroid is None or np.ndim(centroid) != 1 or len(centroid) != 3:
+        return None
+    return np.asarray(centroid, dtype=float)
+
+
+def _load_image(image):
+    """
+    Load an image given as a SimpleITK image, an image file or a DICOM directory.
+    """
+    if isinstance(image, sitk.Image):
+        return image
+    if os.path.isdir(image):
+        return load_dicom_series(image)
+    return sitk.Cast(sitk.ReadImage(image), sitk.sitkFloat32)
+
+
+def extract_lesion_patches(image, centers, patch_size=(32, 32, 32), spacing=(1., 1., 1.), default_value=-1000.,
+                           interpolator=sitk.sitkLinear):
+    """
+    Extract fixed-size physical-space 3D patches around lesions of one image.
+
+    Each patch is an axis-aligned grid of patch_size voxels at the given spacing, centered on the lesion, so
+    patches of images with different spacings or orientations are directly comparable. Only the patch voxels
+    are interpolated; one resampling filter is configured once and re-used for all lesions.
+
+    Parameters:
+        image (SimpleITK.Image): The image.
+        centers (array_like): (N, 3) physical lesion centers; rows with NaN give patches of default_value.
+        patch_size (tuple, optional): (x, y, z) patch size in voxels. Defaults to (32, 32, 32).
+        spacing (tuple, optional): (x, y, z) patch spacing in mm. Defaults to (1., 1., 1.).
+        default_value (float, optional): Value outside the image. Defaults to -1000.
+        interpolator (int, optional): SimpleITK interpolator. Defaults to sitk.sitkLinear.
+
+    Returns:
+        np.ndarray: (N, D, H, W) float32 array of patches, D, H, W being the z, y, x sizes.
+    """
+    centers = np.asarray(centers, dtype=float).reshape(-1, 3)
+    half_extent = (np.asarray(patch_size) - 1) / 2 * np.asarray(spacing)
+    patches = np.full((len(centers),) + tuple(patch_size)[::-1], default_value, dtype=np.float32)
+
+    resampler = sitk.ResampleImageFilter()
+    resampler.SetSize([int(s) for s in patch_size])
+    resampler.SetOutputSpacing([float(s) for s in spacing])
+    resampler.SetOutputDirection((1., 0., 0., 0., 1., 0., 0., 0., 1.))
+    resampler.SetOutputPixelType(sitk.sitkFloat32)
+    resampler.SetDefaultPixelValue(default_value)
+    resampler.SetInterpolator(interpolator)
+
+    for n, center in enumerate(centers):
+        if np.isnan(center).any():
+            continue
+        resampler.SetOutputOrigin((center - half_extent).tolist())
+        patches[n] = sitk.GetArrayViewFromImage(resampler.Execute(image))
+
+    return patches
+
+
+def track_centers(tracks, column):
+    """
+    Physical centers of the tracks at one timepoint.
+
+    Parameters:
+        tracks (pandas.DataFrame): The track table, e.g. from create_final_dataframe_timepoints.
+        column (str): The centroid column of the timepoint, e.g. 'Fixed Centroid'.
+
+    Returns:
+        np.ndarray: (N, 3) centers, NaN where the lesion is missing at that timepoint.
+    """
+    centers = np.full((len(tracks), 3), np.nan)
+    for n, centroid in enumerate(tracks[column]):
+        centroid = _parse_centroid(centroid)
+        if centroid is not None:
+            centers[n] = centroid
+    return centers
+
+
+def add_moving_centroids(tracks, moving_csv, column='Moving Centroid'):
+    """
+    Add the centroids of the lesions in the moving (not registered) image to a track table.
+
+    The registered coordinates keep the indices of the moving lesions, so the 'Reg Index' of a track is
+    looked up in the moving lesion file.
+
+    Parameters:
+        tracks (pandas.DataFrame): The track table from create_final_dataframe_timepoints.
+        moving_csv (str): The file path to the moving lesions.
+        column (str, optional): The name of the new column. Defaults to 'Moving Centroid'.
+
+    Returns:
+        pandas.DataFrame: A copy of the track table with the new column ('Not matched' where missing).
+    """
+    moving = read_lesion_csv(moving_csv).set_index('Index')
+    centroids = {index: [row.x, row.y, row.z] for index, row in moving.iterrows()}
+    tracks = tracks.copy()
+    tracks[column] = [centroids.get(str(index), 'Not matched') for index in tracks['Reg Index']]
+    return tracks
+
+
+def _extract_case(case, timepoints, patch_size, spacing, default_value, patches, offset):
+    """
+    Extract the patches of one case into rows offset... of the output array and return its index rows.
+    """
+    tracks = case['tracks']
+    if isinstance(tracks, str):
+        tracks = pd.read_csv(tracks, dtype=str)
+
+    index = pd.DataFrame({'Row': np.arange(offset, offset + len(tracks)), 'Case': case['name']})
+    for column in ('Updated Index', 'Fixed Index', 'Reg Index'):
+        if column in tracks.columns:
+            index[column] = tracks[column].astype(str).values
+
+    for t, timepoint in enumerate(timepoints):
+        centers = track_centers(tracks, case['columns'][timepoint])
+        image = _load_image(case['images'][timepoint])
+        patches[offset:offset + len(tracks), t] = extract_lesion_patches(image, centers, patch_size, spacing,
+                                                                         default_value)
+        index[f'{timepoint}_valid'] = ~np.isnan(centers).any(axis=1)
+        for k, axis in enumerate('xyz'):
+            index[f'{timepoint}_{axis}'] = centers[:, k]
+
+    return index
+
+
+def write_patch_dataset(cases, output_file, timepoints=('fixed', 'moving', 'registered'), patch_size=(32, 32, 32),
+                        spacing=(1., 1., 1.), default_value=-1000., num_workers=4):
+    """
+    Extract lesion patches of a cohort into one memory-mapped (N, T, D, H, W) array with an index table.
+
+    Row n of the array holds the patches of one track at the T timepoints. The index table, written next to
+    the array as a CSV file, gives the case, the lesion indices and, per timepoint, the patch center and
+    whether the lesion exists there (missing lesions have patches of default_value). Cases are extracted
+    concurrently by threads writing directly into the memory-mapped array.
+
+    Parameters:
+        cases (list): Case descriptions, each a dict with:
+            - 'name': the case name;
+            - 'tracks': the track table (DataFrame or CSV file), e.g. from create_final_dataframe_timepoints
+              (with add_moving_centroids for the moving timepoint);
+            - 'images': the image of each timepoint (SimpleITK image, image file or DICOM directory);
+            - 'columns': the centroid column of each timepoint, e.g. {'fixed': 'Fixed Centroid',
+              'moving': 'Moving Centroid', 'registered': 'Reg Centroid'}.
+        output_file (str): The path to the .npy output file; the index table goes to the same path with .csv.
+        timepoints (tuple, optional): Timepoint names, in the order of the T axis. Defaults to
+            ('fixed', 'moving', 'registered').
+        patch_size (tuple, optional): (x, y, z) patch size in voxels. Defaults to (32, 32, 32).
+        spacing (tuple, optional): (x, y, z) patch spacing in mm. Defaults to (1., 1., 1.).
+        default_value (float, optional): Value outside the images and for missing lesions. Defaults to -1000.
+        num_workers (int, optional): Number of cases extracted concurrently. Defaults to 4.
+
+    Returns:
+        tuple: The memory-mapped patch array and the index table (pandas.DataFrame). Both are empty (N = 0)
+        when cases is empty.
+    """
+    cases = [dict(case, tracks=pd.read_csv(case['tracks'], dtype=str) if isinstance(case['tracks'], str)
+                  else case['tracks']) for case in cases]
+    counts = [len(case['tracks']) for case in cases]
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(int)
+
+    shape = (int(sum(counts)), len(timepoints)) + tuple(patch_size)[::-1]
+    patches = np.lib.format.open_memmap(output_file, mode='w+', dtype=np.float32, shape=shape)
+
+    with ThreadPoolExecutor(num_workers) as executor:
+        futures = [executor.submit(_extract_case, case, timepoints, patch_size, spacing, default_value, patches,
+                                   offset) for case, offset in zip(cases, offsets)]
+        indices = [future.result() for future in futures]
+
+    if indices:
+        index = pd.concat(indices, ignore_index=True)
+    else:
+        # No cases, e.g. nothing matched in the cohort: an empty array and index table
+        index = pd.DataFrame(columns=['Row', 'Case', 'Updated Index', 'Fixed Index', 'Reg Index'] +
+                             [f'{timepoint}_{column}' for timepoint in timepoints
+                              for column in ('valid', 'x', 'y', 'z')])
+
+    patches.flush()
+    index.to_csv(os.path.splitext(output_file)[0] + '.csv', index=False)
+    return patches, index
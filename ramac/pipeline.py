@@ -0,0 +1,182 @@
+
+
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import SimpleITK as sitk
+
+from input_transform import load_dicom_series
+from dicom_io import dicom_cache_file
+from preprocessing import mask_air, preprocess_dicom_series
+from registration import registration_3d_rigid_series
+from transform_coordinates import create_transformed_dataframe, read_lesion_csv
+from correspondence_csv_input import find_corresponding_lesions, create_final_dataframe_timepoints
+from merge_dataframe import merge_indices
+from utils import save_transformed_dataframe
+from result_database import write_case_to_database
+
+
+def run_cohort_pipeline(cases, prepare, process, write, max_in_flight=2, num_prefetch_threads=1,
+                        num_writer_threads=1, max_pending_writes=4):
+    """
+    Run a cohort through overlapped pipeline stages.
+
+    Each case goes through three stages:
+        - prepare(case), e.g. loading and masking the images, runs in background threads, so that the next
+          cases are prefetched while the current case is processed;
+        - process(case, prepared), e.g. registration and matching, runs in the calling thread;
+        - write(case, results), e.g. writing CSVs and figures, runs in a write-behind worker.
+
+    Memory is bounded: at most max_in_flight prepared cases (the one being processed included) exist at
+    any time, and at most max_pending_writes results wait to be written.
+
+    Parameters:
+        cases (iterable): The case descriptions passed to the stages.
+        prepare (callable): I/O-heavy stage, prepare(case) -> prepared.
+        process (callable): CPU-heavy stage, process(case, prepared) -> results.
+        write (callable): Output stage, write(case, results) -> value returned for the case.
+        max_in_flight (int, optional): Maximum number of prepared cases held in memory. Defaults to 2.
+        num_prefetch_threads (int, optional): Number of threads running the prepare stage. Defaults to 1.
+        num_writer_threads (int, optional): Number of threads running the write stage. Defaults to 1.
+        max_pending_writes (int, optional): Maximum number of results waiting to be written. Defaults to 4.
+
+    Returns:
+        list: The values returned by write, in the order of the cases.
+
+    Raises:
+        Exception: The first exception raised by a stage is re-raised once the running stages are finished.
+    """
+    outputs = []
+    prefetched = deque()
+    pending_writes = deque()
+
+    with ThreadPoolExecutor(num_prefetch_threads) as prefetch_pool, \
+            ThreadPoolExecutor(num_writer_threads) as write_pool:
+
+        def process_oldest():
+            case, future = prefetched.popleft()
+            results = process(case, future.result())
+
+            # Write behind, but do not let unwritten results pile up
+            if len(pending_writes) >= max_pending_writes:
+                outputs.append(pending_writes.popleft().result())
+            pending_writes.append(write_pool.submit(write, case, results))
+
+        try:
+            for case in cases:
+                if len(prefetched) >= max_in_flight:
+                    process_oldest()
+                prefetched.append((case, prefetch_pool.submit(prepare, case)))
+
+            while prefetched:
+                process_oldest()
+
+            while pending_writes:
+                outputs.append(pending_writes.popleft().result())
+        finally:
+            # Do not start new work after a failure
+            for _, future in prefetched:
+                future.cancel()
+
+    return outputs
+
+
+def prepare_case(case):
+    """
+    Pipeline prepare stage: load the fixed and moving DICOM series and mask out air.
+
+    Parameters:
+        case (dict): Case description with 'fixed_dir' and 'moving_dir', and optionally 'cache_dir'
+            (volume and body mask cache) and 'preprocessing' (options of preprocess_image; the images
+            are then the cached working volumes of preprocess_dicom_series).
+
+    Returns:
+        tuple: The preprocessed fixed and moving images.
+    """
+    cache_dir = case.get('cache_dir')
+    if case.get('preprocessing') is not None:
+        return tuple(preprocess_dicom_series(directory, cache_dir, **case['preprocessing'])[0]
+                     for directory in (case['fixed_dir'], case['moving_dir']))
+
+    images = []
+    for directory in (case['fixed_dir'], case['moving_dir']):
+        image = load_dicom_series(directory, cache_dir=cache_dir)
+        # The body mask is cached next to the volume
+        mask_cache_file = None
+        if cache_dir is not None:
+            mask_cache_file = dicom_cache_file(directory, cache_dir)[:-len('.nrrd')] + '_mask.nrrd'
+        images.append(mask_air(image, cache_file=mask_cache_file))
+    return tuple(images)
+
+
+def register_and_match_case(case, prepared):
+    """
+    Pipeline process stage: register the images, transform the moving lesions and match them.
+
+    Parameters:
+        case (dict): Case description with 'fixed_csv', 'moving_csv' and optionally 'threshold' (default 30).
+        prepared (tuple): The fixed and moving images returned by prepare_case.
+
+    Returns:
+        dict: The final transform, the registration convergence trace, the registered coordinates, the
+        correspondences and the unmatched indices of both sets.
+    """
+    fixed_image, moving_image = prepared
+    trace = {}
+    _, [_, final_transform] = registration_3d_rigid_series(fixed_image, moving_image, trace=trace)
+
+    registered = create_transformed_dataframe(case['moving_csv'], final_transform, inverse=True)
+    correspondences, unmatched_fixed, unmatched_registered = find_corresponding_lesions(
+        read_lesion_csv(case['fixed_csv']), registered, case.get('threshold', 30))
+
+    return {'transform': final_transform,
+            'convergence_trace': trace['metric_values'],
+            'multires_iterations': trace['multires_iterations'],
+            'registered': registered,
+            'correspondences': correspondences,
+            'unmatched_fixed': unmatched_fixed,
+            'unmatched_registered': unmatched_registered}
+
+
+def write_case_results(case, results):
+    """
+    Pipeline write stage: save the transform, registered coordinates and final correspondences of a case.
+
+    When the case has a 'database' entry, the results (including the registration convergence trace) are
+    also written to that result database in one transaction, under the case 'patient', 'timepoint' and
+    optional 'run_id'.
+
+    Parameters:
+        case (dict): Case description with 'fixed_csv' and 'output_dir', and optionally 'database'.
+        results (dict): The results returned by register_and_match_case.
+
+    Returns:
+        str: The path to the correspondence CSV file.
+    """
+    output_dir = case['output_dir']
+    os.makedirs(output_dir, exist_ok=True)
+
+    filename_registered = os.path.join(output_dir, 'registered_coordinates.csv')
+    filename_correspondence = os.path.join(output_dir, 'correspondence_indices.csv')
+
+    sitk.WriteTransform(results['transform'], os.path.join(output_dir, 'final_transform.tfm'))
+    save_transformed_dataframe(results['registered'], filename_registered)
+
+    final_df = create_final_dataframe_timepoints(results['correspondences'], results['unmatched_fixed'],
+                                                 results['unmatched_registered'], case['fixed_csv'],
+                                                 filename_registered)
+    if case.get('database') is not None:
+        write_case_to_database(case['database'], case['patient'], case['timepoint'], run_id=case.get('run_id', ''),
+                               threshold=case.get('threshold', 30), transforms={'final': results['transform']},
+                               convergence_trace=results.get('convergence_trace'),
+                               multires_iterations=results.get('multires_iterations'),
+                               lesions={'fixed': read_lesion_csv(case['fixed_csv']),
+                                        'registered': results['registered']},
+                               correspondences=results['correspondences'],
+                               unmatched_fixed=results['unmatched_fixed'],
+                               unmatched_registered=results['unmatched_registered'], tracks=final_df)
+
+    merge_indices(final_df).to_csv(filename_correspondence, index=False)
+
+    return filename_correspondence
@@ -46,61 +46,201 @@ def compare_slices_interactive(original_phantom, transformed_phantom, moving_res
     """
     Compare slices interactively for three input images.
 
+    The three images scroll in lock-step in one SliceBrowser. Use an interactive matplotlib backend
+    (e.g. %matplotlib widget in Jupyter).
+
     Args:
         original_phantom (SimpleITK.Image): The original phantom image.
         transformed_phantom (SimpleITK.Image): The transformed phantom image (which is the moving image).
         moving_resampled (SimpleITK.Image): The resampled moving image (registered image).
 
     Returns:
-        None
+        SliceBrowser: The browser; keep a reference to it while using it.
     """
-    # Define slice indices
-    image_size = original_phantom.GetSize()
-    max_x, max_y, max_z = image_size[0]-1, image_size[1]-1, image_size[2]-1
-
-    # Display heading for original phantom
-    display(Markdown("### Fixed Image Interactive Plot"))
-
-    # Create interactive visualization for original phantom
-    interact(
-        plot_slices_interactive,
-        image=fixed(original_phantom),
-        slice_z=IntSlider(min=0, max=max_x, step=1, value=int(max_x/2)),
-        slice_y=IntSlider(min=0, max=max_y, step=1, value=int(max_y/2)),
-        slice_x=IntSlider(min=0, max=max_z, step=1, value=int(max_z/2))
-    )
-    
-    # Define slice indices
-    image_size = transformed_phantom.GetSize()
-    max_x, max_y, max_z = image_size[0]-1, image_size[1]-1, image_size[2]-1
-
-    # Display heading for transformed phantom
-    display(Markdown("### Moving Image Interactive Plot"))
-
-    # Create interactive visualization for transformed phantom
-    interact(
-        plot_slices_interactive,
-        image=fixed(transformed_phantom),
-        slice_z=IntSlider(min=0, max=max_x, step=1, value=int(max_x/2)),
-        slice_y=IntSlider(min=0, max=max_y, step=1, value=int(max_y/2)),
-        slice_x=IntSlider(min=0, max=max_z, step=1, value=int(max_z/2))
-    )
-    
-    # Define slice indices
-    image_size = moving_resampled.GetSize()
-    max_x, max_y, max_z = image_size[0]-1, image_size[1]-1, image_size[2]-1
+    browser = SliceBrowser([original_phantom, transformed_phantom, moving_resampled],
+                           names=['Fixed Image', 'Moving Image', 'Registered Image'])
+    browser.show()
+    return browser
+
+
+class SliceBrowser:
+    """
+    Interactive triplanar browser of one or more volumes that scroll in lock-step.
+
+    The imshow artists are created once and updated with set_data. While a slider is moving, slices come from
+    a downsampled preview of each volume; the full-resolution slices are drawn once the slider has been still
+    for settle_delay seconds. Slices are read from array views of the images, never from full copies.
+
+    The sliders select a voxel of the first image. The other images show the voxel at the same physical point,
+    so images on different grids (e.g. fixed and moving) stay anatomically aligned.
+
+    Args:
+        images (list): SimpleITK images to browse.
+        names (list, optional): Row titles. Defaults to None ('Image 1', 'Image 2', ...).
+        window_level (float, optional): The window level. Defaults to None (from the intensity range).
+        window_width (float, optional): The window width. Defaults to None (from the intensity range).
+        preview_factor (int, optional): Downsampling factor of the previews. Defaults to 4.
+        settle_delay (float, optional): Delay in seconds before drawing full resolution. Defaults to 0.15.
+    """
+
+    PLANES = ('Axial', 'Sagittal', 'Coronal')
+
+    def __init__(self, images, names=None, window_level=None, window_width=None, preview_factor=4,
+                 settle_delay=0.15):
+        from matplotlib.widgets import Slider
+
+        # Keep the images alive: the arrays are views of their buffers
+        self.images = list(images)
+        self.names = names or [f'Image {i + 1}' for i in range(len(self.images))]
+        self.arrays = [sitk.GetArrayViewFromImage(image) for image in self.images]
+        self.preview_factor = preview_factor
+        self.previews = [np.ascontiguousarray(array[::preview_factor, ::preview_factor, ::preview_factor])
+                         for array in self.arrays]
+
+        if window_level is None or window_width is None:
+            low, high = np.percentile(np.concatenate([preview.ravel() for preview in self.previews]), [0.5, 99.5])
+            window_level, window_width = (low + high) / 2, max(high - low, 1e-6)
+        vmin, vmax = window_level - 0.5 * window_width, window_level + 0.5 * window_width
+
+        size = self.images[0].GetSize()
+        self.position = [s // 2 for s in size]
+        self._shown = {}
+
+        num_rows = len(self.images)
+        self.fig, self.axs = plt.subplots(num_rows, 3, figsize=(12, 4 * num_rows + 1), squeeze=False)
+        self.fig.subplots_adjust(bottom=0.08 + 0.1 / num_rows)
+
+        self.artists = []
+        for i, image in enumerate(self.images):
+            spacing = image.GetSpacing()
+            aspects = (spacing[0] / spacing[1], spacing[2] / spacing[1], spacing[2] / spacing[0])
+            row = []
+            for plane, (ax, aspect) in enumerate(zip(self.axs[i], aspects)):
+                data = self._slice(i, plane, full=True)
+                height, width = data.shape
+                row.append(ax.imshow(data, cmap='gray', vmin=vmin, vmax=vmax, aspect=aspect,
+                                     extent=(-0.5, width - 0.5, height - 0.5, -0.5)))
+                ax.axis('off')
+                self._shown[i, plane] = (self._plane_index(i, plane), True)
+            self.artists.append(row)
+        self._update_titles()
+
+        self.sliders = []
+        for k, label in enumerate('xyz'):
+            slider_ax = self.fig.add_axes([0.15, 0.01 + 0.03 * k, 0.7, 0.02])
+            slider = Slider(slider_ax, label, 0, size[k] - 1, valinit=self.position[k], valstep=1)
+            slider.on_changed(self._on_slider)
+            self.sliders.append(slider)
+
+        self._timer = self.fig.canvas.new_timer(interval=int(settle_delay * 1000))
+        self._timer.single_shot = True
+        self._timer.add_callback(self._update, True)
+
+    def _voxel(self, i):
+        """
+        Voxel (x, y, z) of image i at the physical point of the current position in the first image.
+        """
+        if i == 0:
+            return list(self.position)
+        point = self.images[0].TransformIndexToPhysicalPoint([int(p) for p in self.position])
+        voxel = self.images[i].TransformPhysicalPointToIndex(point)
+        return [min(max(v, 0), s - 1) for v, s in zip(voxel, self.images[i].GetSize())]
+
+    def _plane_index(self, i, plane):
+        """
+        Index of the slice of image i shown in a plane: z for axial, x for sagittal, y for coronal.
+        """
+        return self._voxel(i)[(2, 0, 1)[plane]]
+
+    def _slice(self, i, plane, full):
+        """
+        Slice of image i in a plane, at full resolution or from the preview.
+        """
+        index = self._plane_index(i, plane)
+        if full:
+            array = self.arrays[i]
+        else:
+            array = self.previews[i]
+            index = min(index // self.preview_factor, array.shape[(0, 2, 1)[plane]] - 1)
+
+        if plane == 0:
+            return array[index, :, :]
+        if plane == 1:
+            return np.flipud(array[:, :, index])
+        return np.flipud(array[:, index, :])
+
+    def _update_titles(self):
+        for i, name in enumerate(self.names):
+            voxel = self._voxel(i)
+            for plane, ax in enumerate(self.axs[i]):
+                ax.set_title(f"{name} - {self.PLANES[plane]} (Slice {voxel[(2, 0, 1)[plane]]})")
+
+    def _update(self, full):
+        """
+        Refresh the artists whose slice or resolution changed.
+        """
+        for i in range(len(self.images)):
+            for plane in range(3):
+                state = (self._plane_index(i, plane), full)
+                if self._shown[i, plane] != state:
+                    self.artists[i][plane].set_data(self._slice(i, plane, full))
+                    self._shown[i, plane] = state
+        self._update_titles()
+        self.fig.canvas.draw_idle()
+
+    def _on_slider(self, value):
+        self.position = [int(slider.val) for slider in self.sliders]
+        self._update(False)
+        # Draw full resolution once the slider settles
+        self._timer.stop()
+        self._timer.start()
+
+    def set_position(self, x, y, z):
+        """
+        Move all images to the voxel (x, y, z) of the first image and draw it at full resolution.
+
+        Args:
+            x (int): Sagittal slice index.
+            y (int): Coronal slice index.
+            z (int): Axial slice index.
+
+        Returns:
+            None
+        """
+        self.position = [int(x), int(y), int(z)]
+        for slider, value in zip(self.sliders, self.position):
+            slider.eventson = False
+            slider.set_val(value)
+            slider.eventson = True
+        self._update(True)
+
+    def show(self):
+        """
+        Show the browser window.
+
+        Returns:
+            None
+        """
+        plt.show()
 
-    # Display heading for moving resampled image
-    display(Markdown("### Registered Image Interactive Plot"))
 
-    # Create interactive visualization for moving resampled image
-    interact(
-        plot_slices_interactive,
-        image=fixed(moving_resampled),
-        slice_z=IntSlider(min=0, max=max_x, step=1, value=int(max_x/2)),
-        slice_y=IntSlider(min=0, max=max_y, step=1, value=int(max_y/2)),
-        slice_x=IntSlider(min=0, max=max_z, step=1, value=int(max_z/2))
-    )
+def extract_slices_along_axes(array, indices):
+    """
+    Extract, for every lesion, the slices through its voxel along each array axis in one vectorized step.
+
+    Only the requested slices are copied, not the volume: pass a view from sitk.GetArrayViewFromImage.
+
+    Args:
+        array (numpy.ndarray): The 3D array, e.g. a view of a SimpleITK image.
+        indices (list): List of tuples (i0, i1, i2) of indices along array axes 0, 1 and 2, one per lesion.
+
+    Returns:
+        tuple: Three arrays; the n-th element of the a-th array is the slice of array at indices[n][a] along axis a.
+    """
+    indices = np.asarray(indices, dtype=int).reshape(-1, 3)
+    return (array[indices[:, 0]],
+            np.moveaxis(array[:, indices[:, 1]], 1, 0),
+            np.moveaxis(array[:, :, indices[:, 2]], 2, 0))
 
 
 def plot_lesions_1(original_phantom, transformed_phantom, moving_resampled, fixed_voxel_tuples, transformed_lesions_rounded, registered_voxel_tuples):
@@ -126,6 +266,13 @@ def plot_lesions_1(original_phantom, transformed_phantom, moving_resampled, fixe
 
     plt.figure(figsize=(15, 5*num_rows))
 
+    # Slices through all lesions, from one view per image
+    fixed_slices = extract_slices_along_axes(sitk.GetArrayViewFromImage(original_phantom), fixed_voxel_tuples)
+    transformed_slices = extract_slices_along_axes(sitk.GetArrayViewFromImage(transformed_phantom),
+                                                   transformed_lesions_rounded)
+    registered_slices = extract_slices_along_axes(sitk.GetArrayViewFromImage(moving_resampled),
+                                                  registered_voxel_tuples)
+
     # Initialize subplot index
     subplot_index = 1
 
@@ -138,27 +285,24 @@ def plot_lesions_1(original_phantom, transformed_phantom, moving_resampled, fixe
         plt.suptitle("Lesion Visualization", fontsize=16, fontweight='bold', x=0.5, y=1.00)
         
         # Plot X slice
-        slice_index = fixed_coords[0]
         plt.subplot(num_rows, num_cols, subplot_index)
-        plt.imshow(np.flipud(sitk.GetArrayFromImage(original_phantom)[slice_index, :, :].T), cmap="gray")
+        plt.imshow(np.flipud(fixed_slices[0][lesion_num].T), cmap="gray")
         plt.scatter(fixed_coords[1], original_phantom.GetSize()[2] - fixed_coords[2]-1, color='red', 
                     label='Lesion Coordinates')
         plt.title("Fixed_Image - X slice",fontweight='bold')
         plt.axis("off")
         subplot_index += 1
 
-        slice_index_r = transformed_coords[0]
         plt.subplot(num_rows, num_cols, subplot_index)
-        plt.imshow(np.flipud(sitk.GetArrayFromImage(transformed_phantom)[slice_index_r, :, :].T), cmap="gray")
+        plt.imshow(np.flipud(transformed_slices[0][lesion_num].T), cmap="gray")
         plt.scatter(transformed_coords[1], transformed_phantom.GetSize()[2] - transformed_coords[2]-1, color='red',
                     label='Lesion Coordinates')
         plt.title("Moving_Image - X slice",fontweight='bold')
         plt.axis("off")
         subplot_index += 1
 
-        slice_index_m = registered_coords[0]
         plt.subplot(num_rows, num_cols, subplot_index)
-        plt.imshow(np.flipud(sitk.GetArrayFromImage(moving_resampled)[slice_index_m, :, :].T), cmap="gray")
+        plt.imshow(np.flipud(registered_slices[0][lesion_num].T), cmap="gray")
         plt.scatter(registered_coords[1], moving_resampled.GetSize()[2] - registered_coords[2]-1, color='red', 
                     label='Lesion Coordinates')
         plt.title("Registered_Image - X slice",fontweight='bold')
@@ -166,27 +310,24 @@ def plot_lesions_1(original_phantom, transformed_phantom, moving_resampled, fixe
         subplot_index += 1
 
         # Plot Y slice
-        slice_index = fixed_coords[1]
         plt.subplot(num_rows, num_cols, subplot_index)
-        plt.imshow(np.flipud(sitk.GetArrayFromImage(original_phantom)[:, slice_index, :].T), cmap="gray")
+        plt.imshow(np.flipud(fixed_slices[1][lesion_num].T), cmap="gray")
         plt.scatter(fixed_coords[0], original_phantom.GetSize()[2] - fixed_coords[2]-1, color='red', 
                     label='Lesion Coordinates')
         plt.title("Fixed_Image - Y slice",fontweight='bold')
         plt.axis("off")
         subplot_index += 1
 
-        slice_index_r = transformed_coords[1]
         plt.subplot(num_rows, num_cols, subplot_index)
-        plt.imshow(np.flipud(sitk.GetArrayFromImage(transformed_phantom)[:, slice_index_r, :].T), cmap="gray")
+        plt.imshow(np.flipud(transformed_slices[1][lesion_num].T), cmap="gray")
         plt.scatter(transformed_coords[0], transformed_phantom.GetSize()[2] - transformed_coords[2]-1, color='red',
                     label='Lesion Coordinates')
         plt.title("Moving_Image - Y slice",fontweight='bold')
         plt.axis("off")
         subplot_index += 1
 
-        slice_index_m = registered_coords[1]
         plt.subplot(num_rows, num_cols, subplot_index)
-        plt.imshow(np.flipud(sitk.GetArrayFromImage(moving_resampled)[:, slice_index_m, :].T), cmap="gray")
+        plt.imshow(np.flipud(registered_slices[1][lesion_num].T), cmap="gray")
         plt.scatter(registered_coords[0], moving_resampled.GetSize()[2] - registered_coords[2]-1, color='red', 
                     label='Lesion Coordinates')
         plt.title("Registered_Image - Y slice",fontweight='bold')
@@ -194,27 +335,24 @@ def plot_lesions_1(original_phantom, transformed_phantom, moving_resampled, fixe
         subplot_index += 1
 
         # Plot Z slice
-        slice_index = fixed_coords[2]
         plt.subplot(num_rows, num_cols, subplot_index)
-        plt.imshow(np.flipud(sitk.GetArrayFromImage(original_phantom)[:, :, slice_index].T), cmap="gray")
+        plt.imshow(np.flipud(fixed_slices[2][lesion_num].T), cmap="gray")
         plt.scatter(fixed_coords[0], original_phantom.GetSize()[1] - fixed_coords[1]-1, color='red', 
                     label='Lesion Coordinates')
         plt.title("Fixed_Image - Z slice",fontweight='bold')
         plt.axis("off")
         subplot_index += 1
 
-        slice_index_r = transformed_coords[2]
         plt.subplot(num_rows, num_cols, subplot_index)
-        plt.imshow(np.flipud(sitk.GetArrayFromImage(transformed_phantom)[:, :, slice_index_r].T), cmap="gray")
+        plt.imshow(np.flipud(transformed_slices[2][lesion_num].T), cmap="gray")
         plt.scatter(transformed_coords[0], transformed_phantom.GetSize()[1] - transformed_coords[1]-1, color='red',
                     label='Lesion Coordinates')
         plt.title("Moving_Image - Z slice",fontweight='bold')
         plt.axis("off")
         subplot_index += 1
 
-        slice_index_m = registered_coords[2]
         plt.subplot(num_rows, num_cols, subplot_index)
-        plt.imshow(np.flipud(sitk.GetArrayFromImage(moving_resampled)[:, :, slice_index_m].T), cmap="gray")
+        plt.imshow(np.flipud(registered_slices[2][lesion_num].T), cmap="gray")
         plt.scatter(registered_coords[0], moving_resampled.GetSize()[1] - registered_coords[1]-1, color='red', 
                     label='Lesion Coordinates')
         plt.title("Registered_Image - Z slice",fontweight='bold')
@@ -260,16 +398,16 @@ def plot_lesions(*args):
 
     max_lesions = max(num_lesions_per_set)
 
+    # Slices through all lesions, from one view per image
+    slices = [extract_slices_along_axes(sitk.GetArrayViewFromImage(image), voxel_tuples) for image, voxel_tuples in args]
+
     for i in range(max_lesions):
         plt.figure(figsize=(20, 10))  
         for j, (image, voxel_tuples) in enumerate(args, start=1):
             if i < len(voxel_tuples):
                 subplot_index = (j-1) * 3 + 1  # X slice
                 plt.subplot(num_sets, 3, subplot_index)
-                slice_index = voxel_tuples[i][0]
-                slice_index_r = voxel_tuples[i][1]
-                slice_index_m = voxel_tuples[i][2]
-                plt.imshow(np.flipud(sitk.GetArrayFromImage(image)[slice_index, :, :].T), cmap="gray")
+                plt.imshow(np.flipud(slices[j-1][0][i].T), cmap="gray")
                 plt.scatter(voxel_tuples[i][1], image.GetSize()[2] - voxel_tuples[i][2]-1, color='red', label='Lesion Coordinates')
                 title_prefix = ""
                 if j == 1:
@@ -283,13 +421,13 @@ def plot_lesions(*args):
                 plt.axis("off")
 
                 plt.subplot(num_sets, 3, subplot_index + 1)  # Y slice
-                plt.imshow(np.flipud(sitk.GetArrayFromImage(image)[:, slice_index_r, :].T), cmap="gray")
+                plt.imshow(np.flipud(slices[j-1][1][i].T), cmap="gray")
                 plt.scatter(voxel_tuples[i][0], image.GetSize()[2] - voxel_tuples[i][2]-1, color='red', label='Lesion Coordinates')
                 plt.title(f"{title_prefix}{ordinal(i+1)} Lesion - Y Slice", fontweight='bold')  # Set title fontweight to bold
                 plt.axis("off")
 
                 plt.subplot(num_sets, 3, subplot_index + 2)  # Z slice
-                plt.imshow(np.flipud(sitk.GetArrayFromImage(image)[:, :, slice_index_m].T), cmap="gray")
+                plt.imshow(np.flipud(slices[j-1][2][i].T), cmap="gray")
                 plt.scatter(voxel_tuples[i][0], image.GetSize()[1] - voxel_tuples[i][1]-1, color='red', label='Lesion Coordinates')
                 plt.title(f"{title_prefix}{ordinal(i+1)} Lesion - Z Slice", fontweight='bold')  # Set title fontweight to bold
                 plt.axis("off")
@@ -313,27 +451,51 @@ def plot_triplanar(image, voxel_tuples, window_level, window_width, image_name):
         None
     """
     num_lesions = len(voxel_tuples)
-    fig, axs = plt.subplots(num_lesions, 3, figsize=(15, 5 * num_lesions))
+    fig, axs = plt.subplots(num_lesions, 3, figsize=(15, 5 * num_lesions), squeeze=False)
     plt.suptitle(image_name)
 
-    image_array = sitk.GetArrayFromImage(image)
+    draw_triplanar(axs, image, voxel_tuples, window_level, window_width)
+
+    plt.tight_layout()
+    plt.show()
+
+
+def draw_triplanar(axs, image, voxel_tuples, window_level, window_width, lesion_numbers=None):
+    """
+    Draws triplanar views (axial, sagittal, coronal) of the image slices containing lesions on existing axes.
+
+    Args:
+        axs (numpy.ndarray): (num_lesions, 3) array of matplotlib Axes, one row per lesion.
+        image (SimpleITK.Image): The input image containing the lesion data.
+        voxel_tuples (list of tuples): A list of tuples containing the voxel coordinates (x, y, z) of the lesions.
+        window_level (float): The window level for image visualization.
+        window_width (float): The window width for image visualization.
+        lesion_numbers (list, optional): Lesion numbers used in the titles. Defaults to None (1, 2, ...).
+
+    Returns:
+        None
+    """
+    axs = np.atleast_2d(axs)
+    if lesion_numbers is None:
+        lesion_numbers = range(1, len(voxel_tuples) + 1)
     spacing = image.GetSpacing()
 
-    for i, (voxel_coords, ax_row) in enumerate(zip(voxel_tuples, axs)):
-        axial_slice = image_array[voxel_coords[2], :, :]
-        sagittal_slice = image_array[:, :, voxel_coords[0]]
-        coronal_slice = image_array[:, voxel_coords[1], :]
+    # Axial, coronal and sagittal slices through all lesions, from one view of the image
+    axial_slices, coronal_slices, sagittal_slices = extract_slices_along_axes(
+        sitk.GetArrayViewFromImage(image), [voxel_coords[::-1] for voxel_coords in voxel_tuples])
+
+    for i, (voxel_coords, ax_row, number) in enumerate(zip(voxel_tuples, axs, lesion_numbers)):
+        axial_slice = axial_slices[i]
+        sagittal_slice = sagittal_slices[i]
+        coronal_slice = coronal_slices[i]
 
-        plot_slice(ax_row[0], axial_slice,  (voxel_coords[0], voxel_coords[1]), f"Axial Slice {ordinal(i+1)} Lesion", 
+        plot_slice(ax_row[0], axial_slice,  (voxel_coords[0], voxel_coords[1]), f"Axial Slice {ordinal(number)} Lesion", 
                    spacing[0] / spacing[1], voxel_coords[2], window_level, window_width, flip=False)
-        plot_slice(ax_row[1], sagittal_slice, (voxel_coords[1], voxel_coords[2]), f"Sagittal Slice {ordinal(i+1)} Lesion", 
+        plot_slice(ax_row[1], sagittal_slice, (voxel_coords[1], voxel_coords[2]), f"Sagittal Slice {ordinal(number)} Lesion", 
                    spacing[2] / spacing[1], voxel_coords[0], window_level, window_width, flip=True)
-        plot_slice(ax_row[2], coronal_slice, (voxel_coords[0], voxel_coords[2]), f"Coronal Slice {ordinal(i+1)} Lesion", 
+        plot_slice(ax_row[2], coronal_slice, (voxel_coords[0], voxel_coords[2]), f"Coronal Slice {ordinal(number)} Lesion", 
                    spacing[2] / spacing[0], voxel_coords[1], window_level, window_width, flip=True)
 
-    plt.tight_layout()
-    plt.show()
-
 def plot_slice(ax, slice_array, centroid, title, aspect, slice_number, window_level, window_width, flip=False):
     """
     Plots a single slice of the image with the centroid of the lesion marked.
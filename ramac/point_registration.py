@@ -0,0 +1,341 @@
+
+
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+from scipy.spatial import cKDTree
+
+from correspondence_csv_input import read_lesion_csv, find_corresponding_lesions
+from transform_coordinates import transform_points
+
+
+def weighted_kabsch(source, target, weights=None):
+    """
+    Find the rigid transform that best maps source points onto target points.
+
+    Solves min sum_i w_i * ||R @ source_i + t - target_i||^2 in closed form (weighted Kabsch algorithm).
+
+    Parameters:
+        source (np.ndarray): (N, 3) array of points to be mapped.
+        target (np.ndarray): (N, 3) array of corresponding target points.
+        weights (np.ndarray, optional): (N,) non-negative weight of each pair. Defaults to uniform weights.
+
+    Returns:
+        tuple: The (3, 3) rotation matrix R and the (3,) translation vector t.
+    """
+    source = np.asarray(source, dtype=float)
+    target = np.asarray(target, dtype=float)
+    if weights is None:
+        weights = np.ones(len(source))
+    weights = np.asarray(weights, dtype=float)
+    weights = weights / weights.sum()
+
+    # Weighted centroids and cross-covariance of the centred point sets
+    source_centroid = weights @ source
+    target_centroid = weights @ target
+    covariance = (source - source_centroid).T @ ((target - target_centroid) * weights[:, None])
+
+    U, _, Vt = np.linalg.svd(covariance)
+
+    # Flip the last axis if needed so that the result is a rotation and not a reflection
+    d = 1.0 if np.linalg.det(Vt.T @ U.T) >= 0 else -1.0
+    rotation = Vt.T @ np.diag([1.0, 1.0, d]) @ U.T
+    translation = target_centroid - rotation @ source_centroid
+
+    return rotation, translation
+
+
+def rigid_to_sitk(rotation, translation):
+    """
+    Convert a rotation matrix and translation vector to a SimpleITK rigid transform.
+
+    Parameters:
+        rotation (np.ndarray): (3, 3) rotation matrix.
+        translation (np.ndarray): (3,) translation vector.
+
+    Returns:
+        SimpleITK.Euler3DTransform: Transform mapping p to rotation @ p + translation.
+    """
+    transform = sitk.Euler3DTransform()
+    transform.SetMatrix(np.asarray(rotation, dtype=float).ravel().tolist())
+    transform.SetTranslation(np.asarray(translation, dtype=float).tolist())
+    return transform
+
+
+def _matched_pairs(correspondences):
+    """
+    Return the set of (Fixed_Index, Reg_Index) pairs accepted by the threshold.
+    """
+    matched = correspondences[correspondences['Match_Status'] == 'matched']
+    return set(zip(matched['Fixed_Index'], matched['Reg_Index']))
+
+
+def refine_transform_icp(fixed_df_or_file, moving_df_or_file, transform, threshold,
+                         max_iterations=10, min_pairs=3, weight_scale=None):
+    """
+    Refine a rigid registration transform on matched lesion centroids (point-set ICP).
+
+    The moving coordinates are mapped once with the registration transform. Each iteration then fits a
+    rigid correction (weighted Kabsch) on the pairs matched by the adaptive Hungarian step, re-maps the
+    coordinates with a single matrix multiply and re-runs the matching, until the set of matched pairs
+    no longer changes. Pairs are weighted by 1 / (1 + (distance / weight_scale)^2) so that confidently
+    matched lesions dominate the fit.
+
+    Parameters:
+        fixed_df_or_file (str or pandas.DataFrame): Lesions of the fixed image, as a CSV file path or DataFrame.
+        moving_df_or_file (str or pandas.DataFrame): Lesions of the moving image, as a CSV file path or DataFrame.
+        transform (SimpleITK.Transform): The registration transform applied to the moving coordinates.
+        threshold (float): The threshold distance for considering lesions as corresponding.
+        max_iterations (int, optional): Maximum number of refit/re-match iterations. Defaults to 10.
+        min_pairs (int, optional): Minimum number of matched pairs needed to refit the rotation. Defaults to 3.
+        weight_scale (float, optional): Distance scale of the pair weights. Defaults to threshold / 2.
+
+    Returns:
+        tuple: A tuple containing
+            - SimpleITK.CompositeTransform: The registration transform followed by the rigid correction.
+            - pandas.DataFrame: The refined registered coordinates with 'x', 'y', 'z' and 'Index' columns.
+            - pandas.DataFrame: The correspondences DataFrame of the final matching.
+            - pandas.DataFrame: Unmatched indices DataFrame from the fixed lesions.
+            - pandas.DataFrame: Unmatched indices DataFrame from the moving lesions.
+    """
+    fixed_df = read_lesion_csv(fixed_df_or_file) if isinstance(fixed_df_or_file, str) else fixed_df_or_file
+    moving_df = read_lesion_csv(moving_df_or_file) if isinstance(moving_df_or_file, str) else moving_df_or_file
+
+    if weight_scale is None:
+        weight_scale = threshold / 2
+
+    # Map the moving coordinates with the registration transform once
+    moving_points = moving_df[['x', 'y', 'z']].values.astype(float)
+    registered_points = transform_points(transform, moving_points)
+
+    def match(rotation, translation):
+        refined_df = pd.DataFrame(registered_points @ rotation.T + translation, columns=['x', 'y', 'z'])
+        refined_df['Index'] = moving_df['Index'].values
+        return refined_df, find_corresponding_lesions(fixed_df, refined_df, threshold)
+
+    rotation, translation = np.eye(3), np.zeros(3)
+    refined_df, result = match(rotation, translation)
+
+    for _ in range(max_iterations):
+        correspondences = result[0]
+        matched = correspondences[correspondences['Match_Status'] == 'matched']
+        if len(matched) < min_pairs:
+            break
+
+        # Fit the correction from the registered points, so the correction is never accumulated
+        source = registered_points[matched['R_I'].astype(int).values]
+        target = fixed_df.loc[matched['F_I'].values, ['x', 'y', 'z']].values.astype(float)
+        weights = 1.0 / (1.0 + (matched['Distance'].values.astype(float) / weight_scale) ** 2)
+        rotation, translation = weighted_kabsch(source, target, weights)
+
+        refined_df, new_result = match(rotation, translation)
+        converged = _matched_pairs(new_result[0]) == _matched_pairs(correspondences)
+        result = new_result
+        if converged:
+            break
+
+    # In a composite transform the last added transform is applied first
+    refined_transform = sitk.CompositeTransform([rigid_to_sitk(rotation, translation), transform])
+
+    return (refined_transform, refined_df) + tuple(result)
+
+
+def _lesion_points(df_or_file):
+    """
+    Return the lesion DataFrame and its (N, 3) coordinate array.
+    """
+    df = read_lesion_csv(df_or_file) if isinstance(df_or_file, str) else df_or_file
+    return df, df[['x', 'y', 'z']].values.astype(float)
+
+
+def _triangles(num_points, max_triangles, rng):
+    """
+    Return an index array of (at most max_triangles) distinct point triples.
+    """
+    num_triangles = num_points * (num_points - 1) * (num_points - 2) // 6
+    if num_triangles <= max_triangles:
+        return np.array(list(combinations(range(num_points), 3)), dtype=int).reshape(-1, 3)
+    triangles = np.array([rng.choice(num_points, 3, replace=False) for _ in range(max_triangles)])
+    return np.unique(np.sort(triangles, axis=1), axis=0)
+
+
+def _triangle_signatures(points, triangles):
+    """
+    Compute rotation-invariant signatures of triangles.
+
+    The signature is the sorted triple of side lengths. The vertices are reordered by the length of
+    the opposite side, so that signatures that agree also give the vertex correspondence.
+    """
+    a, b, c = points[triangles[:, 0]], points[triangles[:, 1]], points[triangles[:, 2]]
+    opposite = np.stack([np.linalg.norm(b - c, axis=1),
+                         np.linalg.norm(a - c, axis=1),
+                         np.linalg.norm(a - b, axis=1)], axis=1)
+    order = np.argsort(opposite, axis=1)
+    return np.take_along_axis(opposite, order, axis=1), np.take_along_axis(triangles, order, axis=1)
+
+
+def _batched_kabsch(source, target):
+    """
+    Unweighted Kabsch fit of a stack of (H, K, 3) point sets. Returns (H, 3, 3) rotations and (H, 3) translations.
+    """
+    source_centroid = source.mean(axis=1)
+    target_centroid = target.mean(axis=1)
+    covariance = np.einsum('hki,hkj->hij', source - source_centroid[:, None], target - target_centroid[:, None])
+    U, _, Vt = np.linalg.svd(covariance)
+    V, Ut = np.swapaxes(Vt, 1, 2), np.swapaxes(U, 1, 2)
+    d = np.where(np.linalg.det(V @ Ut) >= 0, 1.0, -1.0)
+    D = np.zeros((len(d), 3, 3))
+    D[:, 0, 0] = 1.0
+    D[:, 1, 1] = 1.0
+    D[:, 2, 2] = d
+    rotation = V @ D @ Ut
+    translation = target_centroid - np.einsum('hij,hj->hi', rotation, source_centroid)
+    return rotation, translation
+
+
+def estimate_constellation_transform(fixed_df_or_file, moving_df_or_file, inlier_tolerance=15.0,
+                                     signature_tolerance=5.0, min_side=10.0, max_triangles=5000,
+                                     max_hypotheses=20000, seed=0):
+    """
+    Estimate the rigid transform aligning two lesion constellations from point geometry alone.
+
+    No images are needed. Triangles of lesions are described by their sorted side lengths, which do not
+    change under rotation and translation. Moving triangles are looked up among the fixed triangles with
+    a KD-tree on these signatures (geometric hashing), each candidate triangle pair gives a rigid
+    hypothesis, and all hypotheses are scored at once by counting the moving lesions that land within
+    inlier_tolerance of a fixed lesion (RANSAC-style consensus). The best hypothesis is refitted on its
+    inliers.
+
+    With fewer than three lesions in either set the rotation is not determined, and the transform is a
+    translation aligning the centroids of the two sets.
+
+    Parameters:
+        fixed_df_or_file (str or pandas.DataFrame): Lesions of the fixed image, as a CSV file path or DataFrame.
+        moving_df_or_file (str or pandas.DataFrame): Lesions of the moving image, as a CSV file path or DataFrame.
+        inlier_tolerance (float, optional): Distance under which a mapped moving lesion supports a hypothesis. Defaults to 15.
+        signature_tolerance (float, optional): Maximum difference of triangle side lengths for a candidate pair. Defaults to 5.
+        min_side (float, optional): Triangles with a shorter side are too unstable to seed a hypothesis. Defaults to 10.
+        max_triangles (int, optional): Maximum number of triangles drawn from each constellation. Defaults to 5000.
+        max_hypotheses (int, optional): Maximum number of candidate triangle pairs that are scored. Defaults to 20000.
+        seed (int, optional): Seed of the random triangle and hypothesis sampling. Defaults to 0.
+
+    Returns:
+        tuple: The SimpleITK.Euler3DTransform mapping moving coordinates onto the fixed coordinates, and the
+        number of inlier lesions supporting it.
+    """
+    _, fixed_points = _lesion_points(fixed_df_or_file)
+    _, moving_points = _lesion_points(moving_df_or_file)
+    rng = np.random.default_rng(seed)
+
+    if len(fixed_points) < 3 or len(moving_points) < 3:
+        translation = fixed_points.mean(axis=0) - moving_points.mean(axis=0)
+        return rigid_to_sitk(np.eye(3), translation), min(len(fixed_points), len(moving_points))
+
+    fixed_signatures, fixed_vertices = _triangle_signatures(
+        fixed_points, _triangles(len(fixed_points), max_triangles, rng))
+    moving_signatures, moving_vertices = _triangle_signatures(
+        moving_points, _triangles(len(moving_points), max_triangles, rng))
+
+    # Degenerate (short-sided) triangles do not constrain the rotation
+    fixed_keep = fixed_signatures[:, 0] >= min_side
+    moving_keep = moving_signatures[:, 0] >= min_side
+    fixed_signatures, fixed_vertices = fixed_signatures[fixed_keep], fixed_vertices[fixed_keep]
+    moving_signatures, moving_vertices = moving_signatures[moving_keep], moving_vertices[moving_keep]
+
+    # Geometric hashing: look up every moving triangle among the fixed triangle signatures
+    candidates = []
+    if len(fixed_signatures) and len(moving_signatures):
+        neighbours = cKDTree(fixed_signatures).query_ball_point(moving_signatures, signature_tolerance, p=np.inf)
+        candidates = [(i, j) for i, found in enumerate(neighbours) for j in found]
+
+    if not candidates:
+        translation = fixed_points.mean(axis=0) - moving_points.mean(axis=0)
+        return rigid_to_sitk(np.eye(3), translation), 0
+
+    candidates = np.array(candidates)
+    if len(candidates) > max_hypotheses:
+        candidates = candidates[rng.choice(len(candidates), max_hypotheses, replace=False)]
+
+    # Fit one rigid hypothesis per candidate triangle pair
+    rotations, translations = _batched_kabsch(moving_points[moving_vertices[candidates[:, 0]]],
+                                              fixed_points[fixed_vertices[candidates[:, 1]]])
+
+    # Score all hypotheses at once by the number of mapped moving lesions close to a fixed lesion
+    fixed_tree = cKDTree(fixed_points)
+    mapped = np.einsum('hij,mj->hmi', rotations, moving_points) + translations[:, None, :]
+    nearest_distance, _ = fixed_tree.query(mapped.reshape(-1, 3))
+    nearest_distance = nearest_distance.reshape(len(candidates), len(moving_points))
+    inliers = nearest_distance <= inlier_tolerance
+    residual = np.where(inliers, nearest_distance, inlier_tolerance).sum(axis=1)
+    best = np.lexsort((residual, -inliers.sum(axis=1)))[0]
+
+    # Refit on the one-to-one inlier pairs of the best hypothesis
+    rotation, translation = rotations[best], translations[best]
+    nearest_distance, nearest_index = fixed_tree.query(moving_points @ rotation.T + translation)
+    inlier_moving = np.flatnonzero(nearest_distance <= inlier_tolerance)
+    _, first = np.unique(nearest_index[inlier_moving], return_index=True)
+    inlier_moving = inlier_moving[first]
+    if len(inlier_moving) >= 3:
+        rotation, translation = weighted_kabsch(moving_points[inlier_moving],
+                                                fixed_points[nearest_index[inlier_moving]])
+
+    return rigid_to_sitk(rotation, translation), len(inlier_moving)
+
+
+def constellation_match(fixed_df_or_file, moving_df_or_file, threshold, **kwargs):
+    """
+    Match lesions between two timepoints without image registration.
+
+    Fallback for cases where the registration failed or only the lesion CSVs are available. The moving
+    lesions are aligned with estimate_constellation_transform, and the alignment is refined and matched
+    with refine_transform_icp (adaptive Hungarian algorithm).
+
+    Parameters:
+        fixed_df_or_file (str or pandas.DataFrame): Lesions of the fixed image, as a CSV file path or DataFrame.
+        moving_df_or_file (str or pandas.DataFrame): Lesions of the moving image, as a CSV file path or DataFrame.
+        threshold (float): The threshold distance for considering lesions as corresponding.
+        **kwargs: Additional keyword arguments passed to estimate_constellation_transform.
+
+    Returns:
+        tuple: Same as refine_transform_icp: the transform, the registered coordinates DataFrame, the
+        correspondences DataFrame and the unmatched indices DataFrames of both sets.
+    """
+    fixed_df, _ = _lesion_points(fixed_df_or_file)
+    moving_df, _ = _lesion_points(moving_df_or_file)
+    kwargs.setdefault('inlier_tolerance', threshold)
+
+    transform, _ = estimate_constellation_transform(fixed_df, moving_df, **kwargs)
+
+    return refine_transform_icp(fixed_df, moving_df, transform, threshold)
+
+
+def check_registration_consistency(fixed_df_or_file, moving_df_or_file, transform, tolerance=10.0, **kwargs):
+    """
+    Compare a registration transform with the constellation fit of the lesions.
+
+    A cheap pre-check for cohort runs: registrations whose mapping of the moving lesions disagrees with
+    the image-free constellation alignment by more than tolerance are flagged for review.
+
+    Parameters:
+        fixed_df_or_file (str or pandas.DataFrame): Lesions of the fixed image, as a CSV file path or DataFrame.
+        moving_df_or_file (str or pandas.DataFrame): Lesions of the moving image, as a CSV file path or DataFrame.
+        transform (SimpleITK.Transform): The registration transform applied to the moving coordinates.
+        tolerance (float, optional): Largest accepted displacement between the two mappings. Defaults to 10.
+        **kwargs: Additional keyword arguments passed to estimate_constellation_transform.
+
+    Returns:
+        tuple: Whether the registration is consistent with the constellation fit, the largest displacement
+        between the two mappings of the moving lesions, and the number of constellation inliers.
+    """
+    _, moving_points = _lesion_points(moving_df_or_file)
+
+    constellation_transform, num_inliers = estimate_constellation_transform(
+        fixed_df_or_file, moving_df_or_file, **kwargs)
+
+    registered = transform_points(transform, moving_points)
+    constellation = transform_points(constellation_transform, moving_points)
+    max_difference = float(np.linalg.norm(registered - constellation, axis=1).max()) if len(moving_points) else 0.0
+
+    return max_difference <= tolerance, max_difference, num_inliers
@@ -2,43 +2,284 @@
 # coding: utf-8
 
 
+import hashlib
+import json
+import os
+
+import numpy as np
 import SimpleITK as sitk
 
-def mask_air(image, air_threshold=-950):
+from input_transform import load_dicom_series
+from dicom_io import dicom_cache_file, temporary_cache_file, write_cache_image
+from array_bridge import new_image, edit_image_array
+
+
+def mask_air(image, air_threshold=-950, shrink_factor=1, cache_file=None):
     """
     Mask out air voxels using air_threhold.
 
+    The body is the largest connected component of the voxels above air_threshold. shrink_factor > 1 opts in
+    to a faster approximation (see body_mask_air): the components are found on a volume downsampled by bin
+    averaging, and only a band of voxels around the coarse boundary is re-thresholded at full resolution.
+    Voxels deeper inside the coarse body are never re-thresholded, so air pockets that do not fill whole
+    bins are kept rather than masked out. The default shrink_factor=1 gives the exact full-resolution mask.
+
     Parameters
     ----------
-    image : np.array
+    image : SimpleITK.Image
         Image to be preprocessed.
     air_threshold : float, optional
         Threshold for air voxels. The default is -950.
+    shrink_factor : int, optional
+        Downsampling factor of the connected component analysis. The default is 1 (exact mask).
+    cache_file : str, optional
+        File caching the body mask, with air_threshold and shrink_factor stored in its header. It is read
+        when it exists and matches the image grid and both parameters, and written otherwise. The default
+        is None (no cache).
 
     Returns
     -------
-    masked_image : np.array
+    masked_image : SimpleITK.Image
         Processed image with air voxels removed.
 
     """
+    parameters = {'air_threshold': repr(float(air_threshold)), 'shrink_factor': str(int(shrink_factor))}
+
+    body_mask = None
+    if cache_file is not None and os.path.exists(cache_file):
+        body_mask = sitk.ReadImage(cache_file)
+        if (body_mask.GetSize() != image.GetSize() or not np.allclose(body_mask.GetOrigin(), image.GetOrigin())
+                or not np.allclose(body_mask.GetSpacing(), image.GetSpacing())
+                or any(not body_mask.HasMetaDataKey(key) or body_mask.GetMetaData(key) != value
+                       for key, value in parameters.items())):
+            body_mask = None
+
+    if body_mask is None:
+        body_mask = body_mask_air(image, air_threshold, shrink_factor)
+        if cache_file is not None:
+            for key, value in parameters.items():
+                body_mask.SetMetaData(key, value)
+            write_cache_image(body_mask, cache_file)
+
+    # Mask the original image with the body mask
+    masked_image = sitk.Mask(image, body_mask)
     
+    return masked_image
+
+
+def _largest_component(binary_mask):
+    """
+    Largest connected component of a binary mask, selected by relabeling the components by size.
+    """
+    labeled_mask = sitk.RelabelComponent(sitk.ConnectedComponent(binary_mask), sortByObjectSize=True)
+    return labeled_mask == 1
+
+
+def body_mask_air(image, air_threshold=-950, shrink_factor=1):
+    """
+    Compute the body mask used by mask_air: the largest connected component above air_threshold.
+
+    With shrink_factor > 1 the mask is an approximation: the component analysis runs on a volume
+    downsampled by shrink_factor, and only voxels in a band one coarse voxel wide around the coarse body
+    boundary are re-thresholded at full resolution. Inside the coarse body every voxel is kept. An air
+    pocket is only found if it makes whole bins average below air_threshold. Smaller or partially filled
+    pockets (e.g. bowel gas or small airways) stay in the mask, although the exact mask removes them.
+
+    Parameters
+    ----------
+    image : SimpleITK.Image
+        Image to be preprocessed.
+    air_threshold : float, optional
+        Threshold for air voxels. The default is -950.
+    shrink_factor : int, optional
+        Downsampling factor of the connected component analysis. The default is 1 (exact mask).
+
+    Returns
+    -------
+    body_mask : SimpleITK.Image
+        Binary (sitkUInt8) mask of the body on the image grid.
+
+    """
     # Create a binary mask using thresholding
     binary_mask = image > air_threshold
-    
-    # Perform connected component analysis
-    labeled_mask = sitk.ConnectedComponent(binary_mask)
-    
-    # Compute statistics of connected components
-    label_sizes = sitk.LabelShapeStatisticsImageFilter()
-    label_sizes.Execute(labeled_mask)
-    
-    # Find the label with the largest size (excluding label 0, which corresponds to background)
-    largest_label = max(range(1, label_sizes.GetNumberOfLabels() + 1), key=lambda label: label_sizes.GetPhysicalSize(label))
-    
-    # Create a binary mask containing only the largest connected component
-    largest_air_mask = labeled_mask == largest_label
-    
-    # Mask the original image with the largest air mask
-    masked_image = sitk.Mask(image, largest_air_mask)
-    
-    return masked_image
\ No newline at end of file
+    if shrink_factor <= 1:
+        return _largest_component(binary_mask)
+
+    # Find the body on the downsampled volume
+    coarse_image = sitk.BinShrink(sitk.Cast(image, sitk.sitkFloat32), [shrink_factor] * image.GetDimension())
+    coarse_body = _largest_component(coarse_image > air_threshold)
+
+    # Voxels in the interior of the coarse body, and in a band around its boundary (holes included)
+    coarse_interior = sitk.BinaryErode(coarse_body, [1] * image.GetDimension())
+    coarse_band = sitk.BinaryDilate(coarse_body, [1] * image.GetDimension()) - coarse_interior
+
+    def upsample(mask):
+        # Each coarse voxel covers a bin of shrink_factor voxels; the remainder at the end of an axis takes
+        # the last bin
+        array = sitk.GetArrayViewFromImage(mask)
+        for axis in range(array.ndim):
+            array = np.repeat(array, shrink_factor, axis=axis)
+        padding = [(0, full - coarse) for full, coarse in zip(image.GetSize()[::-1], array.shape)]
+        return np.pad(array, padding, mode='edge').astype(bool)
+
+    # Refine at full resolution only near the boundary
+    body_mask = new_image(sitk.GetArrayViewFromImage(binary_mask).shape, np.uint8, reference=image)
+    with edit_image_array(body_mask) as body:
+        np.bitwise_or(upsample(coarse_interior),
+                      upsample(coarse_band) & sitk.GetArrayViewFromImage(binary_mask).astype(bool),
+                      out=body.view(bool))
+    return body_mask
+
+
+# Default configuration of preprocess_image
+PREPROCESSING_DEFAULTS = {
+    'hu_range': (-1000, 2000),
+    'spacing': None,
+    'mask': True,
+    'crop': True,
+    'crop_margin': 10,
+    'air_threshold': -950,
+    'shrink_factor': 1,
+}
+
+
+def image_geometry(image):
+    """
+    Describe the voxel grid of an image.
+
+    Parameters
+    ----------
+    image : SimpleITK.Image
+        The image.
+
+    Returns
+    -------
+    geometry : dict
+        Size, origin, spacing and direction of the image, as lists.
+
+    """
+    return {'size': list(image.GetSize()), 'origin': list(image.GetOrigin()),
+            'spacing': list(image.GetSpacing()), 'direction': list(image.GetDirection())}
+
+
+def preprocess_image(image, **config):
+    """
+    Build the working volume used for registration: HU clipping, air masking, cropping to the body and
+    optional resampling to a working spacing (e.g. isotropic).
+
+    Every step keeps physical space: cropping only moves the origin, and resampling keeps origin and
+    direction. A transform estimated on working volumes therefore applies unchanged to lesion coordinates
+    in the native physical space, and voxel indices map between the grids through the recorded geometries
+    (e.g. with utils.index_to_physical and utils.physical_to_index).
+
+    Parameters
+    ----------
+    image : SimpleITK.Image
+        The native image, in Hounsfield units.
+    **config
+        Options overriding PREPROCESSING_DEFAULTS:
+            - hu_range: (low, high) clipping range, or None;
+            - spacing: working spacing, a number for isotropic voxels or an (x, y, z) tuple, or None to keep
+              the native grid;
+            - mask: mask out air with mask_air;
+            - crop: crop to the bounding box of the body mask;
+            - crop_margin: margin of the crop, in voxels;
+            - air_threshold, shrink_factor: options of mask_air.
+
+    Returns
+    -------
+    working_image : SimpleITK.Image
+        The working volume (sitkFloat32).
+    geometry : dict
+        The configuration, the 'native' and 'working' grids (see image_geometry) and the native index of the
+        crop ('crop_index').
+
+    """
+    config = {**PREPROCESSING_DEFAULTS, **config}
+    geometry = {'config': config, 'native': image_geometry(image)}
+    working_image = sitk.Cast(image, sitk.sitkFloat32)
+
+    if config['hu_range'] is not None:
+        working_image = sitk.Clamp(working_image, sitk.sitkFloat32, *config['hu_range'])
+
+    body_mask = None
+    if config['mask'] or config['crop']:
+        body_mask = body_mask_air(working_image, config['air_threshold'], config['shrink_factor'])
+    if config['mask']:
+        working_image = sitk.Mask(working_image, body_mask)
+
+    crop_index = [0] * image.GetDimension()
+    if config['crop']:
+        statistics = sitk.LabelShapeStatisticsImageFilter()
+        statistics.Execute(body_mask)
+        if statistics.HasLabel(1):
+            box = statistics.GetBoundingBox(1)
+            dimension = image.GetDimension()
+            low = [max(box[k] - config['crop_margin'], 0) for k in range(dimension)]
+            high = [min(box[k] + box[dimension + k] + config['crop_margin'], image.GetSize()[k])
+                    for k in range(dimension)]
+            crop_index = low
+            working_image = sitk.RegionOfInterest(working_image, [h - l for l, h in zip(low, high)], low)
+    geometry['crop_index'] = crop_index
+
+    if config['spacing'] is not None:
+        spacing = config['spacing']
+        spacing = [float(spacing)] * image.GetDimension() if np.isscalar(spacing) else [float(s) for s in spacing]
+        extent = np.array(working_image.GetSize()) * np.array(working_image.GetSpacing())
+        size = [max(int(round(e / s)), 1) for e, s in zip(extent, spacing)]
+        working_image = sitk.Resample(working_image, size, sitk.Transform(), sitk.sitkLinear,
+                                      working_image.GetOrigin(), spacing, working_image.GetDirection(),
+                                      0.0, sitk.sitkFloat32)
+
+    geometry['working'] = image_geometry(working_image)
+    # Same types as a geometry read back from the cache
+    return working_image, json.loads(json.dumps(geometry))
+
+
+def preprocess_dicom_series(directory, cache_dir=None, **config):
+    """
+    Load a DICOM series and build its working volume with preprocess_image, through a cache.
+
+    The working volume and its geometry are cached next to the volume cache entry of the series, keyed by
+    the configuration, so that each series is preprocessed once per configuration. Entries are dropped with
+    the volume entry when the series changes.
+
+    Parameters
+    ----------
+    directory : str
+        The path to the directory containing the DICOM series.
+    cache_dir : str, optional
+        The path to the cache directory. The default is None (no cache).
+    **config
+        Options of preprocess_image.
+
+    Returns
+    -------
+    working_image : SimpleITK.Image
+        The working volume.
+    geometry : dict
+        The geometry returned by preprocess_image.
+
+    """
+    if cache_dir is None:
+        return preprocess_image(load_dicom_series(directory), **config)
+
+    config = {**PREPROCESSING_DEFAULTS, **config}
+    key = hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:12]
+    cache_file = dicom_cache_file(directory, cache_dir)[:-len('.nrrd')] + f'_work_{key}.nrrd'
+    geometry_file = cache_file[:-len('.nrrd')] + '.json'
+
+    if os.path.exists(cache_file) and os.path.exists(geometry_file):
+        with open(geometry_file) as f:
+            return sitk.ReadImage(cache_file), json.load(f)
+
+    working_image, geometry = preprocess_image(load_dicom_series(directory, cache_dir=cache_dir), **config)
+
+    # The geometry goes first: an entry is only used once its volume exists
+    temporary_file = temporary_cache_file(geometry_file, suffix='.tmp.json')
+    with open(temporary_file, 'w') as f:
+        json.dump(geometry, f)
+    os.replace(temporary_file, geometry_file)
+    write_cache_image(working_image, cache_file, compressionLevel=1)
+
+    return working_image, geometry
@@ -0,0 +1,205 @@
+
+
+import html
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+import numpy as np
+import SimpleITK as sitk
+
+from input_transform import load_dicom_series
+from transform_coordinates import read_lesion_csv
+from correspondence_csv_input import find_corresponding_lesions, draw_lesion_correspondences
+from plots import draw_triplanar
+from utils import physical_to_index
+
+# Figures of the current worker process, created once and re-used for every case
+_worker_figures = {}
+
+
+def _init_qa_worker():
+    """
+    Select the non-interactive Agg backend in a rendering process.
+    """
+    matplotlib.use('Agg')
+
+
+def _get_figure(kind):
+    """
+    Return the figure and axes of a kind ('triplanar', 'overlay' or 'correspondences'), with cleared axes.
+    """
+    import matplotlib.pyplot as plt
+
+    if kind not in _worker_figures:
+        if kind == 'correspondences':
+            fig = plt.figure(figsize=(10, 8))
+            axs = np.array([fig.add_subplot(111, projection='3d')])
+        else:
+            fig, axs = plt.subplots(1, 3, figsize=(15, 5))
+        _worker_figures[kind] = (fig, axs)
+
+    fig, axs = _worker_figures[kind]
+    for ax in axs.ravel():
+        ax.cla()
+    fig.suptitle('')
+    return fig, axs
+
+
+def _voxel_tuples(image, df):
+    """
+    Voxel indices (x, y, z) of lesion coordinates in an image, clipped to the image.
+    """
+    indices = physical_to_index(image, df[['x', 'y', 'z']].values)
+    return [tuple(index) for index in np.clip(indices, 0, np.array(image.GetSize()) - 1).tolist()]
+
+
+def draw_registration_overlay(axs, fixed_image, registered_image, voxel=None, window_level=40, window_width=400):
+    """
+    Draw the fixed image in gray with the registered image in magenta on the axial, sagittal and coronal planes.
+
+    Args:
+        axs (array_like): Three matplotlib Axes.
+        fixed_image (SimpleITK.Image): The fixed image.
+        registered_image (SimpleITK.Image): The moving image resampled onto the fixed image grid.
+        voxel (tuple, optional): The (x, y, z) voxel the planes go through. Defaults to None (image center).
+        window_level (float, optional): The window level. Defaults to 40.
+        window_width (float, optional): The window width. Defaults to 400.
+
+    Returns:
+        None
+    """
+    if voxel is None:
+        voxel = tuple(size // 2 for size in fixed_image.GetSize())
+    low = window_level - 0.5 * window_width
+
+    def windowed(array):
+        return np.clip((array - low) / window_width, 0, 1)
+
+    fixed_array = sitk.GetArrayViewFromImage(fixed_image)
+    registered_array = sitk.GetArrayViewFromImage(registered_image)
+    spacing = fixed_image.GetSpacing()
+    planes = [('Axial', np.s_[voxel[2], :, :], spacing[0] / spacing[1], False),
+              ('Sagittal', np.s_[:, :, voxel[0]], spacing[2] / spacing[1], True),
+              ('Coronal', np.s_[:, voxel[1], :], spacing[2] / spacing[0], True)]
+
+    for ax, (name, index, aspect, flip) in zip(axs, planes):
+        fixed_slice = windowed(fixed_array[index])
+        registered_slice = windowed(registered_array[index])
+        # Fixed in green, registered in red and blue: aligned structures appear gray
+        rgb = np.stack([registered_slice, fixed_slice, registered_slice], axis=-1)
+        ax.imshow(np.flipud(rgb) if flip else rgb, aspect=aspect)
+        ax.set_title(f"{name} overlay")
+        ax.axis('off')
+
+
+def render_case_qa(case, qa_dir, window_level=40, window_width=400, threshold=30, dpi=80):
+    """
+    Render the QA figures of one case processed by the cohort pipeline to PNG files.
+
+    The figures are: the registration overlay, the lesion correspondences in 3D, and one triplanar figure per
+    lesion of the fixed and registered images. Figures are re-used across the calls made in a process.
+
+    Args:
+        case (dict): Case description with 'fixed_dir', 'moving_dir', 'fixed_csv' and 'output_dir' (holding
+            final_transform.tfm and registered_coordinates.csv written by write_case_results), and optionally
+            'name' and 'cache_dir'.
+        qa_dir (str): The QA output directory; the figures go to <qa_dir>/<case name>/.
+        window_level (float, optional): The window level. Defaults to 40.
+        window_width (float, optional): The window width. Defaults to 400.
+        threshold (float, optional): The matching threshold of the correspondence figure. Defaults to 30.
+        dpi (int, optional): Resolution of the PNG files. Defaults to 80.
+
+    Returns:
+        dict: The case name and the list of figure files relative to qa_dir.
+    """
+    name = case.get('name', os.path.basename(os.path.normpath(case['output_dir'])))
+    case_dir = os.path.join(qa_dir, name)
+    os.makedirs(case_dir, exist_ok=True)
+    figures = []
+
+    def save(fig, filename):
+        fig.savefig(os.path.join(case_dir, filename), dpi=dpi)
+        figures.append(os.path.join(name, filename))
+
+    fixed_image = load_dicom_series(case['fixed_dir'], cache_dir=case.get('cache_dir'))
+    moving_image = load_dicom_series(case['moving_dir'], cache_dir=case.get('cache_dir'))
+    transform = sitk.ReadTransform(os.path.join(case['output_dir'], 'final_transform.tfm'))
+    registered_image = sitk.Resample(moving_image, fixed_image, transform, sitk.sitkLinear, -1000.0)
+
+    fixed_lesions = read_lesion_csv(case['fixed_csv'])
+    registered_lesions = read_lesion_csv(os.path.join(case['output_dir'], 'registered_coordinates.csv'))
+
+    fig, axs = _get_figure('overlay')
+    draw_registration_overlay(axs, fixed_image, registered_image, window_level=window_level,
+                              window_width=window_width)
+    fig.suptitle(f"{name}: registration overlay")
+    save(fig, 'overlay.png')
+
+    fig, axs = _get_figure('correspondences')
+    correspondences, _, _ = find_corresponding_lesions(fixed_lesions, registered_lesions, threshold)
+    draw_lesion_correspondences(axs[0], fixed_lesions, registered_lesions, correspondences)
+    fig.suptitle(f"{name}: lesion correspondences")
+    save(fig, 'correspondences.png')
+
+    # Registered lesions are shown on the registered image, i.e. on the fixed image grid
+    for image_name, image, lesions in (('fixed', fixed_image, fixed_lesions),
+                                       ('registered', registered_image, registered_lesions)):
+        for number, (voxel, index) in enumerate(zip(_voxel_tuples(image, lesions), lesions['Index']), start=1):
+            fig, axs = _get_figure('triplanar')
+            draw_triplanar(axs, image, [voxel], window_level, window_width, lesion_numbers=[number])
+            fig.suptitle(f"{name}: {image_name} image, lesion {index}")
+            save(fig, f'{image_name}_lesion_{index}.png')
+
+    return {'name': name, 'figures': figures}
+
+
+def write_qa_index(results, qa_dir, title='Cohort QA'):
+    """
+    Write an HTML index page linking the QA figures of all cases.
+
+    Args:
+        results (list): Dictionaries returned by render_case_qa.
+        qa_dir (str): The QA output directory.
+        title (str, optional): The page title. Defaults to 'Cohort QA'.
+
+    Returns:
+        str: The path to index.html.
+    """
+    lines = [f'<html><head><meta charset="utf-8"><title>{html.escape(title)}</title></head><body>',
+             f'<h1>{html.escape(title)}</h1>']
+    for result in results:
+        lines.append(f'<h2 id="{html.escape(result["name"])}">{html.escape(result["name"])}</h2><p>')
+        for figure in result['figures']:
+            src = html.escape(figure.replace(os.sep, '/'))
+            lines.append(f'<a href="{src}"><img src="{src}" height="200" loading="lazy"></a>')
+        lines.append('</p>')
+    lines.append('</body></html>')
+
+    filename = os.path.join(qa_dir, 'index.html')
+    with open(filename, 'w') as f:
+        f.write('\n'.join(lines))
+    return filename
+
+
+def render_cohort_qa(cases, qa_dir, num_workers=4, **kwargs):
+    """
+    Render the QA figures of a cohort headlessly, spreading the cases across a process pool.
+
+    Each worker uses the Agg backend and re-uses its figures for all the cases it renders; nothing is shown
+    on screen. An index.html page linking all figures is written to qa_dir.
+
+    Args:
+        cases (list): Case descriptions accepted by render_case_qa.
+        qa_dir (str): The QA output directory.
+        num_workers (int, optional): Number of rendering processes. Defaults to 4.
+        **kwargs: Arguments of render_case_qa (window_level, window_width, threshold, dpi).
+
+    Returns:
+        str: The path to index.html.
+    """
+    os.makedirs(qa_dir, exist_ok=True)
+    with ProcessPoolExecutor(num_workers, initializer=_init_qa_worker) as executor:
+        futures = [executor.submit(render_case_qa, case, qa_dir, **kwargs) for case in cases]
+        results = [future.result() for future in futures]
+    return write_qa_index(results, qa_dir)
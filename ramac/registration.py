@@ -126,7 +126,7 @@ def update_multires_iterations():
     multires_iterations.append(len(metric_values))
 
 
-def registration_3d_rigid_series(fixed_image, moving_image):
+def registration_3d_rigid_series(fixed_image, moving_image, trace=None):
     """
     Perform 3D rigid registration using a series of steps.
 
@@ -137,6 +137,10 @@ def registration_3d_rigid_series(fixed_image, moving_image):
         moving_image : SimpleITK.Image
             The moving image to be registered.
 
+        trace : dict, optional
+            If given, filled with the 'metric_values' of every iteration and the 'multires_iterations'
+            indices into them where a resolution level starts, which end_plot discards. Defaults to None.
+
     Returns:
         tuple
             A tuple containing the resampled moving image and the list of transforms applied.
@@ -184,6 +188,17 @@ def registration_3d_rigid_series(fixed_image, moving_image):
     registration_method.AddCommand(
         sitk.sitkIterationEvent, lambda: plot_values(registration_method)
     )
+    if trace is not None:
+        trace['metric_values'] = []
+        trace['multires_iterations'] = []
+        registration_method.AddCommand(
+            sitk.sitkMultiResolutionIterationEvent,
+            lambda: trace['multires_iterations'].append(len(trace['metric_values']))
+        )
+        registration_method.AddCommand(
+            sitk.sitkIterationEvent,
+            lambda: trace['metric_values'].append(registration_method.GetMetricValue())
+        )
     
     final_transform = registration_method.Execute(
         sitk.Cast(fixed_image, sitk.sitkFloat32), sitk.Cast(moving_image, sitk.sitkFloat32)
@@ -0,0 +1,306 @@
+
+
+import json
+import sqlite3
+from contextlib import closing
+
+import pandas as pd
+
+# Schema of the result database. Deleting a case deletes all its rows in the other tables.
+RESULT_DATABASE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cases (
+    case_id INTEGER PRIMARY KEY,
+    run_id TEXT NOT NULL,
+    patient TEXT NOT NULL,
+    timepoint TEXT NOT NULL,
+    reference_timepoint TEXT,
+    threshold REAL,
+    created TEXT DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (run_id, patient, timepoint)
+);
+CREATE TABLE IF NOT EXISTS transforms (
+    case_id INTEGER NOT NULL REFERENCES cases ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    type TEXT NOT NULL,
+    parameters TEXT NOT NULL,
+    fixed_parameters TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS convergence_traces (
+    case_id INTEGER NOT NULL REFERENCES cases ON DELETE CASCADE,
+    level INTEGER NOT NULL,
+    iteration INTEGER NOT NULL,
+    metric_value REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS lesions (
+    case_id INTEGER NOT NULL REFERENCES cases ON DELETE CASCADE,
+    lesion_set TEXT NOT NULL,
+    lesion_index TEXT NOT NULL,
+    x REAL NOT NULL,
+    y REAL NOT NULL,
+    z REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS correspondences (
+    case_id INTEGER NOT NULL REFERENCES cases ON DELETE CASCADE,
+    fixed_index TEXT,
+    reg_index TEXT,
+    distance REAL,
+    match_status TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tracks (
+    case_id INTEGER NOT NULL REFERENCES cases ON DELETE CASCADE,
+    updated_index TEXT NOT NULL,
+    fixed_index TEXT,
+    reg_index TEXT
+);
+CREATE INDEX IF NOT EXISTS cases_patient ON cases (patient);
+CREATE INDEX IF NOT EXISTS cases_timepoint ON cases (timepoint);
+CREATE INDEX IF NOT EXISTS transforms_case ON transforms (case_id);
+CREATE INDEX IF NOT EXISTS convergence_traces_case ON convergence_traces (case_id);
+CREATE INDEX IF NOT EXISTS lesions_case ON lesions (case_id, lesion_set, lesion_index);
+CREATE INDEX IF NOT EXISTS correspondences_case ON correspondences (case_id);
+CREATE INDEX IF NOT EXISTS correspondences_status ON correspondences (match_status);
+CREATE INDEX IF NOT EXISTS tracks_case ON tracks (case_id);
+"""
+
+
+def connect_result_database(filename):
+    """
+    Open (and create if needed) a SQLite result database.
+
+    Each thread writing to the database should open its own connection; SQLite serializes the writes.
+
+    Parameters:
+        filename (str): The path to the database file.
+
+    Returns:
+        sqlite3.Connection: The connection, with foreign keys enabled.
+    """
+    connection = sqlite3.connect(filename, timeout=60)
+    connection.execute('PRAGMA foreign_keys = ON')
+    connection.execute('PRAGMA journal_mode = WAL')
+    connection.executescript(RESULT_DATABASE_SCHEMA)
+    return connection
+
+
+def _optional_index(value):
+    """
+    Convert a lesion index to text, keeping missing indices as NULL.
+    """
+    return None if value is None or pd.isna(value) else str(value)
+
+
+def write_case_to_database(database, patient, timepoint, run_id='', reference_timepoint=None, threshold=None,
+                           transforms=None, convergence_trace=None, multires_iterations=None, lesions=None,
+                           correspondences=None, unmatched_fixed=None, unmatched_registered=None, tracks=None):
+    """
+    Write the results of one case to the result database in a single transaction.
+
+    Writing a case that already exists for the same run replaces all its rows, so a crashed or re-run case
+    never leaves partial results behind.
+
+    Parameters:
+        database (str or sqlite3.Connection): The database file, or a connection from connect_result_database.
+        patient (str): The patient identifier.
+        timepoint (str): The timepoint of the case, e.g. 'Week 8'.
+        run_id (str, optional): Identifier of the pipeline run. Defaults to ''.
+        reference_timepoint (str, optional): The timepoint the case was registered to. Defaults to None.
+        threshold (float, optional): The matching threshold. Defaults to None.
+        transforms (dict, optional): SimpleITK transforms by name, e.g. {'final': final_transform}.
+        convergence_trace (list, optional): Metric value of every registration iteration.
+        multires_iterations (list, optional): Indices into convergence_trace where a new resolution level
+            starts, as collected by update_multires_iterations. Defaults to None (single level).
+        lesions (dict, optional): Lesion DataFrames ('x', 'y', 'z', 'Index') by set name,
+            e.g. {'fixed': ..., 'moving': ..., 'registered': ...}.
+        correspondences (pandas.DataFrame, optional): Correspondences from find_corresponding_lesions.
+        unmatched_fixed (pandas.DataFrame, optional): Unmatched indices of the fixed lesions.
+        unmatched_registered (pandas.DataFrame, optional): Unmatched indices of the registered lesions.
+        tracks (pandas.DataFrame, optional): Final correspondences from create_final_dataframe_timepoints
+            (with 'Updated Index', 'Fixed Index' and 'Reg Index' columns).
+
+    Returns:
+        int: The case_id of the case.
+    """
+    connection = connect_result_database(database) if isinstance(database, str) else database
+    try:
+        with connection:
+            connection.execute('DELETE FROM cases WHERE run_id = ? AND patient = ? AND timepoint = ?',
+                               (run_id, str(patient), str(timepoint)))
+            case_id = connection.execute(
+                'INSERT INTO cases (run_id, patient, timepoint, reference_timepoint, threshold) VALUES (?, ?, ?, ?, ?)',
+                (run_id, str(patient), str(timepoint), reference_timepoint, threshold)).lastrowid
+
+            if transforms is not None:
+                rows = []
+                for name, transform in transforms.items():
+                    transform = transform.Downcast()
+                    rows.append((case_id, name, transform.GetName(), json.dumps(list(transform.GetParameters())),
+                                 json.dumps(list(transform.GetFixedParameters()))))
+                connection.executemany('INSERT INTO transforms VALUES (?, ?, ?, ?, ?)', rows)
+
+            if convergence_trace is not None:
+                starts = sorted(multires_iterations or [0])
+                rows = [(case_id, sum(start <= iteration for start in starts[1:]), iteration, float(value))
+                        for iteration, value in enumerate(convergence_trace)]
+                connection.executemany('INSERT INTO convergence_traces VALUES (?, ?, ?, ?)', rows)
+
+            if lesions is not None:
+                for lesion_set, df in lesions.items():
+                    rows = zip([case_id] * len(df), [lesion_set] * len(df), df['Index'].astype(str),
+                               df['x'].astype(float), df['y'].astype(float), df['z'].astype(float))
+                    connection.executemany('INSERT INTO lesions VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+            rows = []
+            if correspondences is not None:
+                rows += [(case_id, _optional_index(row.Fixed_Index), _optional_index(row.Reg_Index),
+                          float(row.Distance), row.Match_Status) for row in correspondences.itertuples()]
+            # Lesions left out of the assignment have no partner and no distance
+            if unmatched_fixed is not None:
+                paired = set() if correspondences is None else set(correspondences['Fixed_Index'].astype(str))
+                rows += [(case_id, str(index), None, None, 'not matched')
+                         for index in unmatched_fixed['Fixed_Index'].astype(str) if index not in paired]
+            if unmatched_registered is not None:
+                paired = set() if correspondences is None else set(correspondences['Reg_Index'].astype(str))
+                rows += [(case_id, None, str(index), None, 'not matched')
+                         for index in unmatched_registered['Reg_Index'].astype(str) if index not in paired]
+            connection.executemany('INSERT INTO correspondences VALUES (?, ?, ?, ?, ?)', rows)
+
+            if tracks is not None:
+                # create_final_dataframe_timepoints marks a missing partner with 'Not matched'
+                tracks = tracks.replace('Not matched', None)
+                rows = [(case_id, str(updated), _optional_index(fixed), _optional_index(reg))
+                        for updated, fixed, reg in zip(tracks['Updated Index'], tracks['Fixed Index'],
+                                                       tracks['Reg Index'])]
+                connection.executemany('INSERT INTO tracks VALUES (?, ?, ?, ?)', rows)
+    finally:
+        if isinstance(database, str):
+            connection.close()
+
+    return case_id
+
+
+def _query(database, sql, parameters):
+    """
+    Run a query on a database file or connection and return the rows as a DataFrame.
+    """
+    if isinstance(database, str):
+        with closing(connect_result_database(database)) as connection:
+            return pd.read_sql_query(sql, connection, params=parameters)
+    return pd.read_sql_query(sql, database, params=parameters)
+
+
+def _case_conditions(patient, timepoint, run_id):
+    """
+    Build the WHERE conditions selecting cases, and their parameters.
+    """
+    conditions, parameters = [], []
+    for column, value in (('c.patient', patient), ('c.timepoint', timepoint), ('c.run_id', run_id)):
+        if value is not None:
+            conditions.append(f'{column} = ?')
+            parameters.append(str(value))
+    return conditions, parameters
+
+
+def _where(conditions):
+    """
+    Join WHERE conditions, or return an empty clause.
+    """
+    return (' WHERE ' + ' AND '.join(conditions)) if conditions else ''
+
+
+def query_cases(database, patient=None, timepoint=None, run_id=None):
+    """
+    List the cases in the result database.
+
+    Parameters:
+        database (str or sqlite3.Connection): The database file or connection.
+        patient (str, optional): Keep only this patient. Defaults to None.
+        timepoint (str, optional): Keep only this timepoint. Defaults to None.
+        run_id (str, optional): Keep only this run. Defaults to None.
+
+    Returns:
+        pandas.DataFrame: One row per case.
+    """
+    conditions, parameters = _case_conditions(patient, timepoint, run_id)
+    return _query(database, 'SELECT * FROM cases c' + _where(conditions) + ' ORDER BY c.patient, c.timepoint',
+                  parameters)
+
+
+def query_correspondences(database, patient=None, timepoint=None, run_id=None, match_status=None,
+                          min_distance=None):
+    """
+    Query lesion correspondences across cases and runs.
+
+    Parameters:
+        database (str or sqlite3.Connection): The database file or connection.
+        patient (str, optional): Keep only this patient. Defaults to None.
+        timepoint (str, optional): Keep only this timepoint. Defaults to None.
+        run_id (str, optional): Keep only this run. Defaults to None.
+        match_status (str, optional): Keep only 'matched' or 'not matched' rows. Defaults to None.
+        min_distance (float, optional): Keep only correspondences farther apart than this. Defaults to None.
+
+    Returns:
+        pandas.DataFrame: The correspondences with the run, patient and timepoint of their case.
+    """
+    conditions, parameters = _case_conditions(patient, timepoint, run_id)
+    if match_status is not None:
+        conditions.append('r.match_status = ?')
+        parameters.append(match_status)
+    if min_distance is not None:
+        conditions.append('r.distance > ?')
+        parameters.append(float(min_distance))
+
+    sql = ('SELECT c.run_id, c.patient, c.timepoint, r.fixed_index, r.reg_index, r.distance, r.match_status '
+           'FROM correspondences r JOIN cases c USING (case_id)' + _where(conditions) +
+           ' ORDER BY c.patient, c.timepoint, r.fixed_index')
+    return _query(database, sql, parameters)
+
+
+def query_unmatched_lesions(database, patient, lesion_set='fixed'):
+    """
+    List the lesions of a patient that were unmatched in at least one case of any run.
+
+    Parameters:
+        database (str or sqlite3.Connection): The database file or connection.
+        patient (str): The patient identifier.
+        lesion_set (str, optional): 'fixed' for the reference lesions, 'registered' for the follow-up
+            lesions. Defaults to 'fixed'.
+
+    Returns:
+        pandas.DataFrame: One row per lesion index, with the number of cases it was unmatched in and the
+        timepoints of these cases.
+    """
+    column = 'fixed_index' if lesion_set == 'fixed' else 'reg_index'
+    sql = (f'SELECT r.{column} AS lesion_index, COUNT(*) AS unmatched_cases, '
+           'GROUP_CONCAT(DISTINCT c.timepoint) AS timepoints '
+           'FROM correspondences r JOIN cases c USING (case_id) '
+           f"WHERE c.patient = ? AND r.match_status = 'not matched' AND r.{column} IS NOT NULL "
+           f'GROUP BY r.{column} ORDER BY r.{column}')
+    return _query(database, sql, [str(patient)])
+
+
+def query_tracks(database, patient=None, timepoint=None, run_id=None, min_distance=None):
+    """
+    Query lesion tracks with the distance between their fixed and registered lesions.
+
+    Parameters:
+        database (str or sqlite3.Connection): The database file or connection.
+        patient (str, optional): Keep only this patient. Defaults to None.
+        timepoint (str, optional): Keep only this timepoint. Defaults to None.
+        run_id (str, optional): Keep only this run. Defaults to None.
+        min_distance (float, optional): Keep only tracks whose distance exceeds this. Defaults to None.
+
+    Returns:
+        pandas.DataFrame: The tracks with the run, patient and timepoint of their case, and the distance
+        (missing for lesions without a partner).
+    """
+    conditions, parameters = _case_conditions(patient, timepoint, run_id)
+    if min_distance is not None:
+        conditions.append('r.distance > ?')
+        parameters.append(float(min_distance))
+
+    sql = ('SELECT c.run_id, c.patient, c.timepoint, t.updated_index, t.fixed_index, t.reg_index, r.distance '
+           'FROM tracks t JOIN cases c USING (case_id) '
+           'LEFT JOIN correspondences r ON r.case_id = t.case_id AND r.fixed_index IS t.fixed_index '
+           'AND r.reg_index IS t.reg_index' + _where(conditions) +
+           ' ORDER BY c.patient, c.timepoint, t.updated_index')
+    return _query(database, sql, parameters)
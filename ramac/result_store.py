@@ -0,0 +1,158 @@
+
+
+import json
+import os
+import shutil
+
+import pandas as pd
+
+# Tables of the result store
+STORE_TABLES = ('correspondences', 'correspondence_indices', 'unmatched', 'coordinates', 'transforms', 'metadata')
+
+
+def _partition_dir(store_dir, table, patient, timepoint):
+    """
+    Return the directory of a table partition (hive layout: table/patient=.../timepoint=...).
+    """
+    return os.path.join(store_dir, table, f"patient={patient}", f"timepoint={timepoint}")
+
+
+def _write_partition(store_dir, table, patient, timepoint, df):
+    """
+    Replace the partition of one case in a table with df.
+    """
+    partition_dir = _partition_dir(store_dir, table, patient, timepoint)
+    if os.path.isdir(partition_dir):
+        shutil.rmtree(partition_dir)
+    os.makedirs(partition_dir)
+    # Partition values live in the directory names, not in the files
+    df.to_parquet(os.path.join(partition_dir, 'part-0.parquet'), index=False)
+
+
+def _correspondence_indices_table(df):
+    """
+    Split the (fixed, moving) tuples of merge_indices output into typed columns.
+    """
+    pairs = df['Correspondence Index (F, M)'].tolist()
+    return pd.DataFrame({'Updated_Index': df['Updated Index'].astype(str).values,
+                         'Fixed_Index': [str(pair[0]) for pair in pairs],
+                         'Reg_Index': [str(pair[1]) for pair in pairs]})
+
+
+def _transforms_table(transforms):
+    """
+    Describe SimpleITK transforms by type, parameters and fixed parameters.
+    """
+    rows = []
+    for name, transform in transforms.items():
+        transform = transform.Downcast()
+        rows.append({'Name': name,
+                     'Type': transform.GetName(),
+                     'Parameters': list(transform.GetParameters()),
+                     'FixedParameters': list(transform.GetFixedParameters())})
+    return pd.DataFrame(rows, columns=['Name', 'Type', 'Parameters', 'FixedParameters'])
+
+
+def append_case_results(store_dir, patient, timepoint, correspondences=None, correspondence_indices=None,
+                        unmatched_fixed=None, unmatched_registered=None, coordinates=None, transforms=None,
+                        metadata=None):
+    """
+    Add the results of one case to a columnar (Parquet) result store.
+
+    Every table is a Parquet dataset partitioned by patient and timepoint, so a cohort run appends one
+    partition per case, re-running a case replaces its partition, and readers only open the partitions
+    they query. Columns are typed: indices are strings, distances and coordinates floats, and transform
+    parameters lists of floats, so nothing has to be parsed back with ast.literal_eval.
+
+    Writing Parquet requires pyarrow, the optional Parquet engine of pandas (pip install .[parquet]).
+
+    Parameters:
+        store_dir (str): The root directory of the store.
+        patient (str): The patient identifier.
+        timepoint (str): The timepoint of the case, e.g. 'Week 8'.
+        correspondences (pandas.DataFrame, optional): Correspondences from find_corresponding_lesions.
+        correspondence_indices (pandas.DataFrame, optional): Final correspondences from merge_indices.
+        unmatched_fixed (pandas.DataFrame, optional): Unmatched indices of the fixed lesions.
+        unmatched_registered (pandas.DataFrame, optional): Unmatched indices of the registered lesions.
+        coordinates (dict, optional): Lesion coordinate DataFrames ('x', 'y', 'z', 'Index') by set name,
+            e.g. {'fixed': ..., 'moving': ..., 'registered': ...}.
+        transforms (dict, optional): SimpleITK transforms by name, e.g. {'final': final_transform}.
+        metadata (dict, optional): Run metadata, e.g. threshold and software versions.
+
+    Returns:
+        None
+    """
+    if correspondences is not None:
+        df = correspondences.astype({'F_I': int, 'R_I': int, 'Fixed_Index': str, 'Reg_Index': str,
+                                     'Distance': float, 'Match_Status': str})
+        _write_partition(store_dir, 'correspondences', patient, timepoint, df)
+
+    if correspondence_indices is not None:
+        _write_partition(store_dir, 'correspondence_indices', patient, timepoint,
+                         _correspondence_indices_table(correspondence_indices))
+
+    if unmatched_fixed is not None or unmatched_registered is not None:
+        parts = []
+        for side, df, column in (('fixed', unmatched_fixed, 'Fixed_Index'),
+                                 ('registered', unmatched_registered, 'Reg_Index')):
+            if df is not None:
+                parts.append(pd.DataFrame({'Side': side, 'Index': df[column].astype(str).values,
+                                           'UnMatch': df['UnMatch'].astype(str).values}))
+        _write_partition(store_dir, 'unmatched', patient, timepoint, pd.concat(parts, ignore_index=True))
+
+    if coordinates is not None:
+        parts = [pd.DataFrame({'Set': name,
+                               'Index': df['Index'].astype(str).values,
+                               'x': df['x'].astype(float).values,
+                               'y': df['y'].astype(float).values,
+                               'z': df['z'].astype(float).values})
+                 for name, df in coordinates.items()]
+        _write_partition(store_dir, 'coordinates', patient, timepoint, pd.concat(parts, ignore_index=True))
+
+    if transforms is not None:
+        _write_partition(store_dir, 'transforms', patient, timepoint, _transforms_table(transforms))
+
+    if metadata is not None:
+        df = pd.DataFrame({'Key': list(metadata), 'Value': [json.dumps(value) for value in metadata.values()]})
+        _write_partition(store_dir, 'metadata', patient, timepoint, df)
+
+
+def read_store_table(store_dir, table, patient=None, timepoint=None, filters=None, columns=None):
+    """
+    Read a table of the result store, loading only the partitions and row groups that match.
+
+    Parameters:
+        store_dir (str): The root directory of the store.
+        table (str): One of STORE_TABLES.
+        patient (str or list, optional): Keep only this patient (or these patients). Defaults to None.
+        timepoint (str or list, optional): Keep only this timepoint (or these timepoints). Defaults to None.
+        filters (list, optional): Additional predicates pushed down to the reader, in pyarrow format,
+            e.g. [('Distance', '>', 10.0)]. Defaults to None.
+        columns (list, optional): Columns to read. Defaults to None (all columns).
+
+    Returns:
+        pandas.DataFrame: The selected rows, with 'patient' and 'timepoint' columns.
+    """
+    if table not in STORE_TABLES:
+        raise ValueError(f"Unknown table '{table}', expected one of {STORE_TABLES}.")
+
+    filters = list(filters or [])
+    for column, value in (('patient', patient), ('timepoint', timepoint)):
+        if value is not None:
+            values = [str(v) for v in value] if isinstance(value, (list, tuple)) else [str(value)]
+            filters.append((column, 'in', values))
+
+    # Partition values such as patient IDs are read as strings, not inferred as numbers
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    partitioning = ds.partitioning(pa.schema([('patient', pa.string()), ('timepoint', pa.string())]), flavor='hive')
+
+    df = pd.read_parquet(os.path.join(store_dir, table), filters=filters or None, columns=columns,
+                         partitioning=partitioning)
+
+    # Partition columns come back as categoricals
+    for column in ('patient', 'timepoint'):
+        if column in df.columns:
+            df[column] = df[column].astype(str)
+
+    return df
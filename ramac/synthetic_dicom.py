@@ -0,0 +1,257 @@
+
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+
+from phantominator import shepp_logan
+from utils import index_to_physical
+from array_bridge import image_from_array
+from transform_coordinates import transform_points
+
+# DICOM root of the UIDs generated here
+UID_ROOT = '1.2.826.0.1.3680043.2.1125.'
+
+
+def generate_uid(suffix=''):
+    """
+    Generate a DICOM UID, unique per call within a process.
+
+    Parameters:
+        suffix (str, optional): Text appended to the UID, e.g. a slice number. Defaults to ''.
+
+    Returns:
+        str: The UID.
+    """
+    uid = UID_ROOT + str(time.time_ns()) + str(os.getpid() % 1000)
+    return (uid + '.' + str(suffix) if suffix != '' else uid)[:64]
+
+
+def write_dicom_series(image, directory, patient_id='SYNTHETIC', study_date='20240101', study_uid=None,
+                       series_description='Synthetic phantom', modality='CT', compress=False, num_threads=4):
+    """
+    Write a 3D image as a multi-file DICOM series, one file per slice, with concurrent slice writers.
+
+    The slices carry the tags the loaders and the catalog rely on: patient, study and series identifiers,
+    study date, series description, modality, image position and orientation, instance number and slice
+    thickness. The pixel data is stored as 16-bit integers.
+
+    Args:
+        image (SimpleITK.Image): The 3D image to write, e.g. in Hounsfield units.
+        directory (str): The output directory. It is created if it does not exist.
+        patient_id (str, optional): The PatientID. Defaults to 'SYNTHETIC'.
+        study_date (str, optional): The StudyDate (YYYYMMDD). Defaults to '20240101'.
+        study_uid (str, optional): The StudyInstanceUID. Defaults to None (a new UID).
+        series_description (str, optional): The SeriesDescription. Defaults to 'Synthetic phantom'.
+        modality (str, optional): The Modality. Defaults to 'CT'.
+        compress (bool, optional): Store the pixel data compressed (lossless JPEG 2000). Defaults to False.
+        num_threads (int, optional): Number of slice-writing threads. Defaults to 4.
+
+    Returns:
+        list: The written file names, in slice order.
+    """
+    os.makedirs(directory, exist_ok=True)
+    image = sitk.Cast(image, sitk.sitkInt16)
+
+    series_uid = generate_uid()
+    study_uid = study_uid or generate_uid()
+    frame_of_reference_uid = generate_uid()
+    direction = image.GetDirection()
+    orientation = '\\'.join(f'{value:.6f}' for value in direction[0:9:3] + direction[1:9:3])
+
+    tags = {
+        '0008|0020': study_date,
+        '0008|0021': study_date,
+        '0008|0060': modality,
+        '0008|103e': series_description,
+        '0010|0010': patient_id,
+        '0010|0020': patient_id,
+        '0018|0050': f'{image.GetSpacing()[2]:.6f}',
+        '0020|000d': study_uid,
+        '0020|000e': series_uid,
+        '0020|0052': frame_of_reference_uid,
+        '0020|0037': orientation,
+        '0028|1050': '40',
+        '0028|1051': '400',
+    }
+
+    file_names = [os.path.join(directory, f'{k:04d}.dcm') for k in range(image.GetDepth())]
+
+    def write_slice(k):
+        slice_image = image[:, :, k]
+        for tag, value in tags.items():
+            slice_image.SetMetaData(tag, value)
+        position = image.TransformIndexToPhysicalPoint((0, 0, k))
+        slice_image.SetMetaData('0020|0032', '\\'.join(f'{value:.6f}' for value in position))
+        slice_image.SetMetaData('0020|0013', str(k + 1))
+        slice_image.SetMetaData('0008|0018', generate_uid(k + 1))
+
+        writer = sitk.ImageFileWriter()
+        writer.KeepOriginalImageUIDOn()
+        if compress:
+            writer.SetUseCompression(True)
+            writer.SetCompressor('JPEG2000')
+        writer.SetFileName(file_names[k])
+        writer.Execute(slice_image)
+
+    with ThreadPoolExecutor(num_threads) as executor:
+        list(executor.map(write_slice, range(image.GetDepth())))
+
+    return file_names
+
+
+def insert_spherical_lesions(volume, centers, radii, values, spacing=(1., 1., 1.)):
+    """
+    Paint spherical lesions into a volume, touching only the bounding box of each lesion.
+
+    Args:
+        volume (np.ndarray): The (z, y, x) volume, modified in place.
+        centers (array_like): (N, 3) lesion centers as (x, y, z) voxel indices.
+        radii (array_like): (N,) lesion radii, in the units of spacing.
+        values (array_like): (N,) lesion intensities.
+        spacing (tuple, optional): (x, y, z) voxel spacing. Defaults to (1., 1., 1.), i.e. radii in voxels.
+
+    Returns:
+        np.ndarray: The volume.
+    """
+    spacing = np.asarray(spacing, dtype=float)
+    for center, radius, value in zip(np.asarray(centers, dtype=float), radii, values):
+        extent = radius / spacing
+        low = np.maximum(np.floor(center - extent).astype(int), 0)
+        high = np.minimum(np.ceil(center + extent).astype(int) + 1, volume.shape[::-1])
+        xx, yy, zz = np.ogrid[low[0]:high[0], low[1]:high[1], low[2]:high[2]]
+        inside = (((xx - center[0]) * spacing[0]) ** 2 + ((yy - center[1]) * spacing[1]) ** 2 +
+                  ((zz - center[2]) * spacing[2]) ** 2) < radius ** 2
+        box = volume[low[2]:high[2], low[1]:high[1], low[0]:high[0]]
+        box[inside.transpose(2, 1, 0)] = value
+    return volume
+
+
+def random_rigid_transform(image, max_rotation=0.1, max_translation=10, rng=None):
+    """
+    Draw a random rigid transform centered on the image.
+
+    Args:
+        image (SimpleITK.Image): The image defining the center of rotation.
+        max_rotation (float, optional): Maximum absolute rotation around each axis, in radians. Defaults to 0.1.
+        max_translation (float, optional): Maximum absolute translation along each axis, in mm. Defaults to 10.
+        rng (np.random.Generator, optional): Random generator. Defaults to None (a new generator).
+
+    Returns:
+        SimpleITK.Euler3DTransform: The transform.
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    center = image.TransformContinuousIndexToPhysicalPoint([(size - 1) / 2 for size in image.GetSize()])
+    return sitk.Euler3DTransform(center, *rng.uniform(-max_rotation, max_rotation, 3),
+                                 rng.uniform(-max_translation, max_translation, 3).tolist())
+
+
+def generate_synthetic_study(output_dir, patient_id='SYNTHETIC', timepoints=('Screening', 'Week 8'),
+                             shape=(128, 256, 256), spacing=(0.8, 0.8, 2.0), num_lesions=5,
+                             lesion_radius=(2, 6), max_rotation=0.1, max_translation=10, compress=False,
+                             num_threads=4, seed=0):
+    """
+    Write a synthetic longitudinal study: one Shepp-Logan DICOM series per timepoint, with lesions and
+    known rigid motion between timepoints.
+
+    The first timepoint is the reference. Every later timepoint is the reference volume resampled through a
+    random rigid transform, so its lesions are the reference lesions moved by that transform. For each
+    timepoint the output holds:
+        - <output_dir>/<patient_id>/<timepoint>/dicom/: the DICOM series;
+        - <output_dir>/<patient_id>/<timepoint>/lesions.csv: the lesion coordinates ('x', 'y', 'z', 'Index')
+          in physical space;
+        - <output_dir>/<patient_id>/<timepoint>/ground_truth.tfm (follow-ups only): the transform mapping
+          reference points to the timepoint, i.e. what registration_3d_rigid_series should recover with the
+          reference as fixed image.
+
+    Args:
+        output_dir (str): The output directory.
+        patient_id (str, optional): The PatientID. Defaults to 'SYNTHETIC'.
+        timepoints (tuple, optional): Timepoint names; their order gives the study dates. Defaults to
+            ('Screening', 'Week 8').
+        shape (tuple, optional): (slices, rows, columns) of the volumes. Defaults to (128, 256, 256).
+        spacing (tuple, optional): (x, y, z) voxel spacing in mm. Defaults to (0.8, 0.8, 2.0).
+        num_lesions (int, optional): Number of lesions. Defaults to 5.
+        lesion_radius (tuple, optional): Range of lesion radii in mm. Defaults to (2, 6).
+        max_rotation (float, optional): Maximum rotation around each axis between timepoints, in radians.
+            Defaults to 0.1.
+        max_translation (float, optional): Maximum translation along each axis between timepoints, in mm.
+            Defaults to 10.
+        compress (bool, optional): Write compressed DICOM. Defaults to False.
+        num_threads (int, optional): Number of phantom rasterization and slice-writing threads. Defaults to 4.
+        seed (int, optional): Seed of the random lesions and transforms. Defaults to 0.
+
+    Returns:
+        pandas.DataFrame: One row per timepoint with its DICOM directory, lesion CSV and ground-truth
+        transform file (empty for the reference).
+    """
+    rng = np.random.default_rng(seed)
+
+    # Reference volume in Hounsfield units: air at -1000, phantom values scaled to tissue and bone
+    volume = -1000 + 2000 * shepp_logan(tuple(shape), num_threads=num_threads).astype(np.float32)
+
+    # Lesions inside the phantom, away from the borders
+    shape_xyz = np.array(shape[::-1])
+    centers = rng.uniform(0.3, 0.7, (num_lesions, 3)) * (shape_xyz - 1)
+    radii = rng.uniform(*lesion_radius, num_lesions)
+    insert_spherical_lesions(volume, centers, radii, [60] * num_lesions, spacing)
+
+    reference = image_from_array(volume, spacing=spacing)
+    reference_lesions = index_to_physical(reference, centers)
+    study_uid = generate_uid()
+
+    rows = []
+    for number, timepoint in enumerate(timepoints):
+        case_dir = os.path.join(output_dir, str(patient_id), str(timepoint))
+        os.makedirs(case_dir, exist_ok=True)
+
+        transform_file = ''
+        if number == 0:
+            image, lesions = reference, reference_lesions
+        else:
+            # The follow-up at point p shows the reference at T^-1(p), so a reference lesion q appears at T(q)
+            transform = random_rigid_transform(reference, max_rotation, max_translation, rng)
+            image = sitk.Resample(reference, reference, transform.GetInverse(), sitk.sitkLinear, -1000.0)
+            lesions = transform_points(transform, reference_lesions)
+            transform_file = os.path.join(case_dir, 'ground_truth.tfm')
+            sitk.WriteTransform(transform, transform_file)
+
+        dicom_dir = os.path.join(case_dir, 'dicom')
+        write_dicom_series(image, dicom_dir, patient_id=str(patient_id), study_date=f'2024{number + 1:02d}01',
+                           study_uid=f'{study_uid}.{number}', series_description=f'Synthetic {timepoint}',
+                           compress=compress, num_threads=num_threads)
+
+        lesion_file = os.path.join(case_dir, 'lesions.csv')
+        pd.DataFrame({'x': lesions[:, 0], 'y': lesions[:, 1], 'z': lesions[:, 2],
+                      'Index': [str(i + 1) for i in range(num_lesions)]}).to_csv(lesion_file, index=False)
+
+        rows.append({'PatientID': str(patient_id), 'Timepoint': timepoint, 'DicomDirectory': dicom_dir,
+                     'LesionFile': lesion_file, 'TransformFile': transform_file})
+
+    return pd.DataFrame(rows)
+
+
+def generate_synthetic_cohort(output_dir, num_patients=10, num_workers=1, **kwargs):
+    """
+    Write a reproducible synthetic cohort of longitudinal studies for I/O load testing.
+
+    Args:
+        output_dir (str): The output directory.
+        num_patients (int, optional): Number of patients. Defaults to 10.
+        num_workers (int, optional): Number of patients generated concurrently. Defaults to 1.
+        **kwargs: Arguments of generate_synthetic_study (the seed of patient i is seed + i).
+
+    Returns:
+        pandas.DataFrame: The rows of all studies returned by generate_synthetic_study.
+    """
+    seed = kwargs.pop('seed', 0)
+
+    def generate(number):
+        return generate_synthetic_study(output_dir, patient_id=f'SYNTH{number:04d}', seed=seed + number, **kwargs)
+
+    with ThreadPoolExecutor(num_workers) as executor:
+        return pd.concat(list(executor.map(generate, range(num_patients))), ignore_index=True)
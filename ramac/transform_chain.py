@@ -0,0 +1,161 @@
+
+
+import json
+
+import numpy as np
+import SimpleITK as sitk
+
+from transform_coordinates import get_affine_parameters
+
+
+def to_homogeneous(transform):
+    """
+    Convert a linear transform to a 4x4 homogeneous matrix.
+
+    Parameters:
+        transform (SimpleITK.Transform, np.ndarray or dict): A linear SimpleITK transform (composites included),
+            a 4x4 homogeneous matrix, or a collapsed chain returned by collapse_transform_chain.
+
+    Returns:
+        np.ndarray: The 4x4 homogeneous matrix of the transform.
+
+    Raises:
+        ValueError: If the transform is not linear.
+    """
+    if isinstance(transform, dict):
+        return transform['forward']
+    if isinstance(transform, np.ndarray):
+        return transform
+
+    affine = get_affine_parameters(transform)
+    if affine is None:
+        raise ValueError(f"{transform.Downcast().GetName()} is not a linear transform and cannot be collapsed.")
+
+    matrix = np.eye(4)
+    matrix[:3, :3], matrix[:3, 3] = affine
+    return matrix
+
+
+def collapse_transform_chain(transforms):
+    """
+    Collapse a chain of linear transforms into one homogeneous matrix, in both directions.
+
+    Unlike SimpleITK.CompositeTransform, whose stack applies the last added transform first, the chain is
+    given in application order: transforms[0] is applied first.
+
+    Parameters:
+        transforms (list): Transforms accepted by to_homogeneous, in the order they are applied.
+
+    Returns:
+        dict: The collapsed chain, with the 4x4 'forward' matrix and its 'inverse'.
+    """
+    forward = np.eye(4)
+    for transform in transforms:
+        forward = to_homogeneous(transform) @ forward
+
+    return {'forward': forward, 'inverse': np.linalg.inv(forward)}
+
+
+def apply_transform_chain(chain, points, inverse=False):
+    """
+    Map points through a collapsed transform chain with one matrix multiply.
+
+    Parameters:
+        chain (dict): A collapsed chain returned by collapse_transform_chain.
+        points (array_like): (N, 3) array of points.
+        inverse (bool, optional): Map through the inverse of the chain. Defaults to False.
+
+    Returns:
+        np.ndarray: (N, 3) array of mapped points.
+    """
+    matrix = chain['inverse'] if inverse else chain['forward']
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    return points @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+def transform_chain_to_sitk(chain, inverse=False):
+    """
+    Convert a collapsed transform chain to a single SimpleITK affine transform.
+
+    Parameters:
+        chain (dict): A collapsed chain returned by collapse_transform_chain.
+        inverse (bool, optional): Return the inverse of the chain. Defaults to False.
+
+    Returns:
+        SimpleITK.AffineTransform: The equivalent affine transform.
+    """
+    matrix = chain['inverse'] if inverse else chain['forward']
+    transform = sitk.AffineTransform(3)
+    transform.SetMatrix(matrix[:3, :3].ravel().tolist())
+    transform.SetTranslation(matrix[:3, 3].tolist())
+    return transform
+
+
+def save_transform_chain(chain, filename):
+    """
+    Save a collapsed transform chain to a JSON file.
+
+    Only the 12 parameters of the forward matrix are stored; the inverse is recomputed on loading.
+
+    Parameters:
+        chain (dict): A collapsed chain returned by collapse_transform_chain.
+        filename (str): The path to the output JSON file.
+
+    Returns:
+        None
+    """
+    with open(filename, 'w') as f:
+        json.dump({'matrix': chain['forward'][:3].ravel().tolist()}, f)
+
+
+def load_transform_chain(filename):
+    """
+    Load a collapsed transform chain saved with save_transform_chain.
+
+    Parameters:
+        filename (str): The path to the JSON file.
+
+    Returns:
+        dict: The collapsed chain, with the 4x4 'forward' matrix and its 'inverse'.
+    """
+    with open(filename) as f:
+        parameters = json.load(f)['matrix']
+
+    forward = np.eye(4)
+    forward[:3] = np.reshape(parameters, (3, 4))
+    return {'forward': forward, 'inverse': np.linalg.inv(forward)}
+
+
+def build_timepoint_chains(transforms_to_reference):
+    """
+    Collapse the transform chains of all timepoints of a patient.
+
+    Parameters:
+        transforms_to_reference (dict): Maps each timepoint to the list of transforms (in application order)
+            that take its coordinates into a common reference timepoint. The reference maps with an empty list.
+
+    Returns:
+        dict: Maps each timepoint to its collapsed chain.
+    """
+    return {timepoint: collapse_transform_chain(transforms)
+            for timepoint, transforms in transforms_to_reference.items()}
+
+
+def map_between_timepoints(chains, points, source, target):
+    """
+    Map points from one timepoint of a patient to another.
+
+    The cost does not depend on the length of the chains: the points are mapped with the product of the
+    cached source matrix and the cached inverse target matrix.
+
+    Parameters:
+        chains (dict): Collapsed chains per timepoint, returned by build_timepoint_chains.
+        points (array_like): (N, 3) array of points in the source timepoint.
+        source: The timepoint of the points.
+        target: The timepoint to map the points to.
+
+    Returns:
+        np.ndarray: (N, 3) array of points in the target timepoint.
+    """
+    matrix = chains[target]['inverse'] @ chains[source]['forward']
+    return apply_transform_chain({'forward': matrix}, points)
@@ -1,8 +1,20 @@
 
 
 
+import numpy as np
 import pandas as pd
+import SimpleITK as sitk
 import ast
+import threading
+from collections import OrderedDict
+
+from utils import physical_to_index
+
+# LRU caches of affine parameters and inverses of linear transforms, keyed by transform type and parameters
+CACHE_SIZE = 256
+_affine_cache = OrderedDict()
+_inverse_cache = OrderedDict()
+_cache_lock = threading.Lock()
 
 def read_lesion_csv(file_path):
     """
@@ -40,24 +52,158 @@ def transform_centroid(centroid, transform):
     return transform.TransformPoint(centroid)
 
 
-def create_transformed_dataframe(df_file, transform):
+def _is_linear(transform):
+    """
+    Whether a transform is linear, judged from its type only (without reading its parameters).
+    """
+    transform = transform.Downcast()
+    if isinstance(transform, sitk.CompositeTransform):
+        return all(_is_linear(transform.GetNthTransform(i)) for i in range(transform.GetNumberOfTransforms()))
+    return (isinstance(transform, sitk.TranslationTransform) or transform.GetTransformEnum() == sitk.sitkIdentity
+            or (hasattr(transform, 'GetMatrix') and hasattr(transform, 'GetCenter')))
+
+
+def _transform_key(transform):
+    """
+    Returns a hashable key identifying a linear transform by its type and parameters, or None for other
+    transforms, whose parameters (e.g. a whole displacement field) are too large to serve as a key.
+    """
+    if not _is_linear(transform):
+        return None
+    transform = transform.Downcast()
+    if isinstance(transform, sitk.CompositeTransform):
+        return ('CompositeTransform',) + tuple(_transform_key(transform.GetNthTransform(i))
+                                              for i in range(transform.GetNumberOfTransforms()))
+    return (transform.GetName(), transform.GetParameters(), transform.GetFixedParameters())
+
+
+def _cached(cache, key, compute):
+    """
+    Look key up in an LRU cache, computing and inserting the value on a miss. None keys are not cached.
+    """
+    if key is None:
+        return compute()
+    with _cache_lock:
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+    value = compute()
+    with _cache_lock:
+        cache[key] = value
+        if len(cache) > CACHE_SIZE:
+            cache.popitem(last=False)
+    return value
+
+
+def _compute_affine(transform):
+    """
+    Returns the (matrix, offset) pair of a linear transform, or None for other transforms.
+    """
+    transform = transform.Downcast()
+    dimension = transform.GetDimension()
+
+    if isinstance(transform, sitk.CompositeTransform):
+        # Composite transforms apply their last transform first
+        matrix, offset = np.eye(dimension), np.zeros(dimension)
+        for i in range(transform.GetNumberOfTransforms()):
+            affine = get_affine_parameters(transform.GetNthTransform(i))
+            if affine is None:
+                return None
+            matrix, offset = matrix @ affine[0], matrix @ affine[1] + offset
+        return matrix, offset
+
+    if isinstance(transform, sitk.TranslationTransform):
+        return np.eye(dimension), np.array(transform.GetOffset())
+
+    if transform.GetTransformEnum() == sitk.sitkIdentity:
+        return np.eye(dimension), np.zeros(dimension)
+
+    # Euler, Similarity, Versor, Scale and Affine transforms: T(p) = M (p - c) + c + t
+    if hasattr(transform, 'GetMatrix') and hasattr(transform, 'GetCenter'):
+        matrix = np.array(transform.GetMatrix()).reshape(dimension, dimension)
+        center = np.array(transform.GetCenter())
+        translation = np.array(transform.GetTranslation()) if hasattr(transform, 'GetTranslation') else 0.0
+        return matrix, center + translation - matrix @ center
+
+    return None
+
+
+def get_affine_parameters(transform):
+    """
+    Extract the matrix and offset of a linear transform, so that T(p) = matrix @ p + offset.
+
+    Supports Translation, Euler, Similarity, Versor, Scale and Affine transforms and composites of them.
+    The result is cached per transform type and parameters (in an LRU cache of CACHE_SIZE entries).
+
+    Parameters:
+        transform (SimpleITK.Transform): The transformation.
+
+    Returns:
+        tuple or None: The (D, D) matrix and (D,) offset, or None if the transform is not linear.
+    """
+    return _cached(_affine_cache, _transform_key(transform), lambda: _compute_affine(transform))
+
+
+def get_inverse_transform(transform):
+    """
+    Return the inverse of a transformation. Inverses of linear transforms are computed once and kept in an
+    LRU cache of CACHE_SIZE entries; other transforms are inverted on every call.
+
+    Parameters:
+        transform (SimpleITK.Transform): The transformation to invert.
+
+    Returns:
+        SimpleITK.Transform: The inverse transformation.
+    """
+    return _cached(_inverse_cache, _transform_key(transform), transform.GetInverse)
+
+
+def transform_points(transform, points, inverse=False):
+    """
+    Apply a transformation to an array of points at once.
+
+    Linear transforms (and composites of them) are applied as a single matrix multiply in NumPy.
+    Other transforms fall back to a batched call of transform.TransformPoint.
+
+    Parameters:
+        transform (SimpleITK.Transform): The transformation to apply.
+        points (array_like): (N, 3) array of points.
+        inverse (bool, optional): Apply the (cached) inverse of the transformation. Defaults to False.
+
+    Returns:
+        np.ndarray: (N, 3) array of transformed points.
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, transform.GetDimension())
+
+    affine = get_affine_parameters(transform)
+    if affine is not None:
+        matrix, offset = affine
+        if inverse:
+            return (points - offset) @ np.linalg.inv(matrix).T
+        return points @ matrix.T + offset
+
+    if inverse:
+        transform = get_inverse_transform(transform)
+    transformed = [transform.TransformPoint(point) for point in points.tolist()]
+    return np.array(transformed, dtype=float).reshape(points.shape)
+
+
+def create_transformed_dataframe(df_file, transform, inverse=False):
     """
     Create a new DataFrame with transformed coordinates.
 
     Parameters:
         df_file (str): The path to the CSV file containing the original lesion data.
         transform (SimpleITK.Transform): The transformation to apply to the coordinates.
+        inverse (bool, optional): Apply the (cached) inverse of the transformation. Defaults to False.
 
     Returns:
         pandas.DataFrame: A DataFrame containing the transformed lesion data.
     """
     df = read_lesion_csv(df_file)
     
-    # Ensure numerical values for coordinates
-    df[['x', 'y', 'z']] = df[['x', 'y', 'z']].astype(float)
-    
-    # Get transformed coordinates for each centroid
-    transformed_coords = [transform_centroid(centroid, transform) for centroid in df[['x', 'y', 'z']].values]
+    # Transform all centroids at once
+    transformed_coords = transform_points(transform, df[['x', 'y', 'z']].values.astype(float), inverse=inverse)
 
     # Create the new DataFrame
     transformed_df = pd.DataFrame(transformed_coords, columns=['x', 'y', 'z'])
@@ -86,17 +232,8 @@ def transform_physical_to_index(image, df_file_or_df):
         # Otherwise, assume it's already a DataFrame
         df = df_file_or_df
     
-    # Create an empty list to store voxel coordinates
-    voxel_coords = []
-
-    # Loop through each row in the DataFrame
-    for index, row in df.iterrows():
-        # Extract the physical coordinates from the DataFrame
-        physical_coords = [row['x'], row['y'], row['z']]
-        # Transform physical coordinates to voxel index using SimpleITK
-        index_coords = image.TransformPhysicalPointToIndex(physical_coords)
-        # Append the voxel index coordinates to the list
-        voxel_coords.append(index_coords)
+    # Transform all physical coordinates to voxel indices in one matrix multiply
+    voxel_coords = physical_to_index(image, df[['x', 'y', 'z']].values)
 
     # Create a new DataFrame to store the voxel coordinates
     df_voxel = pd.DataFrame(voxel_coords, columns=['voxel_x', 'voxel_y', 'voxel_z'])
@@ -0,0 +1,312 @@
+
+
+import json
+import os
+import struct
+import tempfile
+
+import numpy as np
+import SimpleITK as sitk
+
+# File layout: header | records and index segments. The header points to the latest index segment, a JSON
+# object listing the [key, offset, length] records written with it and pointing to the previous segment.
+STORE_MAGIC = b'RTFS'
+STORE_VERSION = 2
+_HEADER = struct.Struct('<4sHQQ')      # magic, version, index offset, index length
+_RECORD = struct.Struct('<?HI')        # composite flag, number of components, provenance length
+_COMPONENT = struct.Struct('<BBII')    # dimension, type name length, number of parameters, number of fixed parameters
+
+# Transforms rebuilt from their type, dimension, parameters and fixed parameters
+_SUPPORTED_TRANSFORMS = {'AffineTransform', 'Euler2DTransform', 'Euler3DTransform', 'ScaleSkewVersor3DTransform',
+                         'ScaleTransform', 'ScaleVersor3DTransform', 'Similarity2DTransform',
+                         'Similarity3DTransform', 'TranslationTransform', 'VersorRigid3DTransform',
+                         'VersorTransform'}
+# Transforms whose constructor takes the dimension
+_DIMENSION_TRANSFORMS = {'AffineTransform', 'TranslationTransform', 'ScaleTransform'}
+
+# An append compacts the store when it leaves more than this many index segments, or more bytes of
+# replaced records than of live records
+MAX_INDEX_SEGMENTS = 32
+
+
+def _store_key(key):
+    """
+    Convert a key to its JSON form (tuples become lists).
+    """
+    return list(key) if isinstance(key, tuple) else key
+
+
+def _lookup_key(key):
+    """
+    Convert a key read from the index back to its Python form (lists become tuples).
+    """
+    return tuple(key) if isinstance(key, list) else key
+
+
+def _encode_transform(transform, provenance=None):
+    """
+    Pack a transform (composites included) and its provenance into bytes.
+    """
+    transform = transform.Downcast()
+    is_composite = transform.GetName() == 'CompositeTransform'
+    components = ([transform.GetNthTransform(i).Downcast() for i in range(transform.GetNumberOfTransforms())]
+                  if is_composite else [transform])
+
+    unsupported = sorted({component.GetName() for component in components} - _SUPPORTED_TRANSFORMS)
+    if unsupported:
+        raise ValueError(f"Transform types {unsupported} cannot be stored in a transform store; "
+                         "write them with SimpleITK.WriteTransform instead.")
+
+    provenance = json.dumps(provenance).encode() if provenance is not None else b''
+    parts = [_RECORD.pack(is_composite, len(components), len(provenance)), provenance]
+    for component in components:
+        name = component.GetName().encode()
+        parameters = np.asarray(component.GetParameters(), dtype='<f8')
+        fixed_parameters = np.asarray(component.GetFixedParameters(), dtype='<f8')
+        parts += [_COMPONENT.pack(component.GetDimension(), len(name), parameters.size, fixed_parameters.size),
+                  name, parameters.tobytes(), fixed_parameters.tobytes()]
+    return b''.join(parts)
+
+
+def _decode_transform(record):
+    """
+    Rebuild a SimpleITK transform and its provenance from the bytes of a record.
+    """
+    is_composite, num_components, provenance_length = _RECORD.unpack_from(record)
+    position = _RECORD.size
+    provenance = json.loads(record[position:position + provenance_length]) if provenance_length else None
+    position += provenance_length
+
+    components = []
+    for _ in range(num_components):
+        dimension, name_length, num_parameters, num_fixed = _COMPONENT.unpack_from(record, position)
+        position += _COMPONENT.size
+        name = record[position:position + name_length].decode()
+        position += name_length
+        parameters = np.frombuffer(record, '<f8', num_parameters, position)
+        position += 8 * num_parameters
+        fixed_parameters = np.frombuffer(record, '<f8', num_fixed, position)
+        position += 8 * num_fixed
+
+        factory = getattr(sitk, name)
+        component = factory(dimension) if name in _DIMENSION_TRANSFORMS else factory()
+        # Fixed parameters (e.g. the center) first, as they may resize the parameters
+        component.SetFixedParameters(fixed_parameters.tolist())
+        component.SetParameters(parameters.tolist())
+        components.append(component)
+
+    transform = sitk.CompositeTransform(components) if is_composite else components[0]
+    return transform, provenance
+
+
+def read_transform_store_index(filename):
+    """
+    Read the index of a transform store.
+
+    Parameters:
+        filename (str): The path to the transform store.
+
+    Returns:
+        dict: Maps each key to the (offset, length) of its record.
+
+    Raises:
+        ValueError: If the file is not a transform store.
+    """
+    with open(filename, 'rb') as f:
+        return _read_index(f)[0]
+
+
+def _read_index(f):
+    """
+    Read the index segments of an open transform store, newest first, and merge them.
+
+    Returns the index, the number of segments and the number of bytes of replaced records.
+    """
+    magic, version, index_offset, index_length = _HEADER.unpack(f.read(_HEADER.size))
+    if magic != STORE_MAGIC or version != STORE_VERSION:
+        raise ValueError(f"{f.name} is not a version {STORE_VERSION} transform store.")
+
+    index, num_segments, dead_bytes = {}, 0, None
+    while index_length:
+        f.seek(index_offset)
+        segment = json.loads(f.read(index_length))
+        if dead_bytes is None:
+            dead_bytes = segment['dead']
+        # Newer segments override older ones
+        for key, offset, length in segment['entries']:
+            index.setdefault(_lookup_key(key), (offset, length))
+        num_segments += 1
+        index_offset, index_length = segment['previous']
+    return index, num_segments, dead_bytes or 0
+
+
+def write_transform_store(filename, transforms, provenance=None, append=True):
+    """
+    Pack transforms into a single indexed binary file.
+
+    Each record holds the transform type, dimension, parameters and fixed parameters (of every component
+    for composite transforms) as raw float64, and optional JSON provenance. Appending writes the new records
+    and an index segment listing only them after the existing data, and only then updates the header, so an
+    interrupted append leaves the previous content readable. A key written again replaces the previous
+    transform of that key. When appends have left more than MAX_INDEX_SEGMENTS segments, or more replaced
+    than live record bytes, the store is compacted (see compact_transform_store).
+
+    Only linear transforms (the types in _SUPPORTED_TRANSFORMS, and composites of them) can be stored.
+
+    Parameters:
+        filename (str): The path to the transform store.
+        transforms (dict): SimpleITK transforms by key. Keys are strings or tuples, e.g.
+            (patient, timepoint, reader, 'final').
+        provenance (dict, optional): JSON-serializable provenance by key (e.g. software version, metric
+            value). Defaults to None.
+        append (bool, optional): Add to an existing store instead of replacing it. Defaults to True.
+
+    Returns:
+        None
+
+    Raises:
+        ValueError: If a transform type is not supported.
+    """
+    provenance = provenance or {}
+    records = [(key, _encode_transform(transform, provenance.get(key))) for key, transform in transforms.items()]
+
+    if append and os.path.exists(filename):
+        with open(filename, 'r+b') as f:
+            index, num_segments, dead_bytes = _read_index(f)
+            _, _, previous_offset, previous_length = _HEADER.unpack(_read_at(f, 0, _HEADER.size))
+            f.seek(0, os.SEEK_END)
+            entries = {}
+            for key, record in records:
+                # The record this one replaces becomes dead
+                if key in index:
+                    dead_bytes += index[key][1]
+                entries[key] = (f.tell(), len(record))
+                f.write(record)
+            _write_segment_and_header(f, entries, (previous_offset, previous_length), dead_bytes)
+
+        index.update(entries)
+        live_bytes = sum(length for _, length in index.values())
+        if num_segments + 1 > MAX_INDEX_SEGMENTS or dead_bytes > live_bytes:
+            compact_transform_store(filename)
+        return
+
+    _write_new_store(filename, records)
+
+
+def _read_at(f, offset, length):
+    """
+    Read length bytes at offset of an open file.
+    """
+    f.seek(offset)
+    return f.read(length)
+
+
+def _write_new_store(filename, records):
+    """
+    Write encoded (key, record) pairs as a new store with a single index segment, under a temporary name
+    that is then moved into place.
+    """
+    handle, temporary_file = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(filename)))
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            f.write(_HEADER.pack(STORE_MAGIC, STORE_VERSION, 0, 0))
+            entries = {}
+            for key, record in records:
+                entries[key] = (f.tell(), len(record))
+                f.write(record)
+            _write_segment_and_header(f, entries, (0, 0), 0)
+        os.replace(temporary_file, filename)
+    except BaseException:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+        raise
+
+
+def _write_segment_and_header(f, entries, previous, dead_bytes):
+    """
+    Write an index segment at the current position of an open store, then point the header to it.
+    """
+    index_offset = f.tell()
+    data = json.dumps({'previous': list(previous), 'dead': dead_bytes,
+                       'entries': [[_store_key(key), offset, length] for key, (offset, length) in entries.items()]})
+    data = data.encode()
+    f.write(data)
+    f.flush()
+    f.seek(0)
+    f.write(_HEADER.pack(STORE_MAGIC, STORE_VERSION, index_offset, len(data)))
+
+
+def compact_transform_store(filename):
+    """
+    Rewrite a transform store with only its live records and a single index segment.
+
+    Appends never overwrite data, so replaced records and index segments accumulate; write_transform_store
+    calls this automatically when they pass a threshold.
+
+    Parameters:
+        filename (str): The path to the transform store.
+
+    Returns:
+        None
+    """
+    with open(filename, 'rb') as f:
+        index = _read_index(f)[0]
+        records = [(key, _read_at(f, offset, length))
+                   for key, (offset, length) in sorted(index.items(), key=lambda item: item[1][0])]
+    _write_new_store(filename, records)
+
+
+def read_transform_store(filename, keys=None, with_provenance=False):
+    """
+    Read transforms from a transform store in one pass over the file.
+
+    Parameters:
+        filename (str): The path to the transform store.
+        keys (list, optional): Keys to read. Defaults to None (all transforms).
+        with_provenance (bool, optional): Also return the provenance of each transform. Defaults to False.
+
+    Returns:
+        dict: SimpleITK transforms by key, or (transform, provenance) tuples if with_provenance is True.
+
+    Raises:
+        KeyError: If a key is not in the store.
+    """
+    with open(filename, 'rb') as f:
+        index = _read_index(f)[0]
+        keys = list(index) if keys is None else list(keys)
+        missing = [key for key in keys if key not in index]
+        if missing:
+            raise KeyError(f"Transforms not found in {filename}: {missing}")
+
+        # Read the records in file order
+        results = {}
+        for key in sorted(keys, key=lambda key: index[key][0]):
+            offset, length = index[key]
+            f.seek(offset)
+            transform, metadata = _decode_transform(f.read(length))
+            results[key] = (transform, metadata) if with_provenance else transform
+
+    return {key: results[key] for key in keys}
+
+
+def convert_transform_files(file_names, filename, key_function=None, append=True):
+    """
+    Pack existing .tfm/.txt/.h5 transform files into a transform store.
+
+    Parameters:
+        file_names (list): Transform files readable by SimpleITK.ReadTransform.
+        filename (str): The path to the transform store.
+        key_function (callable, optional): Maps a file name to its key. Defaults to None (the file name
+            without directory and extension).
+        append (bool, optional): Add to an existing store instead of replacing it. Defaults to True.
+
+    Returns:
+        list: The keys of the converted transforms.
+    """
+    if key_function is None:
+        key_function = lambda name: os.path.splitext(os.path.basename(name))[0]
+
+    transforms = {key_function(name): sitk.ReadTransform(name) for name in file_names}
+    provenance = {key: {'source': name} for key, name in zip(transforms, file_names)}
+    write_transform_store(filename, transforms, provenance, append=append)
+    return list(transforms)
@@ -6,10 +6,15 @@ import SimpleITK as sitk
 import skimage
 import scipy
 
+from array_bridge import image_from_array
+
 def numpy_array_to_sitk(x, spacing=(1.,)*3, origin=(0.,)*3):
     """
     Converts a NumPy array to a SimpleITK image format.
 
+    SimpleITK images own their pixel buffer, so this is one (counted) copy of x; see array_bridge to build
+    images in place instead.
+
     Args:
         x (np.ndarray): The input NumPy array.
         spacing (tuple, optional): The spacing of the image voxels along each dimension. Defaults to (1., 1., 1.).
@@ -18,11 +23,7 @@ def numpy_array_to_sitk(x, spacing=(1.,)*3, origin=(0.,)*3):
     Returns:
         SimpleITK.Image: The SimpleITK image representation of the input NumPy array.
     """
-    x_sitk = sitk.GetImageFromArray(x)
-    x_sitk.SetOrigin(origin)
-    x_sitk.SetSpacing(spacing)
-    
-    return x_sitk
+    return image_from_array(x, spacing=spacing, origin=origin)
 
 def insert_lesion(x, c, r):
     """
@@ -36,14 +37,16 @@ def insert_lesion(x, c, r):
     Returns:
         np.ndarray: The modified phantom array with the lesion inserted.
     """
-    # Generate meshgrid arrays with the same shape as the input array
-    zz, yy, xx = np.meshgrid(np.arange(x.shape[0]), np.arange(x.shape[1]), np.arange(x.shape[2]), indexing='ij')
+    # Bounding box of the lesion, clipped to the array
+    low = [max(int(np.floor(c[k] - r)), 0) for k in range(3)]
+    high = [min(int(np.ceil(c[k] + r)) + 1, x.shape[k]) for k in range(3)]
+    zz, yy, xx = np.ogrid[low[0]:high[0], low[1]:high[1], low[2]:high[2]]
     
-    # Create a mask for the lesion region
+    # Create a mask for the lesion region within the box
     mask = ((zz - c[0]) ** 2 + (yy - c[1]) ** 2 + (xx - c[2]) ** 2) < r ** 2
     
-    # Apply the mask to the phantom array
-    x[mask] = 0.5
+    # Apply the mask to the phantom array (a view of the box, so x is modified in place)
+    x[low[0]:high[0], low[1]:high[1], low[2]:high[2]][mask] = 0.5
     
     return x
 
@@ -111,6 +114,68 @@ def apply_rotation_and_translation(lesion_coords, rotation_matrix_x, translation
 
 
 
+def _index_to_physical_matrix(image):
+    """
+    Returns the matrix direction @ diag(spacing) that maps voxel indices to physical offsets from the origin.
+    """
+    dimension = image.GetDimension()
+    direction = np.array(image.GetDirection(), dtype=float).reshape(dimension, dimension)
+    return direction * np.array(image.GetSpacing(), dtype=float)
+
+
+def index_to_physical(image, indices):
+    """
+    Converts (continuous) voxel indices to physical points in one matrix multiply.
+
+    Equivalent to calling image.TransformContinuousIndexToPhysicalPoint on every row, but the origin,
+    spacing and direction are read only once.
+
+    Args:
+        image (SimpleITK.Image): The image defining the voxel grid.
+        indices (array_like): (N, 3) array of voxel indices (x, y, z).
+
+    Returns:
+        np.ndarray: (N, 3) array of physical points.
+    """
+    matrix = _index_to_physical_matrix(image)
+    indices = np.asarray(indices, dtype=float).reshape(-1, image.GetDimension())
+    return indices @ matrix.T + np.array(image.GetOrigin())
+
+
+def physical_to_continuous_index(image, points):
+    """
+    Converts physical points to continuous voxel indices in one matrix multiply.
+
+    Equivalent to calling image.TransformPhysicalPointToContinuousIndex on every row.
+
+    Args:
+        image (SimpleITK.Image): The image defining the voxel grid.
+        points (array_like): (N, 3) array of physical points (x, y, z).
+
+    Returns:
+        np.ndarray: (N, 3) array of continuous voxel indices.
+    """
+    matrix = np.linalg.inv(_index_to_physical_matrix(image))
+    points = np.asarray(points, dtype=float).reshape(-1, image.GetDimension())
+    return (points - np.array(image.GetOrigin())) @ matrix.T
+
+
+def physical_to_index(image, points):
+    """
+    Converts physical points to the indices of the voxels containing them.
+
+    Equivalent to calling image.TransformPhysicalPointToIndex on every row (halves are rounded up, as in ITK).
+
+    Args:
+        image (SimpleITK.Image): The image defining the voxel grid.
+        points (array_like): (N, 3) array of physical points (x, y, z).
+
+    Returns:
+        np.ndarray: (N, 3) integer array of voxel indices.
+    """
+    return np.floor(physical_to_continuous_index(image, points) + 0.5).astype(np.int64)
+
+
 def numpy_point_to_sitk(xyz, sitk_image):
     """
     Converts a tuple of numpy indices (xyz) to a SimpleITK point.
@@ -138,12 +203,9 @@ def numpy_points_to_sitk(xyzs, sitk_image):
     Returns:
         list: A list of SimpleITK points corresponding to the given numpy indices.
     """
-    sitk_xyzs = []
+    indices = np.round(np.asarray(xyzs, dtype=float))
     
-    for ind, xyz in enumerate(xyzs):
-        sitk_xyzs.append(numpy_point_to_sitk(xyz, sitk_image))
-        
-    return sitk_xyzs
+    return [tuple(xyz) for xyz in index_to_physical(sitk_image, indices).tolist()]
 
 def save_lesion_coordinates(lesion_coords, lesion_index, filename):
     """
@@ -213,7 +275,7 @@ def voxel_tuples_from_dataframe(df):
     Returns:
         list: List of tuples containing voxel coordinates.
     """
-    return [(row['voxel_x'], row['voxel_y'], row['voxel_z']) for _, row in df.iterrows()]
+    return [tuple(voxel) for voxel in df[['voxel_x', 'voxel_y', 'voxel_z']].values.tolist()]
 
 
 def round_coordinates_to_integer(coordinates):
@@ -226,8 +288,8 @@ def round_coordinates_to_integer(coordinates):
     Returns:
         list of tuples: List of tuples with each coordinate rounded to the nearest integer.
     """
-    rounded_coordinates = [(round(coord[0]), round(coord[1]), round(coord[2])) for coord in coordinates]
-    return rounded_coordinates  
+    rounded_coordinates = np.round(np.asarray(coordinates, dtype=float).reshape(-1, 3)).astype(np.int64)
+    return [tuple(coord) for coord in rounded_coordinates.tolist()]
 
 def list_to_dataframe(data_list):
     """
@@ -25,5 +25,9 @@ setuptools.setup(
                       'SimpleITK',
                       'matplotlib',
                       'ipywidgets',
-                      'ipykernel']
+                      'ipykernel'],
+    extras_require={
+        # Columnar result store (ramac/result_store.py)
+        'parquet': ['pyarrow'],
+    }
 )
\ No newline at end of file
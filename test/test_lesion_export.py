@@ -0,0 +1,28 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ramac'))
+
+from lesion_export import iter_lesion_export
+
+EXPORT = """PatientID,Timepoint,Reader,x,y,z,Index
+P1,T0,,1,2,3,1
+P1,T1,R1,1,2,3,1
+P1,T1,R1,4,5,6,2
+P2,T0,,1,2,3,1
+"""
+
+
+@pytest.mark.parametrize('chunksize', [1, 2, 100])
+@pytest.mark.parametrize('assume_sorted', [True, False])
+def test_blank_case_cells_are_kept(tmp_path, chunksize, assume_sorted):
+    export_file = tmp_path / 'export.csv'
+    export_file.write_text(EXPORT)
+
+    cases = dict(iter_lesion_export(str(export_file), chunksize=chunksize, assume_sorted=assume_sorted))
+
+    assert list(cases) == [('P1', 'T0', ''), ('P1', 'T1', 'R1'), ('P2', 'T0', '')]
+    assert [len(lesions) for lesions in cases.values()] == [1, 2, 1]
+    assert list(cases[('P1', 'T1', 'R1')].columns) == ['x', 'y', 'z', 'Index']
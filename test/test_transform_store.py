@@ -0,0 +1,62 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ramac'))
+
+from transform_store import read_transform_store, write_transform_store
+
+
+def linear_transforms():
+    euler = sitk.Euler3DTransform((1., 2., 3.), 0.1, 0.2, 0.3, (4., 5., 6.))
+    affine = sitk.AffineTransform(3)
+    affine.SetMatrix((1.1, 0., 0.1, 0., 0.9, 0., 0., 0.2, 1.))
+    return {
+        ('P1', 'Week 8', 'final'): euler,
+        'affine': affine,
+        'translation': sitk.TranslationTransform(3, (1., -2., 3.)),
+        'composite': sitk.CompositeTransform([euler, sitk.TranslationTransform(3, (1., 1., 1.))]),
+    }
+
+
+def test_round_trip(tmp_path):
+    filename = str(tmp_path / 'transforms.rtfs')
+    transforms = linear_transforms()
+    write_transform_store(filename, transforms, provenance={'affine': {'metric': -0.5}})
+
+    read = read_transform_store(filename, with_provenance=True)
+    assert list(read) == list(transforms)
+    assert read['affine'][1] == {'metric': -0.5}
+    points = np.random.default_rng(0).uniform(-50, 50, (10, 3))
+    for key, transform in transforms.items():
+        for point in points:
+            np.testing.assert_allclose(read[key][0].TransformPoint(point), transform.TransformPoint(point))
+
+
+@pytest.mark.parametrize('transform', [sitk.BSplineTransform(3), sitk.DisplacementFieldTransform(3)])
+def test_unsupported_transforms_are_rejected(tmp_path, transform):
+    filename = str(tmp_path / 'transforms.rtfs')
+    write_transform_store(filename, linear_transforms())
+
+    with pytest.raises(ValueError):
+        write_transform_store(filename, {'deformable': transform})
+    with pytest.raises(ValueError):
+        write_transform_store(filename, {'composite': sitk.CompositeTransform([sitk.Euler3DTransform(), transform])})
+
+    # The store is left readable
+    assert set(read_transform_store(filename)) == set(linear_transforms())
+
+
+def test_appends_keep_the_file_bounded(tmp_path):
+    filename = str(tmp_path / 'transforms.rtfs')
+    for n in range(200):
+        write_transform_store(filename, {f'case{n % 20}': sitk.TranslationTransform(3, (n, 0., 0.))})
+
+    read = read_transform_store(filename)
+    assert len(read) == 20
+    assert read['case19'].GetOffset() == (199., 0., 0.)
+    record_size = os.path.getsize(filename) / 20
+    assert record_size < 1000